@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from bookings import views
+from bookings.models import Booking
+from routes.models import Route
+
+
+class Command(BaseCommand):
+    help = "Benchmark conductor ticket scans (verify_ticket) on synthetic bookings, rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        route = Route.objects.select_related('bus__user').order_by('id').first()
+        if route is None:
+            raise CommandError("Needs at least one Route row")
+        operator = route.bus.user
+        factory = APIRequestFactory()
+        count = options['scans']
+
+        def scan(ticket_id):
+            request = factory.post('/api/bookings/verify/', {"ticket_id": ticket_id}, format='json')
+            force_authenticate(request, user=operator)
+            return views.verify_ticket(request)
+
+        with transaction.atomic():
+            Booking.objects.bulk_create([
+                Booking(ticket_id=f"BENCH-{i:07d}", bus=route.bus, route=route, from_loc="A", to_loc="B", price="25.00")
+                for i in range(count)
+            ], batch_size=1000)
+
+            with CaptureQueriesContext(connection) as queries:
+                scan("BENCH-0000000")
+            statements = sum(1 for q in queries.captured_queries if q['sql'].split()[0].upper() in ('SELECT', 'UPDATE'))
+
+            t0 = time.perf_counter()
+            for i in range(1, count):
+                response = scan(f"BENCH-{i:07d}")
+                if response.status_code != 200:
+                    raise CommandError(f"Scan {i} failed: {response.data}")
+            elapsed = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            for i in range(min(count, 1000)):
+                scan(f"BENCH-{i:07d}")
+            rescan = time.perf_counter() - t0
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{count - 1} scans: {(count - 1) / elapsed:,.0f} scans/s, {statements} statements per scan "
+            f"({connection.vendor}); already-used rescans: {min(count, 1000) / rescan:,.0f}/s"
+        )
@@ -1,3 +1,190 @@
-from django.test import TestCase
+import logging
+import threading
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from accounts.models import BusDetails, Wallet
+from routes.models import Route
+from .models import Booking
+from . import ticket_signing
+
+
+def make_ticket(username="operator", ticket_id="TKT-000001", price="45.50"):
+    user = User.objects.create_user(username=username, password="pass")
+    bus = BusDetails.objects.create(user=user, bus_name=f"{username} bus", reg_number=f"KL-{username}")
+    route = Route.objects.create(bus=bus, start_location="Depot", end_location="Terminus")
+    booking = Booking.objects.create(ticket_id=ticket_id, bus=bus, route=route, from_loc="Depot", to_loc="Terminus", price=price)
+    return user, bus, booking
+
+
+def scan(user, ticket_id):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client.post('/api/bookings/verify/', {"ticket_id": ticket_id}, format='json')
+
+
+class VerifyTicketTests(TestCase):
+    def setUp(self):
+        self.user, self.bus, self.booking = make_ticket()
+
+    def test_scan_credits_the_fare_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = scan(self.user, self.booking.ticket_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['transfer_msg'], "₹45.50 added to wallet.")
+        # Claim and credit: two statements, nothing read first
+        statements = [q['sql'].split()[0].upper() for q in queries.captured_queries]
+        self.assertEqual([s for s in statements if s in ('SELECT', 'UPDATE')], ['UPDATE', 'UPDATE'])
+
+        self.assertEqual(scan(self.user, self.booking.ticket_id).json()['error'], "Ticket already used.")
+        self.bus.refresh_from_db()
+        self.booking.refresh_from_db()
+        self.assertEqual(self.bus.total_earnings, Decimal("45.50"))
+        self.assertTrue(self.booking.is_verified)
+
+    def test_rejections(self):
+        other_user, other_bus, _ = make_ticket("other", "TKT-000002")
+        self.assertEqual(scan(other_user, self.booking.ticket_id).status_code, 403)
+        self.assertEqual(scan(self.user, "TKT-999999").status_code, 404)
+        passenger = User.objects.create_user(username="passenger", password="pass")
+        self.assertEqual(scan(passenger, self.booking.ticket_id).status_code, 404)
+
+        self.booking.refresh_from_db()
+        other_bus.refresh_from_db()
+        self.assertFalse(self.booking.is_verified)
+        self.assertEqual(other_bus.total_earnings, 0)
+
+
+class SignedTicketTests(TestCase):
+    def setUp(self):
+        self.operator, self.bus, _ = make_ticket()
+        self.route = Route.objects.get(bus=self.bus)
+        self.passenger = User.objects.create_user(username="passenger", password="pass")
+        Wallet.objects.filter(user=self.passenger).update(balance=100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.passenger)
+
+    def buy(self):
+        response = self.client.post('/api/bookings/pay-with-wallet/', {
+            "route_id": self.route.id, "from": "Depot", "to": "Terminus", "price": "20.00", "passenger_count": 2,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_ticket_verifies_offline_with_fetched_keys(self):
+        ticket = self.buy()
+        operator = APIClient()
+        operator.force_authenticate(self.operator)
+        data = operator.get('/api/bookings/ticket-keys/').json()
+        self.assertEqual(data['bus_id'], self.bus.id)
+        keys = {key['kid']: ticket_signing._b64decode(key['key']) for key in data['keys']}
+
+        claims = ticket_signing.verify_token(ticket['qr_token'], bus_id=self.bus.id, keys=keys)
+        self.assertEqual((claims.ticket_id, claims.route_id, claims.passenger_count), (ticket['ticket_id'], self.route.id, 2))
+        # The same token is shown again in the rider's ticket list
+        self.assertEqual(self.client.get('/api/bookings/my-tickets/').json()[0]['qr_token'], ticket['qr_token'])
+        self.assertEqual(self.client.get('/api/bookings/ticket-keys/').status_code, 403)
+
+    def test_forged_foreign_and_expired_tickets_are_rejected(self):
+        token = self.buy()['qr_token']
+        claims = ticket_signing.verify_token(token)
+        kid, _, mac = token.split('.')
+        more = "|".join(str(v) for v in claims._replace(passenger_count=5))
+        forged = f"{kid}.{ticket_signing._b64encode(more.encode())}.{mac}"
+
+        for bad, kwargs, reason in [
+            (forged, {}, "Bad signature"),
+            (token, {"bus_id": self.bus.id + 1}, "Ticket belongs to another bus"),
+            (token, {"now": claims.not_after + 1}, "Ticket expired"),
+            (token, {"keys": {}}, "Unknown signing key"),
+            ("not-a-ticket", {}, "Malformed ticket"),
+            ("\u0661." + token.split('.', 1)[1], {}, "Malformed ticket"),
+            (f"{kid}.\u00e9{token.split('.', 1)[1]}", {}, "Malformed ticket"),
+        ]:
+            with self.assertRaisesMessage(ticket_signing.InvalidTicket, reason):
+                ticket_signing.verify_token(bad, **kwargs)
+
+    def test_conductor_syncs_a_scanned_token(self):
+        token = self.buy()['qr_token']
+        operator = APIClient()
+        operator.force_authenticate(self.operator)
+        self.assertEqual(operator.post('/api/bookings/verify/', {"qr_token": token}, format='json').status_code, 200)
+        self.assertEqual(operator.post('/api/bookings/verify/', {"qr_token": token + "x"}, format='json').status_code, 400)
+
+    def test_late_sync_of_an_offline_scan_credits_the_fare(self):
+        token = self.buy()['qr_token']
+        claims = ticket_signing.verify_token(token)
+        operator = APIClient()
+        operator.force_authenticate(self.operator)
+
+        def sync(**data):
+            return operator.post('/api/bookings/verify/', {"qr_token": token, **data}, format='json')
+
+        # Synced a day after the ticket expired: what counts is when the conductor scanned it
+        with mock.patch('bookings.views.time.time', return_value=claims.not_after + 86400):
+            self.assertEqual(sync(scanned_at=claims.not_after + 60).json()['error'], "Ticket expired")
+            self.assertEqual(sync(scanned_at="yesterday").status_code, 400)
+            self.assertEqual(sync(scanned_at=claims.not_before + 60).status_code, 200)
+        self.bus.refresh_from_db()
+        self.assertEqual(self.bus.total_earnings, Decimal("20.00"))
+
+    def test_sync_without_scan_time_skips_the_validity_window(self):
+        token = self.buy()['qr_token']
+        claims = ticket_signing.verify_token(token)
+        operator = APIClient()
+        operator.force_authenticate(self.operator)
+        with mock.patch('bookings.views.time.time', return_value=claims.not_after + 86400):
+            self.assertEqual(operator.post('/api/bookings/verify/', {"qr_token": token}, format='json').status_code, 200)
+
+
+class ConcurrentVerifyTicketTests(TransactionTestCase):
+    def test_simultaneous_scans_credit_once(self):
+        user, bus, booking = make_ticket()
+        scanners = 8
+        barrier = threading.Barrier(scanners)
+        statuses = []
+
+        def conductor():
+            try:
+                barrier.wait()
+                while True:
+                    try:
+                        statuses.append(scan(user, booking.ticket_id).status_code)
+                        return
+                    except OperationalError as e:
+                        # SQLite's shared in-memory test database fails a conflicting lock instead of
+                        # waiting for it; the transaction was rolled back, so wait and scan again
+                        if 'locked' not in str(e):
+                            raise
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=conductor) for _ in range(scanners)]
+        # The test client logs every lock error as a server error before raising it
+        request_logger = logging.getLogger('django.request')
+        request_logger.disabled = True
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            request_logger.disabled = False
+
+        # One scan wins, every other one is told the ticket is used. (On SQLite the winner may itself
+        # be retried after a lock error on commit and then see its own claim, so its 200 can be a 400.)
+        self.assertEqual(len(statuses), scanners)
+        self.assertLessEqual(statuses.count(200), 1)
+        self.assertEqual(statuses.count(400), scanners - statuses.count(200))
+        booking.refresh_from_db()
+        bus.refresh_from_db()
+        self.assertTrue(booking.is_verified)
+        self.assertEqual(bus.total_earnings, Decimal("45.50"))
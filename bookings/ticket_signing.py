@@ -0,0 +1,146 @@
+"""
+Signed QR tickets, verifiable offline.
+
+A ticket issued by verify_payment / pay_with_wallet carries a token:
+
+    <kid>.<payload>.<mac>
+
+  payload  base64url of "ticket_id|bus_id|route_id|passenger_count|not_before|not_after"
+           (epoch seconds; valid for TICKET_VALIDITY_HOURS from the booking)
+  mac      base64url of the first 16 bytes of HMAC-SHA256("<kid>.<payload>")
+           under the key of the ticket's bus for period <kid>
+
+Keys rotate every TICKET_KEY_ROTATION_HOURS: the key of period k is derived
+from TICKET_SIGNING_SECRET (SECRET_KEY by default), and each bus gets its
+own key derived from that. A conductor device fetches its bus's keys while
+online (GET /api/bookings/ticket-keys/) and can then check a scanned ticket
+with one HMAC and no network; a leaked device key can only forge tickets
+for that one bus and key period. verify_token() is the same check, for the
+server and for device code that ports it.
+"""
+import base64
+import hashlib
+import hmac
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+
+SECRET = getattr(settings, 'TICKET_SIGNING_SECRET', None) or settings.SECRET_KEY
+ROTATION_SECONDS = int(getattr(settings, 'TICKET_KEY_ROTATION_HOURS', 24) * 3600)
+VALIDITY = timedelta(hours=getattr(settings, 'TICKET_VALIDITY_HOURS', 24))
+MAC_BYTES = 16
+ALGORITHM = "HMAC-SHA256-128"
+
+
+class InvalidTicket(Exception):
+    pass
+
+
+class TicketClaims(NamedTuple):
+    ticket_id: str
+    bus_id: int
+    route_id: int
+    passenger_count: int
+    not_before: int
+    not_after: int
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def key_id(at):
+    """ Key period of an epoch time. """
+    return int(at // ROTATION_SECONDS)
+
+
+def bus_key(bus_id, kid):
+    """ The signing key of one bus for key period `kid`. """
+    period_key = hmac.new(SECRET.encode('utf-8'), f"ticket-key:{kid}".encode('ascii'), hashlib.sha256).digest()
+    return hmac.new(period_key, f"bus:{bus_id}".encode('ascii'), hashlib.sha256).digest()
+
+
+def _mac(key, signed):
+    return hmac.new(key, signed, hashlib.sha256).digest()[:MAC_BYTES]
+
+
+def sign(claims):
+    """ Token for `claims` (TicketClaims), under the key of its bus for the period it starts in. """
+    kid = key_id(claims.not_before)
+    payload = _b64encode("|".join(str(value) for value in claims).encode('utf-8'))
+    signed = f"{kid}.{payload}"
+    return f"{signed}.{_b64encode(_mac(bus_key(claims.bus_id, kid), signed.encode('ascii')))}"
+
+
+def sign_ticket(booking):
+    """ Token of a Booking. Deterministic, so the ticket list can show it again later. """
+    issued = booking.created_at
+    return sign(TicketClaims(
+        booking.ticket_id, booking.bus_id, booking.route_id, booking.passenger_count,
+        int(issued.timestamp()), int((issued + VALIDITY).timestamp()),
+    ))
+
+
+def verify_token(token, bus_id=None, now=None, keys=None, check_window=True):
+    """
+    Check a token: well formed, signed by the bus's key, and inside its
+    validity window at `now`. bus_id: only accept tickets of this bus. keys:
+    {kid: key bytes} of one bus, as a conductor device holds them (default:
+    derive them here). check_window=False skips the validity window, for scans
+    a device already accepted and syncs later. Returns TicketClaims; raises
+    InvalidTicket.
+    """
+    try:
+        kid_text, payload, mac = token.split('.')
+        # int() would also take non-ASCII digits, which can't be signed
+        if not (kid_text.isascii() and kid_text.isdigit() and payload.isascii()):
+            raise ValueError(kid_text)
+        kid = int(kid_text)
+        fields = _b64decode(payload).decode('utf-8').split('|')
+        ticket_id, numbers = fields[0], [int(value) for value in fields[1:]]
+        claims = TicketClaims(ticket_id, *numbers)
+        given = _b64decode(mac)
+    except (AttributeError, ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidTicket("Malformed ticket")
+
+    if bus_id is not None and claims.bus_id != bus_id:
+        raise InvalidTicket("Ticket belongs to another bus")
+    if keys is not None:
+        key = keys.get(kid)
+        if key is None:
+            raise InvalidTicket("Unknown signing key")
+    else:
+        key = bus_key(claims.bus_id, kid)
+    if not hmac.compare_digest(given, _mac(key, f"{kid_text}.{payload}".encode('ascii'))):
+        raise InvalidTicket("Bad signature")
+
+    if not check_window:
+        return claims
+    now = time.time() if now is None else now
+    if not claims.not_before <= now <= claims.not_after:
+        raise InvalidTicket("Ticket expired" if now > claims.not_after else "Ticket not valid yet")
+    return claims
+
+
+def keys_for_bus(bus_id, now=None):
+    """
+    The keys a conductor device of this bus needs now and until the next
+    rotation: every period a still-valid ticket can be signed in, plus the next one.
+    """
+    now = time.time() if now is None else now
+    first, last = key_id(now - VALIDITY.total_seconds()), key_id(now) + 1
+    return [
+        {
+            "kid": kid,
+            "key": _b64encode(bus_key(bus_id, kid)),
+            "not_before": kid * ROTATION_SECONDS,
+            "not_after": (kid + 1) * ROTATION_SECONDS,
+        }
+        for kid in range(first, last + 1)
+    ]
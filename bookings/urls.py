@@ -9,6 +9,7 @@ urlpatterns = [
     
     # Operator Verification (Scanning)
     path('verify/', views.verify_ticket, name='verify_ticket'),
+    path('ticket-keys/', views.get_ticket_keys, name='get_ticket_keys'),
     
     # User Tickets
     path('my-tickets/', views.get_user_tickets, name='get_user_tickets'),
@@ -1,15 +1,19 @@
 import razorpay
 import os
+from django.db import connection, transaction
 from django.db.models import F 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Booking
+from . import ticket_signing
+from .ticket_signing import InvalidTicket
 from routes.models import Route
 from accounts.models import BusDetails, Wallet, WalletTransaction
 import random
 import string
+import time
 from decimal import Decimal
 from decouple import config
 import razorpay
@@ -96,7 +100,8 @@ def verify_payment(request):
             "from": booking.from_loc,
             "to": booking.to_loc,
             "passenger_count": booking.passenger_count,
-            "date": booking.created_at.strftime("%Y-%m-%d %H:%M")
+            "date": booking.created_at.strftime("%Y-%m-%d %H:%M"),
+            "qr_token": ticket_signing.sign_ticket(booking)
         }, status=status.HTTP_201_CREATED)
 
     except razorpay.errors.SignatureVerificationError:
@@ -160,7 +165,8 @@ def pay_with_wallet(request):
             "from": booking.from_loc,
             "to": booking.to_loc,
             "passenger_count": booking.passenger_count,
-            "date": booking.created_at.strftime("%Y-%m-%d %H:%M")
+            "date": booking.created_at.strftime("%Y-%m-%d %H:%M"),
+            "qr_token": ticket_signing.sign_ticket(booking)
         }, status=status.HTTP_201_CREATED)
 
     except Wallet.DoesNotExist:
@@ -174,36 +180,98 @@ def pay_with_wallet(request):
 #  3. OPERATOR VERIFICATION
 # ==========================================
 
+CENTS = Decimal('0.01')
+
+
+def _claim_ticket(ticket_id, user):
+    """
+    Mark the ticket verified if it is still unused and belongs to `user`'s bus,
+    in one conditional UPDATE. Returns (bus_id, price) if this call claimed it, else None.
+    """
+    # UPDATE ... RETURNING (PostgreSQL, SQLite >= 3.35) hands back the fare in the same round trip
+    if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+        q = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {q(Booking._meta.db_table)} SET {q('is_verified')} = %s"
+                f" WHERE {q('ticket_id')} = %s AND {q('is_verified')} = %s"
+                f" AND {q('bus_id')} IN (SELECT {q('id')} FROM {q(BusDetails._meta.db_table)} WHERE {q('user_id')} = %s)"
+                f" RETURNING {q('bus_id')}, {q('price')}",
+                [True, ticket_id, False, user.id],
+            )
+            return cursor.fetchone()
+
+    claimed = Booking.objects.filter(ticket_id=ticket_id, bus__user=user, is_verified=False).update(is_verified=True)
+    if not claimed:
+        return None
+    return Booking.objects.filter(ticket_id=ticket_id).values_list('bus_id', 'price').get()
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated]) 
 def verify_ticket(request):
+    """
+    Conductor scan. The ticket is claimed by a conditional UPDATE (unused, on
+    this operator's bus) and the fare credited to the bus in the same
+    transaction, so two scans of one ticket can never both pass or both credit.
+    Takes the ticket_id, or the signed qr_token (see bookings/ticket_signing.py),
+    e.g. when a conductor device syncs tickets it checked offline. A sync can
+    come long after the ticket expired, so the validity window is checked at
+    the device's `scanned_at` (epoch seconds) if it sends one, else not at all.
+    """
     ticket_id = request.data.get('ticket_id')
-    try:
-        operator_bus = BusDetails.objects.get(user=request.user)
-        ticket = Booking.objects.get(ticket_id=ticket_id)
-
-        if ticket.bus.id != operator_bus.id:
+    if request.data.get('qr_token'):
+        scanned_at = request.data.get('scanned_at')
+        try:
+            # A device clock running ahead can't stretch a ticket past now
+            scanned_at = min(float(scanned_at), time.time()) if scanned_at not in (None, '') else None
+        except (TypeError, ValueError):
+            return Response({"error": "scanned_at must be epoch seconds"}, 400)
+        try:
+            claims = ticket_signing.verify_token(request.data['qr_token'], now=scanned_at, check_window=scanned_at is not None)
+        except InvalidTicket as e:
+            return Response({"error": str(e)}, 400)
+        ticket_id = claims.ticket_id
+
+    with transaction.atomic():
+        claimed = _claim_ticket(ticket_id, request.user)
+        if claimed is not None:
+            bus_id, price = claimed
+            price = Decimal(str(price)).quantize(CENTS)
+            BusDetails.objects.filter(id=bus_id).update(total_earnings=F('total_earnings') + price)
+
+    if claimed is None:
+        # Only failed scans pay for working out why
+        ticket = Booking.objects.filter(ticket_id=ticket_id).values_list('bus__user_id', flat=True).first()
+        if ticket is None or not BusDetails.objects.filter(user=request.user).exists():
+            return Response({"error": "Invalid Request"}, 404)
+        if ticket != request.user.id:
             return Response({"error": "Invalid Bus! Ticket belongs to another operator."}, 403)
+        return Response({"error": "Ticket already used."}, 400)
 
-        if ticket.is_verified:
-            return Response({"error": "Ticket already used."}, 400)
-
-        ticket.is_verified = True
-        ticket.save()
+    return Response({
+        "message": "Verified!", 
+        "transfer_msg": f"₹{price} added to wallet."
+    }, 200)
 
-        # --- FINANCIAL SAFETY FIX ---
-        operator_bus.total_earnings = F('total_earnings') + Decimal(str(ticket.price))
-        operator_bus.save()
-        
-        operator_bus.refresh_from_db() 
-
-        return Response({
-            "message": "Verified!", 
-            "transfer_msg": f"₹{ticket.price} added to wallet."
-        }, 200)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_ticket_keys(request):
+    """
+    Signing keys of the operator's bus, for checking QR tickets offline: every
+    key a still-valid ticket can be signed with, plus the next period's.
+    """
+    try:
+        operator_bus = BusDetails.objects.get(user=request.user)
+    except BusDetails.DoesNotExist:
+        return Response({"error": "Only Bus Operators can fetch ticket keys."}, status=403)
 
-    except (BusDetails.DoesNotExist, Booking.DoesNotExist):
-        return Response({"error": "Invalid Request"}, 404)
+    return Response({
+        "bus_id": operator_bus.id,
+        "algorithm": ticket_signing.ALGORITHM,
+        "rotation_seconds": ticket_signing.ROTATION_SECONDS,
+        "keys": ticket_signing.keys_for_bus(operator_bus.id)
+    }, status=200, headers={"Cache-Control": "private, no-store"})
 
 # ==========================================
 #  4. USER TICKETS
@@ -226,7 +294,8 @@ def get_user_tickets(request):
                 "price": str(booking.price),
                 "passenger_count": booking.passenger_count,
                 "date": booking.created_at.strftime("%Y-%m-%d %H:%M"),
-                "is_verified": booking.is_verified
+                "is_verified": booking.is_verified,
+                "qr_token": ticket_signing.sign_ticket(booking)
             })
             
         return Response(ticket_data, status=status.HTTP_200_OK)
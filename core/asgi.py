@@ -2,6 +2,16 @@
 ASGI config for core project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Live bus streams (/api/routes/bus/live/<route_id>/stream/) are only served
+here, e.g. under gunicorn core.asgi:application -k uvicorn.workers.UvicornWorker:
+routes.live_push answers them ahead of Django (and its middleware, so it
+sets CORS headers itself), each one waiting on the event loop instead of
+holding a thread. Everything else goes to Django. The default deployment
+(Procfile, cPanel) runs core.wsgi, where the stream URL answers 501 and
+clients poll /api/routes/bus/live/<route_id>/.
+
+With more than one worker, live pushes need LIVE_PUSH_LAYER =
+'routes.live_push.CacheChannelLayer' on a shared cache (see routes.checks).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
@@ -9,8 +19,31 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 
 import os
 
+from asgiref.sync import sync_to_async
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from routes import live_ingest, live_push  # noqa: E402  (needs the app registry loaded above)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Write out buffered bus positions before the worker exits
+            await sync_to_async(live_ingest.buffer.flush)()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and live_push.STREAM_PATH.match(scope['path']):
+        return await live_push.stream_app(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -74,6 +74,23 @@ DATABASES = {
 }
 
 
+# Cache
+# Holds state every worker must see: the network version, live bus state, GPS
+# filter and stop trackers. Defaults to per-process local memory, which is
+# what tests and a single-process server can use; with WEB_CONCURRENCY > 1
+# point CACHE_BACKEND at a shared cache (e.g. Redis or the database cache),
+# or the routes checks stop the server from starting.
+
+WEB_CONCURRENCY = config('WEB_CONCURRENCY', default=1, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='travelsync'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
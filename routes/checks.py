@@ -0,0 +1,43 @@
+"""
+Deployment checks for state that must be shared between worker processes.
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+from django.utils.module_loading import import_string
+
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def _workers():
+    return getattr(settings, 'WEB_CONCURRENCY', 1)
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """ Live bus state, GPS filter state and stop trackers are only correct if every worker sees them. """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if _workers() > 1 and backend in LOCAL_CACHES:
+        return [Error(
+            f"{backend} is per process, but WEB_CONCURRENCY is {_workers()}.",
+            hint="Set CACHE_BACKEND/CACHE_LOCATION to a cache all workers share, or run one worker.",
+            id='routes.E001',
+        )]
+    return []
+
+
+@register()
+def check_push_layer(app_configs, **kwargs):
+    """ InMemoryChannelLayer only reaches the subscribers of the worker that ingested the position. """
+    from .live_push import InMemoryChannelLayer
+
+    path = getattr(settings, 'LIVE_PUSH_LAYER', 'routes.live_push.InMemoryChannelLayer')
+    if _workers() > 1 and import_string(path) is InMemoryChannelLayer:
+        return [Error(
+            f"LIVE_PUSH_LAYER {path} only pushes within one process, but WEB_CONCURRENCY is {_workers()}.",
+            hint="Use 'routes.live_push.CacheChannelLayer' on a shared cache, or run one worker.",
+            id='routes.E002',
+        )]
+    return []
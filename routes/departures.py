@@ -0,0 +1,65 @@
+"""
+Per-route sorted departure arrays for time-aware search.
+
+For every route we keep its trips' start times (minutes after midnight) in
+an ascending array('i') plus the matching Trip ids, so "next departures
+after 09:30" is a bisect per route and a heap merge across routes.
+"""
+import heapq
+import logging
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+
+from .lazy_index import LazyIndex
+from .network_version import get_version
+
+logger = logging.getLogger(__name__)
+
+
+class DepartureIndex:
+    def __init__(self, rows):
+        """ rows: iterable of (trip_id, route_id, start_minutes). """
+        grouped = defaultdict(list)
+        for trip_id, route_id, start in rows:
+            grouped[route_id].append((start, trip_id))
+
+        # { route_id: (array of start minutes, [trip ids]) }, both in departure order
+        self.routes = {}
+        for route_id, trips in grouped.items():
+            trips.sort()
+            self.routes[route_id] = (array('i', (t[0] for t in trips)), [t[1] for t in trips])
+
+    @classmethod
+    def build(cls):
+        from .models import Trip
+
+        rows = (
+            (trip_id, route_id, start.hour * 60 + start.minute)
+            for trip_id, route_id, start in Trip.objects.values_list('id', 'route_id', 'start_time')
+        )
+        index = cls(rows)
+        logger.info(f"Built departure index for {len(index.routes)} routes")
+        return index
+
+    def _upcoming(self, route_id, after):
+        starts, trip_ids = self.routes.get(route_id, ((), ()))
+        for i in range(bisect_left(starts, after), len(starts)):
+            yield starts[i], route_id, trip_ids[i]
+
+    def next_departures(self, route_ids, after, limit):
+        """ The `limit` earliest (start_minutes, route_id, trip_id) at or after `after` across `route_ids`. """
+        merged = heapq.merge(*(self._upcoming(route_id, after) for route_id in route_ids))
+        return [departure for departure, _ in zip(merged, range(limit))]
+
+
+_index = LazyIndex(DepartureIndex.build, max_age=getattr(settings, 'ROUTE_SEARCH_INDEX_MAX_AGE', 60), version=get_version)
+
+get_index = _index.get
+invalidate = _index.invalidate
+
+
+def next_departures(route_ids, after, limit):
+    return get_index().next_departures(route_ids, after, limit)
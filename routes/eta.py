@@ -0,0 +1,165 @@
+"""
+Live ETAs along a route.
+
+A route's geometry is the polyline start -> stops -> end through the real
+Location coordinates, with the cumulative along-route distance of every
+vertex computed once and cached per route (dropped on network changes).
+
+For a bus position we project it onto every segment at once (local
+equirectangular plane, fine at segment scale), take the closest segment,
+and turn it into a distance along the route. Each segment's travel time is
+the learned one for this weekday/hour when there is one
+(routes/segment_times.py), distance / speed otherwise; the ETA of every
+stop ahead is then a cumulative sum minus the bus's own position, in a
+handful of array operations whatever the number of stops.
+"""
+import logging
+import math
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+
+from .geo_index import KM_PER_DEGREE, haversine_km
+from .lazy_index import VersionedCache
+from .network_version import get_version
+from .segment_times import segment_seconds
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPEED_KMH = getattr(settings, 'ETA_DEFAULT_SPEED_KMH', 25)
+MIN_SPEED_KMH = getattr(settings, 'ETA_MIN_SPEED_KMH', 5)     # below this the bus is standing; use the default
+CACHE_SIZE = getattr(settings, 'ETA_GEOMETRY_CACHE_SIZE', 5000)
+
+
+class Projection(NamedTuple):
+    progress_km: float      # distance along the route
+    off_route_km: float     # distance from the bus to the route polyline
+    segment: int            # index of the segment the bus is on
+
+
+class RouteGeometry:
+    def __init__(self, vertices, location_ids=None):
+        """
+        vertices: [(stop_number, name, lat, lng)] in travel order, start first.
+        Vertices without coordinates are kept in the stop list but left out of the polyline.
+        location_ids (parallel to vertices) name the segments for learned travel times.
+        """
+        self.stop_numbers = [v[0] for v in vertices]
+        self.names = [v[1] for v in vertices]
+        located = [i for i, v in enumerate(vertices) if v[2] is not None and v[3] is not None]
+        self.located = np.array(located, dtype=np.int64)
+        ids = [location_ids[i] for i in located] if location_ids else []
+        self.segments = list(zip(ids, ids[1:]))
+        self.lats = np.array([float(vertices[i][2]) for i in located], dtype=np.float64)
+        self.lngs = np.array([float(vertices[i][3]) for i in located], dtype=np.float64)
+
+        # Cumulative along-route distance of every located vertex
+        legs = haversine_km(self.lats[:-1], self.lngs[:-1], self.lats[1:], self.lngs[1:])
+        self.cumulative = np.concatenate([[0.0], np.cumsum(legs)])
+        self.length_km = float(self.cumulative[-1]) if len(self.cumulative) else 0.0
+
+        # Planar coordinates (km) around the route's mean latitude, for projection
+        if len(located):
+            self._kx = KM_PER_DEGREE * math.cos(math.radians(float(self.lats.mean())))
+            self.xs = self.lngs * self._kx
+            self.ys = self.lats * KM_PER_DEGREE
+
+    @classmethod
+    def build(cls, route_id):
+        from .models import Location, Route, RouteStop
+
+        start, end = Route.objects.values_list('start_location', 'end_location').get(id=route_id)
+        stops = list(
+            RouteStop.objects.filter(route_id=route_id).order_by('stop_number')
+            .values_list('stop_number', 'location__name', 'location__latitude', 'location__longitude', 'location_id')
+        )
+        ends = {name: (lat, lng, loc_id) for loc_id, name, lat, lng in Location.objects.filter(name__in=[start, end]).values_list('id', 'name', 'latitude', 'longitude')}
+        last = stops[-1][0] + 1 if stops else 1
+        vertices = [(0, start, *ends.get(start, (None, None, None))), *stops, (last, end, *ends.get(end, (None, None, None)))]
+        return cls([v[:4] for v in vertices], [v[4] for v in vertices])
+
+    def project(self, lat, lng):
+        """ Closest point on the route polyline to (lat, lng). """
+        if len(self.located) < 2:
+            return None
+        px, py = lng * self._kx, lat * KM_PER_DEGREE
+        ax, ay = self.xs[:-1], self.ys[:-1]
+        dx, dy = self.xs[1:] - ax, self.ys[1:] - ay
+        seg_len2 = dx * dx + dy * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(seg_len2 > 0, ((px - ax) * dx + (py - ay) * dy) / seg_len2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        dist2 = (ax + t * dx - px) ** 2 + (ay + t * dy - py) ** 2
+        i = int(np.argmin(dist2))
+
+        leg = self.cumulative[i + 1] - self.cumulative[i]
+        return Projection(float(self.cumulative[i] + t[i] * leg), math.sqrt(float(dist2[i])), i)
+
+    def etas(self, lat, lng, speed_kmh=None, segment_seconds=None):
+        """
+        (Projection, [minutes or None per vertex]). None for vertices already
+        passed or without coordinates. segment_seconds: learned time per
+        segment (NaN = unknown), see routes/segment_times.py.
+        """
+        projection = self.project(lat, lng)
+        minutes = [None] * len(self.names)
+        if projection is None:
+            return None, minutes
+
+        speed = speed_kmh if speed_kmh and speed_kmh >= MIN_SPEED_KMH else DEFAULT_SPEED_KMH
+        seconds = np.diff(self.cumulative) / speed * 3600
+        if segment_seconds is not None:
+            seconds = np.where(np.isnan(segment_seconds), seconds, segment_seconds)
+        elapsed = np.concatenate([[0.0], np.cumsum(seconds)])
+
+        i = projection.segment
+        leg = self.cumulative[i + 1] - self.cumulative[i]
+        done = (projection.progress_km - self.cumulative[i]) / leg if leg > 0 else 0.0
+        now = elapsed[i] + done * seconds[i]
+
+        ahead = self.cumulative >= projection.progress_km
+        eta = np.rint((elapsed - now) / 60).astype(np.int64)
+        for index, value in zip(self.located[ahead].tolist(), eta[ahead].tolist()):
+            minutes[index] = value
+        return projection, minutes
+
+
+_geometries = VersionedCache(CACHE_SIZE, version=get_version)
+invalidate = _geometries.invalidate
+
+
+def get_geometry(route_id):
+    return _geometries.get(route_id, lambda: RouteGeometry.build(route_id))
+
+
+def route_etas(route_id, lat, lng, speed_kmh=None):
+    """
+    Live state of a route with its bus at (lat, lng): what /bus/live/<route_id>/
+    returns. "stops" is the whole route in travel order: the start
+    (stop_number 0), every RouteStop, then the end (last stop_number + 1).
+    eta_minutes is null for a stop the bus has passed or that has no
+    coordinates. (Before live ETAs it listed the RouteStops only, each with an
+    integer ETA; clients must skip nulls.)
+    """
+    geometry = get_geometry(route_id)
+    learned = segment_seconds(geometry.segments) if geometry.segments else None
+    projection, minutes = geometry.etas(lat, lng, speed_kmh, segment_seconds=learned)
+
+    return {
+        "bus_location": {
+            "lat": lat,
+            "lng": lng
+        },
+        "progress_km": round(projection.progress_km, 3) if projection else None,
+        "route_length_km": round(geometry.length_km, 3),
+        "off_route_km": round(projection.off_route_km, 3) if projection else None,
+        "stops": [
+            {
+                "stop_name": name,
+                "stop_number": number,
+                "eta_minutes": eta_minutes,
+            }
+            for number, name, eta_minutes in zip(geometry.stop_numbers, geometry.names, minutes)
+        ]
+    }
@@ -0,0 +1,149 @@
+"""
+Fleet map: where every live bus is, by bounding box or by route.
+
+A uniform lat/lng grid (FLEET_CELL_DEGREES cells, like routes/geo_index.py)
+over the latest BusLiveLocation positions, kept per process and refreshed
+incrementally: at most every FLEET_REFRESH_MS a reader pulls only the rows
+whose updated_at moved since the newest one already applied (minus
+FLEET_OVERLAP_SECONDS for flushes from other workers that committed late)
+and moves those buses between cells. A full reload every
+FLEET_REBUILD_SECONDS (or on invalidate()) drops buses that were deleted.
+
+Every bus also carries moved_at, the updated_at at which its position last
+changed (a ping from a standing bus doesn't count), so a client that sends
+back the previous response's cursor only gets the buses that moved.
+"""
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CELL_DEGREES = getattr(settings, 'FLEET_CELL_DEGREES', 0.05)
+REFRESH_SECONDS = getattr(settings, 'FLEET_REFRESH_MS', 1000) / 1000
+REBUILD_SECONDS = getattr(settings, 'FLEET_REBUILD_SECONDS', 300)
+OVERLAP_SECONDS = getattr(settings, 'FLEET_OVERLAP_SECONDS', 5)
+
+FIELDS = ["bus_id", "lat", "lng", "speed", "heading", "updated_at"]
+
+
+class BusPosition(NamedTuple):
+    latitude: float
+    longitude: float
+    speed: float
+    heading: float
+    updated_at: float       # epoch seconds
+    moved_at: float         # updated_at of the last position change
+    cell: tuple
+
+
+class FleetIndex:
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell = cell_degrees
+        self.buses = {}                 # bus_id -> BusPosition
+        self.cells = defaultdict(set)   # (row, col) -> {bus_id}
+        self.watermark = None           # newest updated_at applied (datetime)
+        self._refreshed_at = 0.0
+        self._rebuilt_at = 0.0
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell), math.floor(lng / self.cell))
+
+    def apply(self, rows):
+        """ rows: (bus_id, lat, lng, speed, heading, updated_at). Older or repeated rows are ignored. Returns the bus ids updated. """
+        updated = []
+        for bus_id, lat, lng, speed, heading, updated_at in rows:
+            stamp = updated_at.timestamp()
+            current = self.buses.get(bus_id)
+            if current is not None and current.updated_at >= stamp:
+                continue
+            moved = current is None or (current.latitude, current.longitude) != (lat, lng)
+            cell = self._cell(lat, lng)
+            if current is not None and current.cell != cell:
+                self.cells[current.cell].discard(bus_id)
+                if not self.cells[current.cell]:
+                    del self.cells[current.cell]
+            self.cells[cell].add(bus_id)
+            self.buses[bus_id] = BusPosition(lat, lng, speed, heading, stamp, stamp if moved else current.moved_at, cell)
+            if self.watermark is None or updated_at > self.watermark:
+                self.watermark = updated_at
+            updated.append(bus_id)
+        return updated
+
+    def refresh(self, force=False):
+        """ Catch up with BusLiveLocation. Returns the bus ids updated, or None if it was fresh enough already. """
+        from .models import BusLiveLocation
+
+        now = time.monotonic()
+        if not force and now - self._refreshed_at < REFRESH_SECONDS:
+            return None
+        with self._lock:
+            if not force and now - self._refreshed_at < REFRESH_SECONDS:
+                return None
+            rows = BusLiveLocation.objects.values_list('bus_id', 'latitude', 'longitude', 'speed', 'heading', 'updated_at')
+            if self.watermark is None or now - self._rebuilt_at > REBUILD_SECONDS:
+                self.buses, self.cells, self.watermark = {}, defaultdict(set), None
+                self._rebuilt_at = now
+                updated = self.apply(rows.iterator(chunk_size=5000))
+                logger.info(f"Built fleet grid: {len(self.buses)} buses in {len(self.cells)} cells")
+            else:
+                updated = self.apply(rows.filter(updated_at__gte=self.watermark - timedelta(seconds=OVERLAP_SECONDS)))
+            self._refreshed_at = time.monotonic()
+        return updated
+
+    def cursor(self):
+        """ What a client sends back as `since`: anything that moves after it is newer than its last answer. """
+        if self.watermark is None:
+            return 0.0
+        return self.watermark.timestamp() - OVERLAP_SECONDS
+
+    def in_box(self, min_lat, min_lng, max_lat, max_lng):
+        """ Bus ids inside the box. """
+        row_lo, col_lo = self._cell(min_lat, min_lng)
+        row_hi, col_hi = self._cell(max_lat, max_lng)
+        with self._lock:
+            if (row_hi - row_lo + 1) * (col_hi - col_lo + 1) > len(self.cells):
+                # A box wider than the fleet: walk the occupied cells instead
+                keys = [k for k in self.cells if row_lo <= k[0] <= row_hi and col_lo <= k[1] <= col_hi]
+            else:
+                keys = [(r, c) for r in range(row_lo, row_hi + 1) for c in range(col_lo, col_hi + 1) if (r, c) in self.cells]
+            found = []
+            for key in keys:
+                for bus_id in self.cells[key]:
+                    position = self.buses[bus_id]
+                    if min_lat <= position.latitude <= max_lat and min_lng <= position.longitude <= max_lng:
+                        found.append(bus_id)
+            return found
+
+    def rows(self, bus_ids, since=None):
+        """ Compact rows (see FIELDS) of those buses that have a position, optionally only those moved after `since`. """
+        out = []
+        with self._lock:
+            for bus_id in bus_ids:
+                position = self.buses.get(bus_id)
+                if position is None or (since is not None and position.moved_at <= since):
+                    continue
+                out.append([bus_id, position.latitude, position.longitude, position.speed, position.heading, round(position.updated_at, 3)])
+        return out
+
+
+_fleet = FleetIndex()
+
+
+def get_fleet():
+    _fleet.refresh()
+    return _fleet
+
+
+def invalidate(*args, **kwargs):
+    # Next read reloads everything
+    _fleet._refreshed_at = 0.0
+    _fleet._rebuilt_at = 0.0
+    _fleet.watermark = None
@@ -0,0 +1,144 @@
+"""
+"Stops near me": uniform lat/lng grid over Location coordinates.
+
+Locations are bucketed into GEO_CELL_DEGREES square cells. A radius query
+only looks at the cells overlapping the circle's bounding box; a k-nearest
+query walks rings of cells outwards until the k-th best distance is inside
+the area already covered. Candidates are ranked with a vectorized NumPy
+haversine, so there is never a per-request table scan.
+
+Cells narrow towards the poles, so the grid serves |lat| up to MAX_LATITUDE
+(the view rejects anything further north or south); beyond it column widths
+are taken at MAX_LATITUDE, which bounds the cells a query can visit.
+"""
+import logging
+import math
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+
+from .lazy_index import LazyIndex
+from .network_version import get_version
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+CELL_DEGREES = getattr(settings, 'GEO_CELL_DEGREES', 0.05)   # ~5.5 km
+MAX_RADIUS_KM = getattr(settings, 'GEO_MAX_RADIUS_KM', 50)
+MAX_LATITUDE = 85.0
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """ Distance (km) from one point to arrays of points, in one vectorized pass. """
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _km_per_degree_lng(lat):
+    """ Width of a degree of longitude at `lat`, never narrower than at MAX_LATITUDE. """
+    return KM_PER_DEGREE * math.cos(math.radians(min(abs(lat), MAX_LATITUDE)))
+
+
+class GridIndex:
+    def __init__(self, rows, cell_degrees=CELL_DEGREES):
+        """ rows: iterable of (id, name, district, lat, lng). """
+        rows = list(rows)
+        self.cell = cell_degrees
+        self.ids = [r[0] for r in rows]
+        self.names = [r[1] for r in rows]
+        self.districts = [r[2] for r in rows]
+        self.lats = np.array([float(r[3]) for r in rows], dtype=np.float64)
+        self.lngs = np.array([float(r[4]) for r in rows], dtype=np.float64)
+
+        cells = defaultdict(list)
+        cell_rows = np.floor(self.lats / self.cell).astype(np.int64).tolist()
+        cell_cols = np.floor(self.lngs / self.cell).astype(np.int64).tolist()
+        for i, key in enumerate(zip(cell_rows, cell_cols)):
+            cells[key].append(i)
+        self.cells = {key: np.array(members, dtype=np.int64) for key, members in cells.items()}
+
+    @classmethod
+    def build(cls):
+        from .models import Location
+
+        rows = Location.objects.filter(latitude__isnull=False, longitude__isnull=False).values_list(
+            'id', 'name', 'district', 'latitude', 'longitude'
+        )
+        index = cls(rows)
+        logger.info(f"Built geo grid: {len(index.ids)} locations in {len(index.cells)} cells")
+        return index
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell), math.floor(lng / self.cell))
+
+    def _gather(self, keys):
+        found = [self.cells[k] for k in keys if k in self.cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def _result(self, candidates, distances, limit):
+        order = np.argsort(distances, kind='stable')[:limit]
+        return [{
+            "id": self.ids[i],
+            "name": self.names[i],
+            "district": self.districts[i],
+            "lat": float(self.lats[i]),
+            "lng": float(self.lngs[i]),
+            "distance_km": round(float(distances[j]), 3),
+        } for j, i in ((j, candidates[j]) for j in order)]
+
+    def within(self, lat, lng, radius_km, limit=50):
+        """ Locations within `radius_km`, nearest first. """
+        if not self.ids:
+            return []
+        radius_km = min(radius_km, MAX_RADIUS_KM)
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = min(radius_km / _km_per_degree_lng(abs(lat) + dlat), 180.0)
+        row_lo, col_lo = self._cell(lat - dlat, lng - dlng)
+        row_hi, col_hi = self._cell(lat + dlat, lng + dlng)
+
+        candidates = self._gather(
+            (row, col) for row in range(row_lo, row_hi + 1) for col in range(col_lo, col_hi + 1)
+        )
+        distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= radius_km
+        return self._result(candidates[inside], distances[inside], limit)
+
+    def nearest(self, lat, lng, k=10):
+        """ The k nearest locations (searching at most MAX_RADIUS_KM away). """
+        if not self.ids:
+            return []
+        row0, col0 = self._cell(lat, lng)
+        # Smallest cell side in km anywhere in the search area: every point within ring*side
+        # of the query is covered by rings 0..ring
+        side_km = self.cell * _km_per_degree_lng(abs(lat) + MAX_RADIUS_KM / KM_PER_DEGREE + self.cell)
+        max_ring = int(MAX_RADIUS_KM / side_km) + 1
+
+        candidates = np.empty(0, dtype=np.int64)
+        distances = None
+        for ring in range(max_ring + 1):
+            if ring == 0:
+                keys = [(row0, col0)]
+            else:
+                keys = [(row0 + dr, col0 + dc) for dr in range(-ring, ring + 1) for dc in (-ring, ring)]
+                keys += [(row0 + dr, col0 + dc) for dr in (-ring, ring) for dc in range(-ring + 1, ring)]
+            candidates = np.concatenate([candidates, self._gather(keys)])
+            distances = None
+            if len(candidates) >= k:
+                distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+                if np.partition(distances, k - 1)[k - 1] <= ring * side_km:
+                    break
+
+        if distances is None:
+            distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= MAX_RADIUS_KM
+        return self._result(candidates[inside], distances[inside], k)
+
+
+_index = LazyIndex(GridIndex.build, max_age=getattr(settings, 'GEO_INDEX_MAX_AGE', 300), version=get_version)
+
+get_index = _index.get
+invalidate = _index.invalidate
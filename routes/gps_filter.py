@@ -0,0 +1,144 @@
+"""
+Ingest filter for bus GPS fixes, ahead of the write-behind buffer.
+
+Operator phones report far more than the live view needs: the same spot
+over and over while the bus stands, bursts when a phone uploads its backlog,
+and the odd fix kilometres off. Each fix that gets through costs a location
+history row, live state and stop tracker updates, and a push. So every fix
+is first checked against the last one accepted for its bus:
+
+  burst       within one upload, fixes of a bus less than GPS_FILTER_BURST_SECONDS
+              apart are coalesced into the newest of them
+  duplicate   within GPS_FILTER_MIN_DISTANCE_M of the last accepted fix and less
+              than GPS_FILTER_KEEPALIVE_SECONDS after it: dropped (a standing bus
+              still reports once per keepalive, so it doesn't look lost)
+  jump        reaching it from the last accepted fix would take more than
+              GPS_FILTER_MAX_SPEED_KMH: rejected, and remembered as a suspect
+  reanchored  a fix reachable from the suspect: the bus really is over there
+              (a GPS outage, a cold start far from the last fix), so accept it
+
+Fixes older than the last accepted one (a late backlog upload) pass
+unchecked; the history wants them and the buffer won't move the bus back.
+
+The last accepted fix per bus is kept in Django's cache, so all workers
+filter alike. Counters are kept there too, so they add up across workers
+(see manage.py gps_filter_stats). GPS_FILTER_ENABLED = False turns it off.
+"""
+from collections import Counter, defaultdict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .geo_index import haversine_km
+
+ENABLED = getattr(settings, 'GPS_FILTER_ENABLED', True)
+MIN_DISTANCE_KM = getattr(settings, 'GPS_FILTER_MIN_DISTANCE_M', 15) / 1000
+KEEPALIVE_SECONDS = getattr(settings, 'GPS_FILTER_KEEPALIVE_SECONDS', 30)
+BURST_SECONDS = getattr(settings, 'GPS_FILTER_BURST_SECONDS', 2)
+MAX_SPEED_KMH = getattr(settings, 'GPS_FILTER_MAX_SPEED_KMH', 150)
+STATE_TIMEOUT = getattr(settings, 'GPS_FILTER_STATE_TIMEOUT', 60 * 60)
+
+OUTCOMES = ("received", "accepted", "burst", "duplicate", "jump", "reanchored", "late")
+
+
+class LastFix(NamedTuple):
+    latitude: float
+    longitude: float
+    recorded_at: float      # epoch seconds
+    suspect: tuple          # (lat, lng, epoch) of the last rejected jump, or None
+
+
+def _state_key(bus_id):
+    return f"routes:gps_filter:bus:{bus_id}"
+
+
+def _counter_key(outcome):
+    return f"routes:gps_filter:{outcome}"
+
+
+def _too_fast(lat, lng, stamp, to_lat, to_lng, to_stamp):
+    km = float(haversine_km(lat, lng, to_lat, to_lng))
+    # At least a second apart: two fixes with the same timestamp aren't infinitely fast
+    hours = max(to_stamp - stamp, 1) / 3600
+    return km > MIN_DISTANCE_KM and km / hours > MAX_SPEED_KMH
+
+
+def check(last, fix, stamp):
+    """ Outcome of one fix against the bus's last accepted one. Returns (outcome, new state). """
+    if last is None:
+        return "accepted", LastFix(fix.latitude, fix.longitude, stamp, None)
+    if stamp <= last.recorded_at:
+        return "late", last
+    if _too_fast(last.latitude, last.longitude, last.recorded_at, fix.latitude, fix.longitude, stamp):
+        suspect = last.suspect
+        if suspect is not None and suspect[2] < stamp and not _too_fast(*suspect, fix.latitude, fix.longitude, stamp):
+            return "reanchored", LastFix(fix.latitude, fix.longitude, stamp, None)
+        return "jump", last._replace(suspect=(fix.latitude, fix.longitude, stamp))
+    if (stamp - last.recorded_at < KEEPALIVE_SECONDS
+            and float(haversine_km(last.latitude, last.longitude, fix.latitude, fix.longitude)) < MIN_DISTANCE_KM):
+        return "duplicate", last
+    return "accepted", LastFix(fix.latitude, fix.longitude, stamp, None)
+
+
+def _coalesce(fixes):
+    """ Per bus, in time order, keeping only the newest of fixes less than BURST_SECONDS apart. """
+    by_bus = defaultdict(list)
+    for fix in sorted(fixes, key=lambda f: f.recorded_at):
+        by_bus[fix.bus_id].append(fix)
+    kept, bursts = {}, 0
+    for bus_id, own in by_bus.items():
+        kept[bus_id] = []
+        for fix, following in zip(own, own[1:] + [None]):
+            if following is not None and (following.recorded_at - fix.recorded_at).total_seconds() < BURST_SECONDS:
+                bursts += 1
+                continue
+            kept[bus_id].append(fix)
+    return kept, bursts
+
+
+def filter_fixes(fixes):
+    """ The fixes worth storing, in time order per bus. """
+    if not ENABLED or not fixes:
+        return list(fixes)
+
+    by_bus, bursts = _coalesce(fixes)
+    counts = Counter(received=len(fixes), burst=bursts)
+    stored = cache.get_many([_state_key(bus_id) for bus_id in by_bus])
+    accepted, updates = [], {}
+    for bus_id, own in by_bus.items():
+        key = _state_key(bus_id)
+        last = stored.get(key)
+        for fix in own:
+            outcome, last = check(last, fix, fix.recorded_at.timestamp())
+            counts[outcome] += 1
+            if outcome in ("accepted", "reanchored", "late"):
+                accepted.append(fix)
+        if last is not None:
+            updates[key] = last
+    counts["accepted"] += counts["reanchored"] + counts["late"]
+    cache.set_many(updates, STATE_TIMEOUT)
+    for outcome, count in counts.items():
+        if count:
+            _count(_counter_key(outcome), count)
+    return accepted
+
+
+def _count(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, delta)
+
+
+def stats():
+    found = cache.get_many([_counter_key(outcome) for outcome in OUTCOMES])
+    counts = {outcome: found.get(_counter_key(outcome), 0) for outcome in OUTCOMES}
+    received = counts["received"]
+    counts["saved_rate"] = round(1 - counts["accepted"] / received, 4) if received else 0.0
+    return counts
+
+
+def reset_stats():
+    cache.delete_many([_counter_key(outcome) for outcome in OUTCOMES])
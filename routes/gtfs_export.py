@@ -0,0 +1,227 @@
+"""
+GTFS static feed export (agency, calendar, stops, routes, trips, stop_times).
+
+The feed is written straight into a zip on disk while iterating the database
+with server-side iterators, so the dataset is never held in memory: RouteStop
+and Trip rows are both read ordered by route and merge-joined one route at a
+time. The zip is written to a temp file and renamed into place, so readers
+never see a half-written feed.
+
+A sidecar file records the network version the feed was built from; the
+feed is only regenerated when that version moves (and at most once every
+GTFS_MIN_REBUILD_SECONDS), see ensure_fresh(). Builds run from manage.py
+export_gtfs (e.g. cron), or on a background thread when the feed endpoint
+finds the feed stale; the endpoint itself always serves the last built
+file. A lock in Django's cache keeps it to one build at a time across
+workers.
+
+Trips only store start/end times, so intermediate stop times are interpolated
+along the stop sequence, same as the journey planner.
+"""
+import csv
+import io
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from .network_version import get_version
+
+logger = logging.getLogger(__name__)
+
+FEED_PATH = Path(getattr(settings, 'GTFS_FEED_PATH', settings.BASE_DIR / 'gtfs' / 'feed.zip'))
+MIN_REBUILD_SECONDS = getattr(settings, 'GTFS_MIN_REBUILD_SECONDS', 300)
+BUILD_LOCK_SECONDS = getattr(settings, 'GTFS_BUILD_LOCK_SECONDS', 30 * 60)
+BUILD_LOCK_KEY = "routes:gtfs:building"
+AGENCY_ID = 'travelsync'
+SERVICE_ID = 'DAILY'
+ROUTE_TYPE_BUS = 3
+
+
+def gtfs_time(minutes):
+    """ Minutes after service-day midnight -> 'HH:MM:SS' (GTFS allows HH >= 24). """
+    return f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+
+
+class _CsvMember:
+    """ A CSV file streamed directly into a zip member. """
+
+    def __init__(self, archive, name):
+        self._raw = archive.open(name, 'w', force_zip64=True)
+        self._text = io.TextIOWrapper(self._raw, encoding='utf-8', newline='')
+        self.writer = csv.writer(self._text)
+
+    def __enter__(self):
+        return self.writer
+
+    def __exit__(self, *exc):
+        self._text.close()
+
+
+def _by_route(rows):
+    """ Group an iterator of rows ordered by route id (first column). """
+    return itertools.groupby(rows, key=lambda row: row[0])
+
+
+def write_feed(fileobj):
+    from .models import Location, Route, RouteStop, Trip
+
+    stats = {"stops": 0, "routes": 0, "trips": 0, "stop_times": 0}
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with _CsvMember(archive, 'agency.txt') as w:
+            w.writerow(['agency_id', 'agency_name', 'agency_url', 'agency_timezone'])
+            w.writerow([AGENCY_ID, 'TravelSync', 'https://travelzync.com', settings.TIME_ZONE])
+
+        with _CsvMember(archive, 'calendar.txt') as w:
+            today = timezone.localdate()
+            w.writerow(['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'])
+            w.writerow([SERVICE_ID, 1, 1, 1, 1, 1, 1, 1, today.strftime('%Y%m%d'), (today + timedelta(days=365)).strftime('%Y%m%d')])
+
+        # Route start/end are plain names; map them to stop ids
+        stop_ids = {}
+        with _CsvMember(archive, 'stops.txt') as w:
+            w.writerow(['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+            for loc_id, name, lat, lng in Location.objects.values_list('id', 'name', 'latitude', 'longitude').iterator(chunk_size=2000):
+                stop_ids[name] = loc_id
+                w.writerow([loc_id, name, lat if lat is not None else '', lng if lng is not None else ''])
+                stats["stops"] += 1
+
+        routes = Route.objects.exclude(status='closed_permanently').order_by('id')
+        with _CsvMember(archive, 'routes.txt') as w:
+            w.writerow(['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'])
+            for route_id, bus_name, start, end, via in routes.values_list('id', 'bus__bus_name', 'start_location', 'end_location', 'via').iterator(chunk_size=2000):
+                long_name = f"{start} - {end}" + (f" via {via}" if via else '')
+                w.writerow([route_id, AGENCY_ID, bus_name, long_name, ROUTE_TYPE_BUS])
+                stats["routes"] += 1
+
+        # zipfile only allows one member open for writing, so stop_times rows
+        # are spooled to a temp file and copied in once trips.txt is closed
+        with tempfile.TemporaryFile(mode='w+', newline='', encoding='utf-8') as spool:
+            times_w = csv.writer(spool)
+            with _CsvMember(archive, 'trips.txt') as trips_w:
+                trips_w.writerow(['route_id', 'service_id', 'trip_id'])
+
+                route_rows = routes.values_list('id', 'start_location', 'end_location').iterator(chunk_size=2000)
+                stop_groups = _by_route(RouteStop.objects.filter(route__in=routes).order_by('route_id', 'stop_number').values_list('route_id', 'location_id').iterator(chunk_size=5000))
+                trip_groups = _by_route(Trip.objects.filter(route__in=routes).order_by('route_id', 'start_time').values_list('route_id', 'id', 'start_time', 'end_time').iterator(chunk_size=5000))
+                next_stops = next(stop_groups, None)
+                next_trips = next(trip_groups, None)
+
+                for route_id, start, end in route_rows:
+                    middle = []
+                    while next_stops and next_stops[0] < route_id:
+                        next_stops = next(stop_groups, None)
+                    if next_stops and next_stops[0] == route_id:
+                        middle = [loc_id for _, loc_id in next_stops[1]]
+                        next_stops = next(stop_groups, None)
+
+                    trips = []
+                    while next_trips and next_trips[0] < route_id:
+                        next_trips = next(trip_groups, None)
+                    if next_trips and next_trips[0] == route_id:
+                        trips = [row[1:] for row in next_trips[1]]
+                        next_trips = next(trip_groups, None)
+
+                    if start not in stop_ids or end not in stop_ids:
+                        continue
+                    sequence = [stop_ids[start], *middle, stop_ids[end]]
+                    last = len(sequence) - 1
+
+                    for trip_id, start_time, end_time in trips:
+                        first = start_time.hour * 60 + start_time.minute
+                        final = end_time.hour * 60 + end_time.minute
+                        if final < first:
+                            final += 1440  # runs past midnight
+                        trips_w.writerow([route_id, SERVICE_ID, trip_id])
+                        for position, stop_id in enumerate(sequence):
+                            at = gtfs_time(first + round((final - first) * position / last))
+                            times_w.writerow([trip_id, at, at, stop_id, position + 1])
+                        stats["trips"] += 1
+                        stats["stop_times"] += len(sequence)
+
+            spool.seek(0)
+            with _CsvMember(archive, 'stop_times.txt') as w:
+                w.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+                for row in csv.reader(spool):
+                    w.writerow(row)
+    return stats
+
+
+def build(path=None):
+    """ (Re)write the feed at `path` atomically and stamp it with the network version. """
+    path = path or FEED_PATH
+    version = get_version()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            stats = write_feed(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    sidecar = path.with_suffix('.version')
+    tmp_sidecar = sidecar.with_suffix(f'.version.{os.getpid()}.tmp')
+    tmp_sidecar.write_text(str(version))
+    os.replace(tmp_sidecar, sidecar)
+    logger.info(f"GTFS feed written to {path} (network version {version}): {stats}")
+    return stats
+
+
+def built_version(path=None):
+    path = path or FEED_PATH
+    try:
+        return int(path.with_suffix('.version').read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def is_stale(path=None):
+    """ Missing, or built from an older network version at least MIN_REBUILD_SECONDS ago. """
+    path = path or FEED_PATH
+    if not path.exists():
+        return True
+    return built_version(path) != get_version() and time.time() - path.stat().st_mtime >= MIN_REBUILD_SECONDS
+
+
+def ensure_fresh(path=None, force=False):
+    """
+    Rebuild only if the network changed since the last build (rate-limited).
+    Returns the build stats, or None if skipped: up to date, or another
+    process is building it right now.
+    """
+    path = path or FEED_PATH
+    if not force and not is_stale(path):
+        return None
+    if not cache.add(BUILD_LOCK_KEY, True, BUILD_LOCK_SECONDS):
+        return None
+    try:
+        return build(path)
+    finally:
+        cache.delete(BUILD_LOCK_KEY)
+
+
+def _refresh(path):
+    try:
+        ensure_fresh(path)
+    except Exception:
+        logger.exception("GTFS feed rebuild failed")
+    finally:
+        connection.close()
+
+
+def refresh_in_background(path=None):
+    """ ensure_fresh() on a daemon thread, so no request waits for an export. """
+    path = path or FEED_PATH
+    if is_stale(path) and cache.get(BUILD_LOCK_KEY) is None:
+        threading.Thread(target=_refresh, args=(path,), name='gtfs-export', daemon=True).start()
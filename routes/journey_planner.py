@@ -0,0 +1,272 @@
+"""
+Multi-leg journey planner (RAPTOR, round-based).
+
+The timetable is compiled once per worker into flat arrays:
+
+  * stops are normalized location names (a transfer is "get off and wait at
+    the same named stop");
+  * every Route becomes one or more *patterns* (stop sequence + trips). Trips
+    that would overtake each other are split into separate patterns so each
+    pattern stays FIFO, which RAPTOR relies on;
+  * pattern stop sequences and stop times are stored back-to-back in
+    `array('i')` buffers, addressed through per-pattern offsets.
+
+We only store start/end times per Trip, so the time at an intermediate stop
+is interpolated linearly along the stop sequence. All times are minutes
+after midnight; trips running past midnight simply go above 1440.
+
+Round k of the search finds the earliest arrival at every stop using k
+buses. An itinerary is Pareto-optimal (arrival vs. transfers) when it
+arrives strictly earlier than every itinerary with fewer transfers.
+"""
+import logging
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils import timezone
+
+from .lazy_index import LazyIndex
+from .network_version import get_version
+from .text import normalize
+
+logger = logging.getLogger(__name__)
+
+INFINITY = 1 << 30
+MIN_TRANSFER_MINUTES = getattr(settings, 'JOURNEY_MIN_TRANSFER_MINUTES', 5)
+MAX_TRANSFERS = getattr(settings, 'JOURNEY_MAX_TRANSFERS', 3)
+LATENCY_BUDGET_MS = getattr(settings, 'JOURNEY_LATENCY_BUDGET_MS', 50)
+
+
+def to_minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def format_minutes(m):
+    day, m = divmod(m, 1440)
+    label = f"{m // 60:02d}:{m % 60:02d}"
+    return f"{label} (+{day}d)" if day else label
+
+
+class Timetable:
+    def __init__(self):
+        self.stop_names = []          # stop index -> display name
+        self.stop_index = {}          # normalized name -> stop index
+        self.stop_patterns = []       # stop index -> [(pattern, position), ...]
+
+        self.pattern_route = []       # pattern -> route id
+        self.pattern_bus = []         # pattern -> bus name
+        self.pattern_stop_offset = array('i')
+        self.pattern_length = array('i')
+        self.pattern_time_offset = array('i')
+        self.pattern_trip_count = array('i')
+        self.pattern_trip_ids = []    # pattern -> [trip id, ...] (departure order)
+
+        self.stops = array('i')       # flat: stop indices of every pattern
+        self.times = array('i')       # flat: trip-major stop times of every pattern
+
+    def _stop(self, name):
+        key = normalize(name)
+        if key not in self.stop_index:
+            self.stop_index[key] = len(self.stop_names)
+            self.stop_names.append(name)
+            self.stop_patterns.append([])
+        return self.stop_index[key]
+
+    def _add_pattern(self, route_id, bus_name, sequence, trips):
+        pattern = len(self.pattern_route)
+        n = len(sequence)
+        self.pattern_route.append(route_id)
+        self.pattern_bus.append(bus_name)
+        self.pattern_stop_offset.append(len(self.stops))
+        self.pattern_length.append(n)
+        self.pattern_time_offset.append(len(self.times))
+        self.pattern_trip_count.append(len(trips))
+        self.pattern_trip_ids.append([trip_id for trip_id, _, _ in trips])
+
+        for position, stop in enumerate(sequence):
+            self.stops.append(stop)
+            self.stop_patterns[stop].append((pattern, position))
+
+        for _, start, end in trips:
+            for position in range(n):
+                self.times.append(start + round((end - start) * position / (n - 1)))
+
+    @classmethod
+    def build(cls):
+        from .models import Route, RouteStop, Trip
+
+        today = timezone.localdate()
+        stops_by_route = defaultdict(list)
+        for route_id, name in RouteStop.objects.order_by('route_id', 'stop_number').values_list('route_id', 'location__name'):
+            stops_by_route[route_id].append(name)
+
+        trips_by_route = defaultdict(list)
+        for trip_id, route_id, start, end in Trip.objects.values_list('id', 'route_id', 'start_time', 'end_time'):
+            start, end = to_minutes(start), to_minutes(end)
+            if end < start:
+                end += 1440  # runs past midnight
+            trips_by_route[route_id].append((trip_id, start, end))
+
+        table = cls()
+        routes = Route.objects.exclude(status='closed_permanently').values_list(
+            'id', 'bus__bus_name', 'start_location', 'end_location', 'status', 'status_updated_at'
+        )
+        for route_id, bus_name, start, end, route_status, updated_at in routes:
+            if route_status == 'closed_today' and timezone.localtime(updated_at).date() == today:
+                continue
+            trips = trips_by_route.get(route_id)
+            if not trips:
+                continue
+
+            sequence = [table._stop(name) for name in [start, *stops_by_route[route_id], end]]
+            # Split into FIFO chains: a trip may only follow one that doesn't arrive later
+            chains = []
+            for trip in sorted(trips, key=lambda t: (t[1], t[2])):
+                for chain in chains:
+                    if chain[-1][2] <= trip[2]:
+                        chain.append(trip)
+                        break
+                else:
+                    chains.append([trip])
+            for chain in chains:
+                table._add_pattern(route_id, bus_name, sequence, chain)
+
+        logger.info(f"Compiled timetable: {len(table.stop_names)} stops, {len(table.pattern_route)} patterns, {len(table.times)} stop times")
+        return table
+
+    # ------------------------------------------------------------------
+
+    def _time(self, pattern, trip, position):
+        return self.times[self.pattern_time_offset[pattern] + trip * self.pattern_length[pattern] + position]
+
+    def _earliest_trip(self, pattern, position, ready_at):
+        """ First trip of `pattern` leaving `position` at or after `ready_at` (bisect over FIFO trips). """
+        base = self.pattern_time_offset[pattern] + position
+        length = self.pattern_length[pattern]
+        count = self.pattern_trip_count[pattern]
+        departures = self.times[base:base + count * length:length]
+        trip = bisect_left(departures, ready_at)
+        return trip if trip < count else None
+
+    def plan(self, from_name, to_name, depart_at, max_transfers=2, budget_ms=LATENCY_BUDGET_MS):
+        source = self.stop_index.get(normalize(from_name))
+        target = self.stop_index.get(normalize(to_name))
+        if source is None or target is None or source == target:
+            return [], False
+
+        deadline = time.perf_counter() + budget_ms / 1000
+        n_stops = len(self.stop_names)
+        best = [INFINITY] * n_stops                 # tau*: best arrival over all rounds
+        previous = [INFINITY] * n_stops             # tau_{k-1}
+        previous[source] = best[source] = depart_at
+        labels = []                                 # labels[k-1][stop] = leg that reached it in round k
+        marked = {source}
+        truncated = False
+
+        for k in range(1, max_transfers + 2):
+            if time.perf_counter() > deadline:
+                truncated = True
+                break
+
+            # Earliest marked position for every pattern touching a marked stop
+            queue = {}
+            for stop in marked:
+                for pattern, position in self.stop_patterns[stop]:
+                    if position < queue.get(pattern, INFINITY):
+                        queue[pattern] = position
+            # Only stops improved last round can board anything new
+            boardable, marked = marked, set()
+
+            current = list(previous)
+            round_labels = {}
+            slack = 0 if k == 1 else MIN_TRANSFER_MINUTES
+
+            times, stops = self.times, self.stops
+            for pattern, start_position in queue.items():
+                offset = self.pattern_stop_offset[pattern]
+                length = self.pattern_length[pattern]
+                trip = trip_base = None
+                board_position = board_stop = None
+                for position in range(start_position, length):
+                    stop = stops[offset + position]
+
+                    if trip is not None:
+                        arrival = times[trip_base + position]
+                        if arrival < best[stop] and arrival < best[target]:
+                            current[stop] = best[stop] = arrival
+                            round_labels[stop] = (pattern, trip, board_stop, board_position, position)
+                            marked.add(stop)
+
+                    if stop in boardable:
+                        ready_at = previous[stop] + (slack if stop != source else 0)
+                        if trip is None or ready_at <= times[trip_base + position]:
+                            earlier = self._earliest_trip(pattern, position, ready_at)
+                            if earlier is not None and (trip is None or earlier < trip):
+                                trip, board_stop, board_position = earlier, stop, position
+                                trip_base = self.pattern_time_offset[pattern] + trip * length
+
+            labels.append(round_labels)
+            previous = current
+            if not marked:
+                break
+
+        return self._itineraries(labels, target), truncated
+
+    def _itineraries(self, labels, target):
+        itineraries = []
+        best_arrival = INFINITY
+        for k in range(1, len(labels) + 1):
+            if target not in labels[k - 1]:
+                continue
+
+            # Walk the labels back to the source. The boarding stop of a round-k leg
+            # was reached in the latest earlier round that labelled it.
+            raw_legs = []
+            stop, round_no = target, k
+            while round_no > 0:
+                pattern, trip, board_stop, board_position, alight_position = labels[round_no - 1][stop]
+                raw_legs.append((pattern, trip, board_stop, stop, board_position, alight_position))
+                stop = board_stop
+                round_no -= 1
+                while round_no > 0 and stop not in labels[round_no - 1]:
+                    round_no -= 1
+            raw_legs.reverse()
+
+            last_pattern, last_trip, *_, last_position = raw_legs[-1]
+            arrival = self._time(last_pattern, last_trip, last_position)
+            # Keep only Pareto-optimal journeys: strictly earlier than any with fewer transfers
+            if arrival >= best_arrival:
+                continue
+            best_arrival = arrival
+
+            legs = [{
+                "route_id": self.pattern_route[pattern],
+                "trip_id": self.pattern_trip_ids[pattern][trip],
+                "bus_name": self.pattern_bus[pattern],
+                "from": self.stop_names[board_stop],
+                "to": self.stop_names[alight_stop],
+                "departure": format_minutes(self._time(pattern, trip, board_position)),
+                "arrival": format_minutes(self._time(pattern, trip, alight_position)),
+            } for pattern, trip, board_stop, alight_stop, board_position, alight_position in raw_legs]
+
+            itineraries.append({
+                "transfers": len(legs) - 1,
+                "departure": legs[0]["departure"],
+                "arrival": format_minutes(arrival),
+                "legs": legs,
+            })
+        return itineraries
+
+
+_timetable = LazyIndex(Timetable.build, max_age=getattr(settings, 'JOURNEY_TIMETABLE_MAX_AGE', 300), version=get_version)
+
+get_timetable = _timetable.get
+invalidate = _timetable.invalidate
+
+
+def plan_journey(from_name, to_name, depart_at, max_transfers=2):
+    max_transfers = max(0, min(max_transfers, MAX_TRANSFERS))
+    return get_timetable().plan(from_name, to_name, depart_at, max_transfers)
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LazyIndex:
+    """
+    Holds one per-process, read-mostly structure built from the database.
+
+    The structure is built on first use and dropped by invalidate() (wired to
+    model signals in routes/signals.py). Writes made by *other* gunicorn
+    workers are picked up through `version` (e.g. the shared network version)
+    when given, and in any case after `max_age` seconds.
+    """
+
+    def __init__(self, builder, max_age=60, version=None):
+        self.builder = builder
+        self.max_age = max_age
+        self.version = version
+        self._value = None
+        self._built_at = 0.0
+        self._built_version = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, version):
+        return (
+            self._value is not None
+            and version == self._built_version
+            and time.monotonic() - self._built_at <= self.max_age
+        )
+
+    def get(self):
+        version = self.version() if self.version else None
+        value = self._value
+        if self._fresh(version):
+            return value
+        with self._lock:
+            if self._fresh(version):
+                return self._value
+            generation = self._generation
+            value = self.builder()
+            # Only keep it if nothing was invalidated while we were building
+            if generation == self._generation:
+                self._value, self._built_at, self._built_version = value, time.monotonic(), version
+        return value
+
+    def invalidate(self, *args, **kwargs):
+        self._generation += 1
+        self._value = None
+
+
+class VersionedCache:
+    """
+    Bounded (LRU) per-process cache of many small entries, e.g. one per route,
+    built on demand by the caller's loader. Everything is dropped when
+    `version()` moves or on invalidate().
+    """
+
+    def __init__(self, max_entries, version):
+        self.max_entries = max_entries
+        self.version = version
+        self._entries = OrderedDict()
+        self._built_version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        version = self.version()
+        with self._lock:
+            if version != self._built_version:
+                self._entries.clear()
+                self._built_version = version
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value = loader()
+        with self._lock:
+            # Not if an invalidate() or version change happened while loading
+            if version == self._built_version:
+                self._entries[key] = value
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._entries.clear()
+            self._built_version = None
@@ -0,0 +1,251 @@
+"""
+Write-behind buffer for bus GPS fixes.
+
+Fixes first pass the ingest filter (routes/gps_filter.py), which drops
+duplicates, bursts and GPS jumps before anything is stored.
+
+Buses report every few seconds, but only the latest position per bus is
+read back live, so fixes are collected in memory (newest per bus wins) and
+written every LIVE_INGEST_FLUSH_MS as one bulk upsert into BusLiveLocation,
+instead of an update_or_create per ping. Every valid fix is also queued for
+the location history (routes/location_history.py) and bulk inserted in the
+same flush. Accepted fixes are written through to the live state store at
+once (routes/live_state.py); after each flush the ETAs of the buses' routes
+are precomputed there and pushed to riders watching them
+(routes/live_push.py). Every fix also goes through the stop arrival and
+departure detector (routes/stop_events.py).
+
+Settings:
+  LIVE_INGEST_FLUSH_MS      flush interval of the background writer (default 1000)
+  LIVE_INGEST_DURABILITY    'buffered': acknowledge once buffered, a crash loses at
+                            most one interval of positions (the next ping replaces
+                            them anyway); 'sync': flush before acknowledging
+  LIVE_INGEST_MAX_PENDING   buses (or 10x as many history fixes) waiting for the
+                            next flush before backpressure
+  LIVE_INGEST_BACKPRESSURE  'flush': the request that hits the limit flushes inline;
+                            'reject': raise BufferFull (the API answers 503)
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import gps_filter, live_push, live_state, location_history, stop_events
+
+logger = logging.getLogger(__name__)
+
+FLUSH_MS = getattr(settings, 'LIVE_INGEST_FLUSH_MS', 1000)
+DURABILITY = getattr(settings, 'LIVE_INGEST_DURABILITY', 'buffered')
+MAX_PENDING = getattr(settings, 'LIVE_INGEST_MAX_PENDING', 10000)
+BACKPRESSURE = getattr(settings, 'LIVE_INGEST_BACKPRESSURE', 'flush')
+
+
+class Fix(NamedTuple):
+    bus_id: int
+    latitude: float
+    longitude: float
+    speed: float
+    heading: float
+    recorded_at: object     # aware datetime
+
+
+class BufferFull(Exception):
+    pass
+
+
+def bulk_upsert(fixes):
+    """ One INSERT ... ON CONFLICT (bus) DO UPDATE for the whole batch. """
+    from .models import BusLiveLocation
+
+    # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target
+    target = ['bus'] if connection.features.supports_update_conflicts_with_target else None
+    BusLiveLocation.objects.bulk_create(
+        [BusLiveLocation(bus_id=f.bus_id, latitude=f.latitude, longitude=f.longitude, speed=f.speed, heading=f.heading) for f in fixes],
+        update_conflicts=True,
+        unique_fields=target,
+        update_fields=['latitude', 'longitude', 'speed', 'heading', 'updated_at'],
+        batch_size=1000,
+    )
+
+
+class WriteBehindBuffer:
+    def __init__(self, writer=bulk_upsert, history_writer=location_history.append, publisher=None, flush_ms=FLUSH_MS,
+                 durability=DURABILITY, max_pending=MAX_PENDING, backpressure=BACKPRESSURE, background=True):
+        self.writer = writer
+        self.history_writer = history_writer
+        self.publisher = publisher
+        self.flush_ms = flush_ms
+        self.durability = durability
+        self.max_pending = max_pending
+        self.backpressure = backpressure
+        self.background = background
+
+        self._pending = {}          # bus_id -> newest Fix not yet written
+        self._history = []          # every accepted Fix not yet written to the history
+        self._written_at = {}       # bus_id -> recorded_at of the last fix written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.stats = {"accepted": 0, "superseded": 0, "stale": 0, "flushes": 0, "written": 0, "rejected_batches": 0}
+
+    def offer(self, fixes):
+        """ Buffer fixes (any order, any buses). Returns how many are still the newest for their bus. """
+        if self.backpressure == 'reject' and self._full():
+            self.stats["rejected_batches"] += 1
+            raise BufferFull()
+
+        kept = 0
+        with self._lock:
+            self._history.extend(fixes)
+            for fix in fixes:
+                current = self._pending.get(fix.bus_id)
+                if current is not None and current.recorded_at >= fix.recorded_at:
+                    self.stats["superseded"] += 1
+                    continue
+                written = self._written_at.get(fix.bus_id)
+                if written is not None and written >= fix.recorded_at:
+                    # A late upload of an old fix must not move the bus backwards
+                    self.stats["stale"] += 1
+                    continue
+                if current is not None:
+                    self.stats["superseded"] += 1
+                self._pending[fix.bus_id] = fix
+                kept += 1
+            self.stats["accepted"] += kept
+            over_limit = self._full()
+
+        if self.durability == 'sync' or over_limit:
+            self.flush()
+        elif self.background:
+            self._ensure_flusher()
+        return kept
+
+    def flush(self):
+        """ Write everything buffered so far. Returns the number of buses written. """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                history, self._history = self._history, []
+            if not batch and not history:
+                return 0
+            try:
+                if history:
+                    self.history_writer(history)
+                    history = []
+                if batch:
+                    self.writer(list(batch.values()))
+            except Exception:
+                # Put back what wasn't written (newer fixes that arrived meanwhile win) for the next flush
+                with self._lock:
+                    self._history[:0] = history
+                    for bus_id, fix in batch.items():
+                        current = self._pending.get(bus_id)
+                        if current is None or current.recorded_at < fix.recorded_at:
+                            self._pending[bus_id] = fix
+                raise
+            with self._lock:
+                for bus_id, fix in batch.items():
+                    self._written_at[bus_id] = fix.recorded_at
+                self.stats["flushes"] += 1
+                self.stats["written"] += len(batch)
+            if batch and self.publisher is not None:
+                try:
+                    self.publisher(list(batch.values()))
+                except Exception:
+                    # The positions are stored; riders get the next push
+                    logger.exception("Live push failed")
+            return len(batch)
+
+    def pending(self):
+        return len(self._pending)
+
+    def _full(self):
+        return len(self._pending) >= self.max_pending or len(self._history) >= self.max_pending * 10
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='live-ingest-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_ms / 1000)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Live location flush failed; will retry")
+
+
+def publish(fixes):
+    """ After a flush: precompute the live ETAs of the buses' routes and push them to riders. """
+    live_push.publish(live_state.precompute(fixes))
+
+
+buffer = WriteBehindBuffer(publisher=publish)
+atexit.register(buffer.flush)
+
+
+def make_fix(bus_id, data, default_speed=None):
+    """
+    Validate one reported fix: {"latitude"/"lat", "longitude"/"lng", "speed", "heading", "timestamp"}.
+    timestamp is epoch seconds or ISO-8601 and defaults to now. Raises ValueError.
+    """
+    try:
+        lat = float(data.get('latitude', data.get('lat')))
+        lng = float(data.get('longitude', data.get('lng')))
+    except TypeError:
+        raise ValueError("latitude and longitude are required")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Coordinates out of range")
+
+    speed = data.get('speed', default_speed)
+    heading = data.get('heading')
+    speed = float(speed) if speed not in (None, '') else None
+    heading = float(heading) if heading not in (None, '') else None
+
+    now = timezone.now()
+    stamp = data.get('timestamp')
+    if stamp in (None, ''):
+        recorded_at = now
+    elif isinstance(stamp, (int, float)) or str(stamp).replace('.', '', 1).isdigit():
+        try:
+            recorded_at = datetime.fromtimestamp(float(stamp), tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            # Past what the platform's time_t can hold
+            raise ValueError("Invalid timestamp")
+    else:
+        recorded_at = parse_datetime(str(stamp))
+        if recorded_at is None:
+            raise ValueError(f"Invalid timestamp '{stamp}'")
+        if timezone.is_naive(recorded_at):
+            recorded_at = timezone.make_aware(recorded_at, dt_timezone.utc)
+    if recorded_at > now + timedelta(minutes=5):
+        raise ValueError("Timestamp is in the future")
+
+    return Fix(bus_id, lat, lng, speed, heading, recorded_at)
+
+
+def ingest(fixes):
+    fixes = gps_filter.filter_fixes(fixes)
+    if not fixes:
+        return 0
+    kept = buffer.offer(fixes)
+    live_state.write_through(fixes)
+    try:
+        stop_events.observe(fixes)
+    except Exception:
+        # The fixes are buffered; a missed stop event must not fail the upload
+        logger.exception("Stop event detection failed")
+    return kept
@@ -0,0 +1,359 @@
+"""
+Push of live bus positions and ETAs to riders, over Server-Sent Events.
+
+A rider watching a route keeps GET /api/routes/bus/live/<route_id>/stream/
+open (stream_app, dispatched by core/asgi.py; only under the ASGI server,
+WSGI answers 501): an idle subscriber costs a
+task and a bounded asyncio queue on the worker's event loop, not a thread.
+Subscribers of a route form the channel group "route.<id>".
+
+When the ingest buffer flushes (routes/live_ingest.py), the ETA payloads of
+the buses' routes are computed once into the live state store
+(routes/live_state.py) and handed to publish(), which encodes each watched
+route's payload as an SSE frame once; the layer then hands the same bytes to
+every subscriber queue, with one event-loop wakeup per worker loop rather
+than per subscriber. Frames are
+full snapshots, so a slow reader simply drops its oldest queued frame.
+
+Layers (LIVE_PUSH_LAYER):
+  routes.live_push.InMemoryChannelLayer  this process only: the ingest and the
+                                         subscribers must share a worker (default;
+                                         refused by routes.checks if WEB_CONCURRENCY > 1)
+  routes.live_push.CacheChannelLayer     across workers, through Django's cache: the
+                                         newest frame per route is stored, and every
+                                         worker polls one key per route it has
+                                         subscribers for (LIVE_PUSH_POLL_MS)
+"""
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from . import live_state
+
+logger = logging.getLogger(__name__)
+
+LAYER = getattr(settings, 'LIVE_PUSH_LAYER', 'routes.live_push.InMemoryChannelLayer')
+QUEUE_SIZE = getattr(settings, 'LIVE_PUSH_QUEUE_SIZE', 8)
+HEARTBEAT_SECONDS = getattr(settings, 'LIVE_PUSH_HEARTBEAT_SECONDS', 15)
+POLL_MS = getattr(settings, 'LIVE_PUSH_POLL_MS', 500)
+SNAPSHOT_MAX_AGE = getattr(settings, 'LIVE_PUSH_SNAPSHOT_MAX_AGE', 5)
+HEARTBEAT = b": ping\n\n"
+
+
+def group_name(route_id):
+    return f"route.{route_id}"
+
+
+def frame(payload, event='position'):
+    """ One SSE frame (bytes) for a JSON payload. """
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode('utf-8')
+
+
+class Subscription:
+    """ One subscriber: a bounded queue that lives on the event loop it was created on. """
+
+    def __init__(self, group, size=QUEUE_SIZE):
+        self.group = group
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(size)
+        self.dropped = 0
+
+    def put(self, message):
+        # Event loop thread only
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def receive(self):
+        return await self.queue.get()
+
+
+def _deliver(subscriptions, message):
+    for subscription in subscriptions:
+        subscription.put(message)
+
+
+class InMemoryChannelLayer:
+    """ Groups of subscriptions in this process. group_send() may be called from any thread. """
+
+    def __init__(self):
+        self._groups = defaultdict(lambda: defaultdict(set))   # group -> loop -> {Subscription}
+        self._lock = threading.Lock()
+
+    def subscribe(self, group):
+        """ Join `group`; must be called on the event loop that will read the subscription. """
+        subscription = Subscription(group)
+        with self._lock:
+            self._groups[group][subscription.loop].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            loops = self._groups.get(subscription.group)
+            if loops is None:
+                return
+            loops[subscription.loop].discard(subscription)
+            if not loops[subscription.loop]:
+                del loops[subscription.loop]
+            if not loops:
+                del self._groups[subscription.group]
+
+    def local(self, loop):
+        """ Every subscription read on `loop`. """
+        with self._lock:
+            return [sub for loops in self._groups.values() for sub in loops.get(loop, ())]
+
+    def subscribers(self, group):
+        with self._lock:
+            return sum(len(s) for s in self._groups.get(group, {}).values())
+
+    def active(self, groups):
+        """ The subset of `groups` that currently has subscribers. """
+        with self._lock:
+            return {group for group in groups if group in self._groups}
+
+    def group_send(self, group, message):
+        """ Hand `message` to every subscriber of `group`. Returns the number of subscribers. """
+        with self._lock:
+            targets = [(loop, tuple(subs)) for loop, subs in self._groups.get(group, {}).items()]
+        for loop, subscriptions in targets:
+            try:
+                loop.call_soon_threadsafe(_deliver, subscriptions, message)
+            except RuntimeError:
+                # That loop is closed; its subscriptions go away with it
+                pass
+        return sum(len(subs) for _, subs in targets)
+
+
+class CacheChannelLayer(InMemoryChannelLayer):
+    """
+    Fan-out between workers through Django's cache (needs a shared backend,
+    e.g. Redis or Memcached). Only the newest frame per group is kept, which
+    is all a live view needs.
+    """
+
+    timeout = 60
+
+    def __init__(self, poll_ms=POLL_MS):
+        super().__init__()
+        self.poll_ms = poll_ms
+        self._pollers = {}      # (group, loop) -> asyncio.Task
+
+    @staticmethod
+    def _key(group):
+        return f"routes:live_push:{group}"
+
+    @staticmethod
+    def _watch_key(group):
+        return f"routes:live_push:watch:{group}"
+
+    def subscribe(self, group):
+        subscription = super().subscribe(group)
+        key = (group, subscription.loop)
+        if key not in self._pollers:
+            self._pollers[key] = subscription.loop.create_task(self._poll(group))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        super().unsubscribe(subscription)
+        with self._lock:
+            idle = subscription.loop not in self._groups.get(subscription.group, {})
+        if idle:
+            poller = self._pollers.pop((subscription.group, subscription.loop), None)
+            if poller is not None:
+                poller.cancel()
+
+    def active(self, groups):
+        # Subscribers on any worker: their pollers keep a watch key alive
+        watch_keys = {self._watch_key(group): group for group in groups}
+        return {watch_keys[key] for key in cache.get_many(list(watch_keys))}
+
+    def group_send(self, group, message):
+        cache.set(self._key(group), (time.time_ns(), message), self.timeout)
+        return 0
+
+    async def _poll(self, group):
+        watch_key = self._watch_key(group)
+        watch_timeout = max(self.poll_ms * 10 // 1000, 5)
+        entry = await cache.aget(self._key(group))
+        seen = entry[0] if entry else None
+        while True:
+            await cache.aset(watch_key, True, watch_timeout)
+            await asyncio.sleep(self.poll_ms / 1000)
+            entry = await cache.aget(self._key(group))
+            if entry and entry[0] != seen:
+                seen = entry[0]
+                super().group_send(group, entry[1])
+
+
+layer = import_string(LAYER)()
+
+
+# ----------------------------------------------------------------------
+# Publishing
+
+_latest = {}       # route_id -> (monotonic time, newest frame built in this process)
+
+
+def invalidate(*args, **kwargs):
+    _latest.clear()
+
+
+def publish(payloads):
+    """
+    Push {route_id: live payload} (live_state.precompute, once per flush) to
+    the subscribers of each route; routes nobody watches are skipped. Each
+    payload is encoded once however many subscribers it has. Returns the
+    number of routes pushed.
+    """
+    groups = {group_name(route_id): route_id for route_id in payloads}
+    active = layer.active(groups) if groups else set()
+    for group in active:
+        route_id = groups[group]
+        current = frame(payloads[route_id])
+        _latest[route_id] = (time.monotonic(), current)
+        layer.group_send(group, current)
+    return len(active)
+
+
+def recent_frame(route_id):
+    """ The route's frame if one was built in the last LIVE_PUSH_SNAPSHOT_MAX_AGE seconds, else None. """
+    entry = _latest.get(route_id)
+    if entry is not None and time.monotonic() - entry[0] <= SNAPSHOT_MAX_AGE:
+        return entry[1]
+    return None
+
+
+def snapshot(route_id):
+    """
+    The current frame of a route from the live state store: b'' if its bus
+    hasn't reported yet, None if there is no such route.
+    """
+    # A crowd joining at once (say, a popular route at rush hour) shares one lookup
+    current = recent_frame(route_id)
+    if current is not None:
+        return current
+    try:
+        if route_id not in live_state.get_route_buses().bus_of:
+            return None
+        payload = live_state.route_live_data(route_id)
+        current = frame(payload) if payload else b''
+        _latest[route_id] = (time.monotonic(), current)
+        return current
+    finally:
+        # A stream stays open for as long as the rider watches: don't hold a database connection for it
+        for conn in connections.all(initialized_only=True):
+            if not conn.in_atomic_block:
+                conn.close()
+
+
+# ----------------------------------------------------------------------
+# Serving
+
+STREAM_PATH = re.compile(r'^/api/routes/bus/live/(?P<route_id>\d+)/stream/$')
+
+
+def _cors_headers(scope):
+    origin = dict(scope['headers']).get(b'origin', b'').decode('latin-1')
+    if origin not in getattr(settings, 'CORS_ALLOWED_ORIGINS', ()):
+        return []
+    headers = [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'origin')]
+    if getattr(settings, 'CORS_ALLOW_CREDENTIALS', False):
+        headers.append((b'access-control-allow-credentials', b'true'))
+    return headers
+
+
+_heartbeats = weakref.WeakKeyDictionary()     # event loop -> its heartbeat task
+
+
+async def _heartbeat():
+    """ One timer per event loop, not one per subscriber: an SSE comment to every idle stream. """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        subscriptions = layer.local(loop)
+        if not subscriptions:
+            del _heartbeats[loop]
+            return
+        for subscription in subscriptions:
+            if subscription.queue.empty():
+                subscription.put(HEARTBEAT)
+
+
+def _ensure_heartbeat():
+    loop = asyncio.get_running_loop()
+    if loop not in _heartbeats:
+        _heartbeats[loop] = loop.create_task(_heartbeat())
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json'), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream_app(scope, receive, send):
+    """
+    ASGI app for GET /api/routes/bus/live/<route_id>/stream/ (dispatched by
+    core/asgi.py ahead of Django): the route's live state now, then a frame
+    on every push, and a heartbeat comment every LIVE_PUSH_HEARTBEAT_SECONDS.
+
+    It bypasses Django's request handling on purpose: Django gives every
+    in-flight ASGI request its own thread for sync code, which a stream would
+    hold for hours. Here a subscriber is one task and one queue.
+    """
+    cors = _cors_headers(scope)
+    if scope['method'] != 'GET':
+        return await _send_json(send, 405, {"error": "Method not allowed"}, cors)
+    route_id = int(STREAM_PATH.match(scope['path'])['route_id'])
+
+    subscription = layer.subscribe(group_name(route_id))
+    try:
+        # Subscribed first, so no update between the snapshot and the first push is lost
+        current = recent_frame(route_id)
+        if current is None:
+            current = await sync_to_async(snapshot)(route_id)
+        if current is None:
+            return await _send_json(send, 404, {"error": "Route not found"}, cors)
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),     # nginx: don't buffer the stream
+            *cors,
+        ]})
+        _ensure_heartbeat()
+
+        async def pump():
+            if current:
+                await send({'type': 'http.response.body', 'body': current, 'more_body': True})
+            while True:
+                await send({'type': 'http.response.body', 'body': await subscription.receive(), 'more_body': True})
+
+        async def until_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(until_disconnect())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(f"Live stream of route {route_id} ended: {task.exception()!r}")
+    finally:
+        layer.unsubscribe(subscription)
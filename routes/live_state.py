@@ -0,0 +1,166 @@
+"""
+Hot live state of every bus, kept in Django's cache.
+
+Per bus: the newest position, speed, heading and report time, written
+through on ingest (routes/live_ingest.ingest), so a read sees a ping before
+the write-behind buffer has flushed it to BusLiveLocation. Per route: the
+ETA payload of /bus/live/<route_id>/, precomputed on every flush for all
+routes of the buses written, and stamped with the report time it was
+computed from.
+
+A live read is then one cache round trip (bus state and route payload
+together) plus an in-process route -> bus lookup; the ETAs are recomputed
+in memory only if a newer ping arrived since the last flush. The database
+is read only on a cold start: a bus with no state in the cache (a restart,
+eviction, or a bus silent for longer than LIVE_STATE_TIMEOUT) is loaded
+from BusLiveLocation, and a bus that never reported is remembered as such.
+Both are kept for LIVE_STATE_COLD_TIMEOUT only: a worker that doesn't share
+the ingesting worker's cache sees new positions that much later, never a
+position frozen for the full timeout.
+
+The cache must be shared by all workers (CACHE_BACKEND); with a per-process
+cache and more than one worker, routes.checks refuses to start.
+"""
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import eta
+from .lazy_index import LazyIndex
+from .network_version import get_version
+
+TIMEOUT = getattr(settings, 'LIVE_STATE_TIMEOUT', 60 * 60)
+COLD_TIMEOUT = getattr(settings, 'LIVE_STATE_COLD_TIMEOUT', 15)
+
+
+class BusState(NamedTuple):
+    latitude: float
+    longitude: float
+    speed: float
+    heading: float
+    recorded_at: float      # epoch seconds
+
+
+# Cached for a bus with no BusLiveLocation; older than any fix, so the first one replaces it
+NO_STATE = BusState(None, None, None, None, float('-inf'))
+
+
+def _bus_key(bus_id):
+    return f"routes:live:bus:{bus_id}"
+
+
+def _route_key(route_id):
+    return f"routes:live:route:{route_id}"
+
+
+# ----------------------------------------------------------------------
+# Which bus drives which route (in process, rebuilt on network changes)
+
+class RouteBuses:
+    def __init__(self, rows):
+        """ rows: (route_id, bus_id). """
+        self.bus_of = {}
+        routes = defaultdict(list)
+        for route_id, bus_id in rows:
+            self.bus_of[route_id] = bus_id
+            routes[bus_id].append(route_id)
+        self.routes_of = dict(routes)
+
+    @classmethod
+    def build(cls):
+        from .models import Route
+
+        return cls(Route.objects.values_list('id', 'bus_id').iterator(chunk_size=5000))
+
+
+_route_buses = LazyIndex(RouteBuses.build, max_age=getattr(settings, 'LIVE_STATE_ROUTES_MAX_AGE', 300), version=get_version)
+get_route_buses = _route_buses.get
+invalidate = _route_buses.invalidate
+
+
+# ----------------------------------------------------------------------
+# Writing
+
+def _newest_per_bus(fixes):
+    newest = {}
+    for fix in fixes:
+        current = newest.get(fix.bus_id)
+        if current is None or current.recorded_at < fix.recorded_at:
+            newest[fix.bus_id] = fix
+    return newest
+
+
+def write_through(fixes):
+    """ Store the newest of `fixes` per bus, unless the cache already has a newer one. Returns buses updated. """
+    newest = _newest_per_bus(fixes)
+    if not newest:
+        return 0
+    stored = cache.get_many([_bus_key(bus_id) for bus_id in newest])
+    updates = {}
+    for bus_id, fix in newest.items():
+        key = _bus_key(bus_id)
+        stamp = fix.recorded_at.timestamp()
+        current = stored.get(key)
+        if current is None or current.recorded_at < stamp:
+            updates[key] = BusState(fix.latitude, fix.longitude, fix.speed, fix.heading, stamp)
+    cache.set_many(updates, TIMEOUT)
+    return len(updates)
+
+
+def precompute(fixes):
+    """
+    ETA payloads of every route of the buses in `fixes` (newest fix per bus),
+    stored for readers. Returns {route_id: payload}.
+    """
+    routes_of = get_route_buses().routes_of
+    payloads, entries = {}, {}
+    for bus_id, fix in _newest_per_bus(fixes).items():
+        for route_id in routes_of.get(bus_id, ()):
+            payload = eta.route_etas(route_id, fix.latitude, fix.longitude, fix.speed)
+            payloads[route_id] = payload
+            entries[_route_key(route_id)] = (fix.recorded_at.timestamp(), payload)
+    cache.set_many(entries, TIMEOUT)
+    return payloads
+
+
+def forget(bus_id):
+    """ Drop a bus's cached state, e.g. after BusLiveLocation was written directly; the next read reloads it. """
+    cache.delete(_bus_key(bus_id))
+
+
+# ----------------------------------------------------------------------
+# Reading
+
+def _load_bus(bus_id):
+    """ Cold start: the bus's state from BusLiveLocation (NO_STATE if it never reported), cached briefly. """
+    from .models import BusLiveLocation
+
+    row = BusLiveLocation.objects.filter(bus_id=bus_id).values_list('latitude', 'longitude', 'speed', 'heading', 'updated_at').first()
+    state = NO_STATE if row is None else BusState(*row[:4], row[4].timestamp())
+    # add(): a ping written through meanwhile wins
+    cache.add(_bus_key(bus_id), state, COLD_TIMEOUT)
+    return state
+
+
+def route_live_data(route_id):
+    """ The live payload of a route (see eta.route_etas), or None if the route or its bus position is unknown. """
+    bus_id = get_route_buses().bus_of.get(route_id)
+    if bus_id is None:
+        return None
+
+    bus_key, route_key = _bus_key(bus_id), _route_key(route_id)
+    found = cache.get_many([bus_key, route_key])
+    state = found.get(bus_key) or _load_bus(bus_id)
+    if state == NO_STATE:
+        return None
+
+    precomputed = found.get(route_key)
+    if precomputed is not None and precomputed[0] == state.recorded_at:
+        return precomputed[1]
+
+    # A ping newer than the last flush (or a cold start): recompute in memory
+    payload = eta.route_etas(route_id, state.latitude, state.longitude, state.speed)
+    cache.set(route_key, (state.recorded_at, payload), TIMEOUT)
+    return payload
@@ -0,0 +1,179 @@
+"""
+Append-only bus location history.
+
+Hot data is a narrow BusLocationFix table (bus, time, lat, lng, speed,
+heading) filled by the live ingest buffer with one bulk INSERT per flush, so
+it keeps up with thousands of fixes per second; the (bus, recorded_at)
+unique index serves range reads and turns retried uploads into no-ops.
+
+Once a bus-day is older than LOCATION_HISTORY_RAW_DAYS, compact() downsamples
+it to one fix per LOCATION_HISTORY_DOWNSAMPLE_SECONDS and packs it into a
+single BusLocationBlock: time / lat / lng columns delta-encoded as
+little-endian int32 (seconds, microdegrees), speed as int32 tenths of km/h,
+then zlib-compressed. A day of 5 s fixes shrinks from ~17k rows to a few KB.
+Blocks older than LOCATION_HISTORY_RETENTION_DAYS are deleted.
+
+read() answers "where was bus X between t1 and t2" from both tiers.
+"""
+import logging
+import zlib
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+RAW_DAYS = getattr(settings, 'LOCATION_HISTORY_RAW_DAYS', 7)
+RETENTION_DAYS = getattr(settings, 'LOCATION_HISTORY_RETENTION_DAYS', 90)
+DOWNSAMPLE_SECONDS = getattr(settings, 'LOCATION_HISTORY_DOWNSAMPLE_SECONDS', 30)
+INSERT_BATCH = 2000
+
+BLOCK_DTYPE = np.dtype('<i4')
+NO_SPEED = -1
+
+
+def append(fixes):
+    """ Bulk insert live_ingest.Fix tuples. Duplicates (same bus and time) are ignored. """
+    from .models import BusLocationFix
+
+    BusLocationFix.objects.bulk_create(
+        [BusLocationFix(bus_id=f.bus_id, recorded_at=f.recorded_at, latitude=f.latitude, longitude=f.longitude, speed=f.speed, heading=f.heading) for f in fixes],
+        batch_size=INSERT_BATCH,
+        ignore_conflicts=True,
+    )
+
+
+# ----------------------------------------------------------------------
+# Block encoding
+
+def _day_start(day):
+    return datetime.combine(day, dt_time.min, tzinfo=dt_timezone.utc)
+
+
+def encode_block(seconds, lats, lngs, speeds):
+    """ Columns (seconds after UTC midnight, degrees, degrees, km/h or NaN) -> compressed bytes. """
+    count = len(seconds)
+    columns = [
+        np.asarray(seconds, dtype=np.int64),
+        np.rint(np.asarray(lats, dtype=np.float64) * 1e6).astype(np.int64),
+        np.rint(np.asarray(lngs, dtype=np.float64) * 1e6).astype(np.int64),
+    ]
+    encoded = [np.diff(col, prepend=0).astype(BLOCK_DTYPE) for col in columns]
+    speeds = np.asarray(speeds, dtype=np.float64)
+    encoded.append(np.where(np.isnan(speeds), NO_SPEED, np.rint(speeds * 10)).astype(BLOCK_DTYPE))
+    header = np.array([count], dtype=BLOCK_DTYPE)
+    return zlib.compress(b''.join(a.tobytes() for a in [header, *encoded]))
+
+
+def decode_block(data):
+    """ Inverse of encode_block: (seconds, lats, lngs, speeds) as NumPy arrays (speed NaN if unknown). """
+    raw = np.frombuffer(zlib.decompress(bytes(data)), dtype=BLOCK_DTYPE)
+    count = int(raw[0])
+    cols = raw[1:].reshape(4, count).astype(np.int64)
+    seconds = np.cumsum(cols[0])
+    lats = np.cumsum(cols[1]) / 1e6
+    lngs = np.cumsum(cols[2]) / 1e6
+    speeds = np.where(cols[3] == NO_SPEED, np.nan, cols[3] / 10)
+    return seconds, lats, lngs, speeds
+
+
+def downsample(seconds, every):
+    """ Indexes of the first fix in every `every`-second bucket (seconds must be sorted). """
+    buckets = np.asarray(seconds) // every
+    return np.flatnonzero(np.diff(buckets, prepend=-1) != 0)
+
+
+# ----------------------------------------------------------------------
+# Maintenance
+
+def compact(before=None, every=DOWNSAMPLE_SECONDS):
+    """ Pack raw fixes of every bus-day before `before` (a date) into blocks. Returns (bus-days, fixes). """
+    from .models import BusLocationFix, BusLocationBlock
+
+    before = before or timezone.now().date() - timedelta(days=RAW_DAYS)
+    cutoff = _day_start(before)
+    days = 0
+    fixes = 0
+
+    pending = (
+        BusLocationFix.objects.filter(recorded_at__lt=cutoff)
+        .annotate(day=TruncDate('recorded_at', tzinfo=dt_timezone.utc))
+        .values_list('bus_id', 'day')
+        .distinct().order_by('bus_id', 'day')
+    )
+    for bus_id, day in list(pending):
+        start = _day_start(day)
+        with transaction.atomic():
+            rows = BusLocationFix.objects.filter(bus_id=bus_id, recorded_at__gte=start, recorded_at__lt=start + timedelta(days=1))
+            stamps, lats, lngs, speeds = [], [], [], []
+            for recorded_at, lat, lng, speed in rows.order_by('recorded_at').values_list('recorded_at', 'latitude', 'longitude', 'speed').iterator(chunk_size=5000):
+                stamps.append((recorded_at - start).total_seconds())
+                lats.append(lat)
+                lngs.append(lng)
+                speeds.append(np.nan if speed is None else speed)
+
+            seconds = np.asarray(stamps, dtype=np.float64).astype(np.int64)
+            existing = BusLocationBlock.objects.select_for_update().filter(bus_id=bus_id, day=day).first()
+            if existing:
+                # Late uploads for an already compacted day: merge them in
+                old = decode_block(existing.data)
+                seconds = np.concatenate([old[0], seconds])
+                lats, lngs, speeds = (np.concatenate([o, np.asarray(n, dtype=np.float64)]) for o, n in zip(old[1:], (lats, lngs, speeds)))
+                order = np.argsort(seconds, kind='stable')
+                seconds, lats, lngs, speeds = seconds[order], lats[order], lngs[order], speeds[order]
+
+            keep = downsample(seconds, every)
+            data = encode_block(seconds[keep], np.asarray(lats)[keep], np.asarray(lngs)[keep], np.asarray(speeds)[keep])
+            BusLocationBlock.objects.update_or_create(bus_id=bus_id, day=day, defaults={"fix_count": len(keep), "data": data})
+            fixes += rows.delete()[0]
+            days += 1
+
+    logger.info(f"Compacted {fixes} location fixes into {days} bus-day blocks")
+    return days, fixes
+
+
+def purge(before=None):
+    """ Drop history older than `before` (default: the retention window). Returns rows/blocks deleted. """
+    from .models import BusLocationFix, BusLocationBlock
+
+    before = before or timezone.now().date() - timedelta(days=RETENTION_DAYS)
+    blocks = BusLocationBlock.objects.filter(day__lt=before).delete()[0]
+    raw = BusLocationFix.objects.filter(recorded_at__lt=_day_start(before)).delete()[0]
+    return blocks + raw
+
+
+# ----------------------------------------------------------------------
+# Reading
+
+def read(bus_id, start, end):
+    """ Fixes of one bus with start <= time < end, oldest first, from blocks and raw rows. """
+    from .models import BusLocationFix, BusLocationBlock
+
+    points = []
+    blocks = BusLocationBlock.objects.filter(
+        bus_id=bus_id, day__gte=start.astimezone(dt_timezone.utc).date(), day__lte=end.astimezone(dt_timezone.utc).date()
+    ).order_by('day').values_list('day', 'data')
+    for day, data in blocks:
+        day_start = _day_start(day)
+        seconds, lats, lngs, speeds = decode_block(data)
+        lo = np.searchsorted(seconds, (start - day_start).total_seconds(), side='left')
+        hi = np.searchsorted(seconds, (end - day_start).total_seconds(), side='left')
+        for i in range(lo, hi):
+            points.append({
+                "recorded_at": day_start + timedelta(seconds=int(seconds[i])),
+                "lat": float(lats[i]),
+                "lng": float(lngs[i]),
+                "speed": None if np.isnan(speeds[i]) else float(speeds[i]),
+            })
+
+    raw = BusLocationFix.objects.filter(bus_id=bus_id, recorded_at__gte=start, recorded_at__lt=end).order_by('recorded_at')
+    for recorded_at, lat, lng, speed in raw.values_list('recorded_at', 'latitude', 'longitude', 'speed').iterator(chunk_size=5000):
+        points.append({"recorded_at": recorded_at, "lat": lat, "lng": lng, "speed": speed})
+
+    # Late uploads can leave raw rows for a day that already has a block
+    points.sort(key=lambda p: p["recorded_at"])
+    return points
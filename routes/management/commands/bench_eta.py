@@ -0,0 +1,56 @@
+import math
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes.eta import RouteGeometry
+
+
+def scalar_etas(vertices, lat, lng, speed):
+    """ The old approach: one Python haversine per stop (straight-line, no projection). """
+    out = []
+    for _, _, stop_lat, stop_lng in vertices:
+        dlat, dlng = math.radians(stop_lat - lat), math.radians(stop_lng - lng)
+        a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat)) * math.cos(math.radians(stop_lat)) * math.sin(dlng / 2) ** 2
+        out.append(round(2 * 6371 * math.atan2(math.sqrt(a), math.sqrt(1 - a)) / speed * 60))
+    return out
+
+
+class Command(BaseCommand):
+    help = "Benchmark live ETA computation against route length (synthetic routes, no database)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, nargs='+', default=[10, 50, 200, 1000])
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=11)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        for n in options['stops']:
+            lat, lng = 11.0, 75.8
+            vertices = []
+            for i in range(n):
+                lat += rng.uniform(0.002, 0.01)
+                lng += rng.uniform(-0.005, 0.01)
+                vertices.append((i, f"Stop {i}", lat, lng))
+
+            t0 = time.perf_counter()
+            geometry = RouteGeometry(vertices)
+            build_ms = (time.perf_counter() - t0) * 1000
+
+            points = [vertices[rng.randrange(n)][2:] for _ in range(options['queries'])]
+            for label, fn in [
+                ("vectorized", lambda p: geometry.etas(p[0] + 0.0005, p[1], 30)),
+                ("scalar loop", lambda p: scalar_etas(vertices, p[0] + 0.0005, p[1], 30)),
+            ]:
+                samples = []
+                for p in points:
+                    t0 = time.perf_counter()
+                    fn(p)
+                    samples.append((time.perf_counter() - t0) * 1000)
+                samples.sort()
+                self.stdout.write(
+                    f"{n:>5} stops  {label:<12} p50 {samples[len(samples) // 2]:.3f} ms, "
+                    f"p99 {samples[int(len(samples) * 0.99)]:.3f} ms (geometry build {build_ms:.2f} ms)"
+                )
@@ -0,0 +1,127 @@
+import asyncio
+import gc
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.asgi import application
+from routes import eta, live_push
+from routes.live_ingest import Fix
+from routes.models import Route
+
+
+def rss_kb():
+    """ Current resident set size (Linux). """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class Subscriber:
+    """ One fake SSE client talking ASGI to core.asgi.application. """
+
+    def __init__(self, path, index, on_frame):
+        self.path = path
+        self.index = index
+        self.on_frame = on_frame
+        self.started = False
+        self.streaming = asyncio.Event()
+        self.closed = asyncio.Event()
+
+    async def receive(self):
+        if not self.started:
+            self.started = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.closed.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.streaming.set()
+        elif message['type'] == 'http.response.body' and message.get('body', b'').startswith(b'event: position'):
+            self.on_frame()
+
+    def run(self):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': self.path, 'raw_path': self.path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 10000 + self.index), 'server': ('localhost', 80),
+        }
+        return asyncio.create_task(application(scope, self.receive, self.send))
+
+
+class Command(BaseCommand):
+    help = "Load test live push: many SSE subscribers of one route on a single worker's event loop, fed by ingest flushes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=5000)
+        parser.add_argument('--updates', type=int, default=20)
+        parser.add_argument('--route', type=int, help="Route id (default: the first route)")
+
+    def handle(self, *args, **options):
+        route = Route.objects.filter(id=options['route']).first() if options['route'] else Route.objects.order_by('id').first()
+        if route is None:
+            raise CommandError("Needs at least one Route row")
+        asyncio.run(self.run(route, options['subscribers'], options['updates']))
+
+    async def run(self, route, count, updates):
+        loop = asyncio.get_running_loop()
+        received = {"frames": 0}
+        target = {"frames": count, "done": None}
+
+        def on_frame():
+            received["frames"] += 1
+            if received["frames"] >= target["frames"] and target["done"] is not None:
+                target["done"].set()
+
+        path = f'/api/routes/bus/live/{route.id}/stream/'
+        subscribers = [Subscriber(path, i, on_frame) for i in range(count)]
+        tasks = []
+
+        async def connect(upto):
+            batch = subscribers[len(tasks):upto]
+            tasks.extend(subscriber.run() for subscriber in batch)
+            for subscriber in batch:
+                await subscriber.streaming.wait()
+
+        # Warm up first, so lazy imports and thread pools don't count as per-subscriber memory
+        warmup = min(100, count)
+        await connect(warmup)
+        gc.collect()
+        rss_before = rss_kb()
+        t0 = time.perf_counter()
+        await connect(count)
+        connect_s = time.perf_counter() - t0
+        gc.collect()
+        rss_after = rss_kb()
+        self.stdout.write(
+            f"{count} subscribers connected ({count - warmup} in {connect_s:.2f} s, "
+            f"~{(rss_after - rss_before) / max(count - warmup, 1):.1f} KB RSS each)"
+        )
+
+        geometry = await loop.run_in_executor(None, eta.get_geometry, route.id)
+        points = list(zip(geometry.lats.tolist(), geometry.lngs.tolist())) or [(11.0, 76.0)]
+
+        latencies = []
+        received["frames"] = 0
+        for i in range(updates):
+            lat, lng = points[i % len(points)]
+            target["frames"], target["done"] = count * (i + 1), asyncio.Event()
+            fix = Fix(route.bus_id, lat + 0.0001, lng, 30.0, None, timezone.now())
+            t0 = time.perf_counter()
+            # Published from a worker thread, like the ingest flusher
+            await loop.run_in_executor(None, live_push.publish, [fix])
+            await target["done"].wait()
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        latencies.sort()
+        self.stdout.write(
+            f"{updates} updates fanned out to {count} subscribers each: "
+            f"p50 {latencies[len(latencies) // 2]:.1f} ms, max {latencies[-1]:.1f} ms until the last subscriber had it "
+            f"({count * 1000 / latencies[len(latencies) // 2]:,.0f} deliveries/s)"
+        )
+
+        for subscriber in subscribers:
+            subscriber.closed.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
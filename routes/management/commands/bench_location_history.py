@@ -0,0 +1,60 @@
+import random
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import BusDetails
+from routes import location_history
+from routes.live_ingest import Fix
+
+
+class Command(BaseCommand):
+    help = "Benchmark location history ingest (bulk inserts, rolled back) and block encoding on synthetic fixes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixes', type=int, default=20000)
+        parser.add_argument('--batch', type=int, default=2000, help="Fixes per flush")
+        parser.add_argument('--seed', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        bus_ids = list(BusDetails.objects.values_list('id', flat=True)[:500])
+        if not bus_ids:
+            raise CommandError("Needs at least one BusDetails row")
+
+        start = timezone.now() - timedelta(days=1)
+        fixes = [
+            Fix(bus_ids[i % len(bus_ids)], 11.0 + rng.random(), 76.0 + rng.random(), 30.0, None, start + timedelta(seconds=i))
+            for i in range(options['fixes'])
+        ]
+
+        # 1. Ingest: one bulk insert per flush, inside a transaction that is rolled back
+        with transaction.atomic():
+            t0 = time.perf_counter()
+            for i in range(0, len(fixes), options['batch']):
+                location_history.append(fixes[i:i + options['batch']])
+            elapsed = time.perf_counter() - t0
+            transaction.set_rollback(True)
+        self.stdout.write(f"Ingest: {len(fixes) / elapsed:,.0f} fixes/s ({len(fixes)} fixes, batches of {options['batch']})")
+
+        # 2. One bus-day of 5 s fixes: block size and encode/decode cost
+        seconds = np.arange(0, 86400, 5)
+        lats = 11.0 + np.cumsum(np.full(len(seconds), 1e-4))
+        lngs = 76.0 + np.cumsum(np.full(len(seconds), 1e-4))
+        speeds = np.full(len(seconds), 32.5)
+        keep = location_history.downsample(seconds, location_history.DOWNSAMPLE_SECONDS)
+
+        t0 = time.perf_counter()
+        data = location_history.encode_block(seconds[keep], lats[keep], lngs[keep], speeds[keep])
+        encode_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        location_history.decode_block(data)
+        decode_ms = (time.perf_counter() - t0) * 1000
+        self.stdout.write(
+            f"Block: {len(seconds)} fixes -> {len(keep)} after downsampling -> {len(data):,} bytes "
+            f"(encode {encode_ms:.2f} ms, decode {decode_ms:.2f} ms)"
+        )
@@ -0,0 +1,54 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from routes.geo_index import GridIndex, haversine_km
+
+# Roughly Kerala
+LAT_RANGE = (8.2, 12.8)
+LNG_RANGE = (74.8, 77.4)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the nearby-stops grid index on synthetic in-memory locations."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--k', type=int, default=10)
+        parser.add_argument('--radius', type=float, default=2.0)
+        parser.add_argument('--seed', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        rows = [
+            (i, f"Stop {i}", None, rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE))
+            for i in range(options['locations'])
+        ]
+
+        t0 = time.perf_counter()
+        index = GridIndex(rows)
+        self.stdout.write(f"Build: {(time.perf_counter() - t0) * 1000:.0f} ms for {len(rows)} locations, {len(index.cells)} cells")
+
+        points = [(rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE)) for _ in range(options['queries'])]
+
+        # Correctness: kNN agrees with brute force on a sample
+        for lat, lng in points[:20]:
+            brute = np.argsort(haversine_km(lat, lng, index.lats, index.lngs))[:options['k']]
+            if [r['id'] for r in index.nearest(lat, lng, options['k'])] != [index.ids[i] for i in brute]:
+                self.stderr.write(f"kNN mismatch at {lat:.4f},{lng:.4f}")
+
+        for label, fn in [
+            (f"kNN (k={options['k']})", lambda lat, lng: index.nearest(lat, lng, options['k'])),
+            (f"radius ({options['radius']} km)", lambda lat, lng: index.within(lat, lng, options['radius'])),
+            ("brute-force kNN", lambda lat, lng: np.argsort(haversine_km(lat, lng, index.lats, index.lngs))[:options['k']]),
+        ]:
+            samples = []
+            for lat, lng in points:
+                t0 = time.perf_counter()
+                fn(lat, lng)
+                samples.append((time.perf_counter() - t0) * 1000)
+            samples.sort()
+            self.stdout.write(f"{label:<20} p50 {samples[len(samples) // 2]:.3f} ms, p99 {samples[int(len(samples) * 0.99)]:.3f} ms")
@@ -0,0 +1,45 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes import notification_dispatcher
+
+
+class Command(BaseCommand):
+    help = "Benchmark the notification dispatcher in memory: re-scoring per bus ping and popping due alerts, with many subscriptions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=300_000)
+        parser.add_argument('--routes', type=int, default=3000)
+        parser.add_argument('--stops', type=int, default=20, help="Stops per route")
+        parser.add_argument('--pings', type=int, default=20_000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(1)
+        routes, stops = options['routes'], options['stops']
+        dispatcher = notification_dispatcher.Dispatcher(transport=notification_dispatcher.InMemoryTransport(), fleet=object())
+
+        t0 = time.perf_counter()
+        for i in range(options['subscriptions']):
+            dispatcher.upsert(i, i, rng.randrange(routes), f"Stop {rng.randrange(stops)}", rng.choice((5, 10, 15, 20)))
+        self.stdout.write(f"{options['subscriptions']:,} subscriptions loaded in {time.perf_counter() - t0:.2f} s")
+
+        # Every ping: one route's bus moved, its stops' ETAs shift
+        now = time.time()
+        t0 = time.perf_counter()
+        for ping in range(options['pings']):
+            route_id = rng.randrange(routes)
+            offset = rng.randrange(60)
+            payload = {"stops": [{"stop_name": f"Stop {s}", "eta_minutes": s * 4 - offset if s * 4 >= offset else None}
+                                 for s in range(stops)]}
+            dispatcher.rescore(route_id, payload, now + ping * 0.01)
+        elapsed = time.perf_counter() - t0
+        self.stdout.write(
+            f"{options['pings']:,} pings: {elapsed / options['pings'] * 1e6:.0f} us each, "
+            f"{dispatcher.stats['rescored'] / options['pings']:.0f} entries re-scored per ping, heap {len(dispatcher.heap):,}"
+        )
+
+        t0 = time.perf_counter()
+        due = dispatcher.due(now + 15 * 60)
+        self.stdout.write(f"{len(due):,} alerts due in the next 15 min popped in {(time.perf_counter() - t0) * 1000:.0f} ms")
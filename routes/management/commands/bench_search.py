@@ -0,0 +1,123 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from accounts.models import BusDetails
+from routes.models import Location, Route, RouteStop
+from routes.search_index import StopSequenceIndex
+
+
+class _Rollback(Exception):
+    pass
+
+
+def legacy_orm_search(from_query, to_query):
+    """ The previous search_routes pipeline (icontains OR-joins + Python position loop). """
+    from_matches = Route.objects.filter(
+        Q(start_location__icontains=from_query) | Q(stops__location__name__icontains=from_query)
+    ).distinct()
+    to_matches = Route.objects.filter(
+        Q(end_location__icontains=to_query) | Q(stops__location__name__icontains=to_query)
+    ).distinct()
+    candidates = (from_matches & to_matches).distinct().prefetch_related('stops__location')
+
+    valid = []
+    for route in candidates:
+        start_index = end_index = -1
+        if from_query.lower() in route.start_location.lower():
+            start_index = 0
+        else:
+            for stop in route.stops.all():
+                if from_query.lower() in stop.location.name.lower():
+                    start_index = stop.stop_number
+                    break
+        if to_query.lower() in route.end_location.lower():
+            end_index = 9999
+        else:
+            for stop in route.stops.all():
+                if to_query.lower() in stop.location.name.lower():
+                    end_index = stop.stop_number
+                    break
+        if start_index != -1 and end_index != -1 and start_index < end_index:
+            valid.append(route.id)
+    return valid
+
+
+class Command(BaseCommand):
+    help = "Benchmark the stop-sequence index against the legacy ORM search on synthetic data (rolled back afterwards)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=10000)
+        parser.add_argument('--locations', type=int, default=2000)
+        parser.add_argument('--stops', type=int, default=10, help="Intermediate stops per route")
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _seed(self, options, rng):
+        names = [f"Bench Stop {i:05d}" for i in range(options['locations'])]
+        Location.objects.bulk_create([Location(name=n) for n in names], batch_size=1000)
+        locations = list(Location.objects.filter(name__startswith="Bench Stop "))
+
+        buses = []
+        for i in range(max(1, options['routes'] // 100)):
+            user = User.objects.create(username=f"bench_operator_{i}")
+            buses.append(BusDetails.objects.create(user=user, bus_name=f"Bench {i}", reg_number=f"BN-{i}"))
+
+        routes = []
+        route_paths = []
+        for i in range(options['routes']):
+            path = rng.sample(locations, options['stops'] + 2)
+            route_paths.append(path)
+            routes.append(Route(bus=buses[i % len(buses)], start_location=path[0].name, end_location=path[-1].name))
+        routes = Route.objects.bulk_create(routes, batch_size=1000)
+
+        stops = []
+        for route, path in zip(routes, route_paths):
+            for number, loc in enumerate(path[1:-1], start=1):
+                stops.append(RouteStop(route=route, location=loc, stop_number=number))
+        RouteStop.objects.bulk_create(stops, batch_size=5000)
+        return names
+
+    def _time(self, fn, pairs):
+        samples = []
+        for from_q, to_q in pairs:
+            t0 = time.perf_counter()
+            fn(from_q, to_q)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        return sum(samples) / len(samples), samples[int(len(samples) * 0.99) - 1] if len(samples) > 1 else samples[0]
+
+    def _run(self, options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f"Seeding {options['routes']} routes ...")
+        names = self._seed(options, rng)
+        pairs = [tuple(rng.sample(names, 2)) for _ in range(options['queries'])]
+
+        t0 = time.perf_counter()
+        index = StopSequenceIndex.build()
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        # Sanity check: both paths agree
+        for from_q, to_q in pairs[:5]:
+            if sorted(legacy_orm_search(from_q, to_q)) != index.search(from_q, to_q):
+                self.stderr.write(f"Mismatch for {from_q} -> {to_q}")
+
+        orm_mean, orm_p99 = self._time(legacy_orm_search, pairs)
+        idx_mean, idx_p99 = self._time(index.search, pairs)
+
+        self.stdout.write(f"Index build:  {build_ms:.1f} ms")
+        self.stdout.write(f"ORM search:   mean {orm_mean:.2f} ms, p99 {orm_p99:.2f} ms")
+        self.stdout.write(f"Index search: mean {idx_mean:.3f} ms, p99 {idx_p99:.3f} ms")
+        self.stdout.write(self.style.SUCCESS(f"Speedup: {orm_mean / max(idx_mean, 1e-6):.0f}x"))
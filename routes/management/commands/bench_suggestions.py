@@ -0,0 +1,52 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes.suggestions import SuggestionEngine
+
+SYLLABLES = ['ko', 'zhi', 'kode', 'ni', 'lam', 'bur', 'ma', 'la', 'ppu', 'ram', 'thi', 'ru', 'van', 'an', 'tha', 'pu', 'ra', 'kal', 'pet', 'ta', 'ka', 'vu', 'ngal', 'ee', 'ri', 'ssur']
+SUFFIXES = ['', '', '', ' Bus Stand', ' Junction', ' Town', ' Market', ' Bridge']
+
+
+class Command(BaseCommand):
+    help = "Benchmark the location suggestion engine on synthetic in-memory data."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        names = set()
+        while len(names) < options['locations']:
+            word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+            names.add(word + rng.choice(SUFFIXES))
+        districts = [''.join(rng.choice(SYLLABLES) for _ in range(3)).capitalize() for _ in range(14)]
+        rows = [(n, rng.choice(districts), int(rng.paretovariate(1.2))) for n in names]
+
+        t0 = time.perf_counter()
+        engine = SuggestionEngine(rows)
+        self.stdout.write(f"Build: {(time.perf_counter() - t0):.2f} s for {len(rows)} locations")
+
+        # Simulate keystrokes: every prefix of a random name, plus some infix queries
+        queries = []
+        sample = rng.sample(sorted(names), options['queries'] // 8)
+        for name in sample:
+            queries.extend(name[:n] for n in range(1, min(len(name), 8) + 1))
+        queries.extend(name[2:6] for name in sample)
+
+        samples = []
+        for q in queries:
+            t0 = time.perf_counter()
+            engine.suggest(q)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+
+        p50 = samples[len(samples) // 2]
+        p99 = samples[int(len(samples) * 0.99)]
+        self.stdout.write(f"{len(samples)} queries: p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {samples[-1]:.3f} ms")
+        style = self.style.SUCCESS if p99 < 2 else self.style.WARNING
+        self.stdout.write(style(f"p99 target (< 2 ms): {'met' if p99 < 2 else 'missed'}"))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from routes import location_history
+
+
+class Command(BaseCommand):
+    help = "Downsample raw bus location history into daily blocks and drop history past the retention window (run daily)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--raw-days', type=int, default=location_history.RAW_DAYS, help="Keep this many days of raw fixes")
+        parser.add_argument('--retention-days', type=int, default=location_history.RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        days, fixes = location_history.compact(before=today - timedelta(days=options['raw_days']))
+        purged = location_history.purge(before=today - timedelta(days=options['retention_days']))
+        self.stdout.write(self.style.SUCCESS(f"Compacted {fixes} fixes into {days} bus-day blocks; purged {purged} expired rows/blocks."))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes import gtfs_export
+
+
+class Command(BaseCommand):
+    help = "Write the GTFS static feed (skipped when the route network hasn't changed since the last export)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Rebuild even if the feed is up to date")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = gtfs_export.ensure_fresh(force=options['force'])
+        if stats is None:
+            self.stdout.write(f"GTFS feed at {gtfs_export.FEED_PATH} is up to date, or being rebuilt by another process.")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {gtfs_export.FEED_PATH} in {time.perf_counter() - started:.1f}s: "
+            f"{stats['stops']} stops, {stats['routes']} routes, {stats['trips']} trips, {stats['stop_times']} stop times."
+        ))
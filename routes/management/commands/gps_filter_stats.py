@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from routes import gps_filter
+
+
+class Command(BaseCommand):
+    help = "Show GPS ingest filter counters: fixes received, stored and dropped (summed across workers)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = gps_filter.stats()
+        self.stdout.write(f"Received:   {stats['received']}")
+        self.stdout.write(f"Accepted:   {stats['accepted']} (re-anchored after a jump: {stats['reanchored']}, late uploads: {stats['late']})")
+        self.stdout.write(f"Duplicates: {stats['duplicate']}")
+        self.stdout.write(f"Bursts:     {stats['burst']}")
+        self.stdout.write(f"Jumps:      {stats['jump']}")
+        self.stdout.write(f"Writes saved: {stats['saved_rate'] * 100:.1f}%")
+        if options['reset']:
+            gps_filter.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import BusDetails
+from routes.timetable_import import import_timetable
+
+
+class Command(BaseCommand):
+    help = "Import routes and trips for one bus from a flat CSV or a GTFS-lite zip (stops/routes/trips/stop_times)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--bus', required=True, help="BusDetails id or registration number")
+
+    def handle(self, *args, **options):
+        bus_ref = options['bus']
+        try:
+            bus = BusDetails.objects.get(id=int(bus_ref)) if bus_ref.isdigit() else BusDetails.objects.get(reg_number__iexact=bus_ref)
+        except BusDetails.DoesNotExist:
+            raise CommandError(f"Bus '{bus_ref}' not found")
+
+        started = time.perf_counter()
+        with open(options['path'], 'rb') as f:
+            report = import_timetable(bus, f, options['path'])
+        elapsed = time.perf_counter() - started
+
+        for error in report['errors']:
+            self.stderr.write(f"{error['file']}:{error['line']}: {error['error']}")
+        if report['error_count'] > len(report['errors']):
+            self.stderr.write(f"... and {report['error_count'] - len(report['errors'])} more errors")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report['trips']} trips on {report['routes']} routes "
+            f"({report['route_stops']} stops, {report['locations']} locations, {report['templates']} new templates) "
+            f"in {elapsed:.1f}s with {report['error_count']} errors."
+        ))
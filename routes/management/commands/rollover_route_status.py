@@ -0,0 +1,22 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from routes.models import Route
+from routes.signals import route_network_changed
+
+
+class Command(BaseCommand):
+    help = "Reset every 'closed_today' route closed before today back to 'active' (run from cron just after midnight)."
+
+    def handle(self, *args, **options):
+        start_of_today = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+
+        # One UPDATE; status_updated_at is left alone, same as the old per-row save(update_fields=['status'])
+        updated = Route.objects.filter(status='closed_today', status_updated_at__lt=start_of_today).update(status='active')
+
+        # update() sends no signals, so refresh indexes/network version ourselves
+        if updated:
+            route_network_changed()
+        self.stdout.write(self.style.SUCCESS(f"Reactivated {updated} route(s)."))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from routes import notification_dispatcher
+
+
+class Command(BaseCommand):
+    help = "Send route notifications as buses approach riders' stops (long-running; run exactly one)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tick', type=float, default=notification_dispatcher.TICK_SECONDS, help="Seconds between rounds")
+        parser.add_argument('--once', action='store_true', help="Run a single round and exit")
+
+    def handle(self, *args, **options):
+        dispatcher = notification_dispatcher.Dispatcher()
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            try:
+                sent = dispatcher.tick()
+            except Exception as e:
+                if options['once']:
+                    raise
+                self.stderr.write(f"Notification round failed: {e!r}")
+                sent = 0
+            if sent or options['once']:
+                self.stdout.write(
+                    f"{sent} notifications sent ({len(dispatcher.entries)} subscriptions, {len(dispatcher.heap)} queued)"
+                )
+            if options['once']:
+                return
+            time.sleep(max(options['tick'] - (time.monotonic() - started), 0))
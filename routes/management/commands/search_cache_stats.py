@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from routes import search_cache
+
+
+class Command(BaseCommand):
+    help = "Show search_routes result cache hit/miss counters (summed across workers)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = search_cache.stats()
+        self.stdout.write(f"Network version: {stats['network_version']}")
+        self.stdout.write(f"Hits:   {stats['hits']}")
+        self.stdout.write(f"Misses: {stats['misses']}")
+        self.stdout.write(f"Hit rate: {stats['hit_rate'] * 100:.1f}%")
+        if options['reset']:
+            search_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes import segment_times
+
+
+class Command(BaseCommand):
+    help = "Learn stop-to-stop travel times from location history recorded since the last run (run nightly)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Forget the learned table and retrain from all raw history")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        samples = segment_times.train(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f"Trained on {samples} segment samples in {time.perf_counter() - started:.1f}s."))
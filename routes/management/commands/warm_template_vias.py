@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from routes import template_cache
+
+
+class Command(BaseCommand):
+    help = "Precompute the add-route via picker lists for every location pair that has templates (run at deploy)."
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        pairs = template_cache.warm_vias()
+        self.stdout.write(self.style.SUCCESS(f"Cached via lists for {pairs} location pairs in {time.perf_counter() - started:.1f}s."))
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def normalize(name):
+    # Frozen copy of routes.text.normalize as of this migration: the keys it
+    # fills must match the rules in force when it was written
+    return ' '.join((name or '').split()).casefold()
+
+
+def fill_keys(apps, schema_editor):
+    RouteTemplate = apps.get_model('routes', 'RouteTemplate')
+    templates = list(RouteTemplate.objects.select_related('start_location', 'end_location'))
+    for t in templates:
+        start, end = normalize(t.start_location.name), normalize(t.end_location.name)
+        t.lookup_key = f"{start}|{end}|{normalize(t.via)}"
+        t.pair_key = '|'.join(sorted((start, end)))
+    RouteTemplate.objects.bulk_update(templates, ['lookup_key', 'pair_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0011_buslivelocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routetemplate',
+            name='lookup_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=310),
+        ),
+        migrations.AddField(
+            model_name='routetemplate',
+            name='pair_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=210),
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_remove_busdetails_current_lat_and_more'),
+        ('routes', '0012_routetemplate_lookup_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusLocationFix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField()),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('speed', models.FloatField(blank=True, null=True)),
+                ('heading', models.FloatField(blank=True, null=True)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_history', to='accounts.busdetails')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('bus', 'recorded_at'), name='unique_bus_fix_time')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BusLocationBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('fix_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_blocks', to='accounts.busdetails')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('bus', 'day'), name='unique_bus_block_day')],
+            },
+        ),
+    ]
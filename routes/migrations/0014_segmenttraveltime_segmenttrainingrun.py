@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0013_buslocationfix_buslocationblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentTravelTime',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('mean_seconds', models.FloatField(default=0)),
+                ('m2', models.FloatField(default=0)),
+                ('from_location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='routes.location')),
+                ('to_location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='routes.location')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('from_location', 'to_location', 'weekday', 'hour'), name='unique_segment_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SegmentTrainingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trained_through', models.DateTimeField(db_index=True)),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0014_segmenttraveltime_segmenttrainingrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routenotification',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='routenotification',
+            name='last_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from accounts.models import BusDetails  
+from .text import normalize
 
 class Location(models.Model):
     name = models.CharField(max_length=100, unique=True) # unique=True 
@@ -29,12 +30,12 @@ class Route(models.Model):
 
     @property
     def effective_status(self):
+        # Read-only: serializers touch this for every route in a search result.
+        # Stale rows are reset in bulk by `manage.py rollover_route_status`.
         if self.status == 'closed_today':
             from django.utils import timezone
             # If the date the status was updated is before today, it means the "today" has passed.
             if timezone.localtime(self.status_updated_at).date() < timezone.localdate():
-                self.status = 'active'
-                self.save(update_fields=['status'])
                 return 'active'
         return self.status
 
@@ -70,6 +71,33 @@ class RouteTemplate(models.Model):
     created_by = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='created_templates')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Normalized keys so matching is an indexed equality probe instead of __iexact joins.
+    # lookup_key is directional (a reverse match probes end|start|via);
+    # pair_key ignores direction and via, for "every template between A and B".
+    lookup_key = models.CharField(max_length=310, default='', editable=False, db_index=True)
+    pair_key = models.CharField(max_length=210, default='', editable=False, db_index=True)
+
+    @staticmethod
+    def make_lookup_key(start_name, end_name, via):
+        return f"{normalize(start_name)}|{normalize(end_name)}|{normalize(via)}"
+
+    @staticmethod
+    def make_pair_key(start_name, end_name):
+        return '|'.join(sorted((normalize(start_name), normalize(end_name))))
+
+    def set_keys(self, start_name=None, end_name=None):
+        """ Fill the lookup keys. Pass the names to avoid fetching the Locations (e.g. before bulk_create). """
+        start_name = start_name if start_name is not None else self.start_location.name
+        end_name = end_name if end_name is not None else self.end_location.name
+        self.lookup_key = self.make_lookup_key(start_name, end_name, self.via)
+        self.pair_key = self.make_pair_key(start_name, end_name)
+
+    def save(self, *args, **kwargs):
+        self.set_keys()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'lookup_key', 'pair_key'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"TEMPLATE: {self.start_location} -> {self.end_location} ({self.via})"
     
@@ -102,6 +130,8 @@ class RouteNotification(models.Model):
     stop_name = models.CharField(max_length=150)
     notify_minutes = models.PositiveIntegerField(default=15)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)     # picked up by the dispatcher (routes/notification_dispatcher.py)
+    last_sent_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ('user', 'route', 'stop_name')
@@ -121,5 +151,57 @@ class BusLiveLocation(models.Model):
     speed = models.FloatField(null=True, blank=True)
     heading = models.FloatField(null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+
+class BusLocationFix(models.Model):
+    """ Raw GPS history, one narrow row per fix (see routes/location_history.py). """
+    bus = models.ForeignKey(BusDetails, on_delete=models.CASCADE, related_name="location_history")
+    recorded_at = models.DateTimeField()
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    speed = models.FloatField(null=True, blank=True)
+    heading = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # Also the index for per-bus range reads; makes retried uploads no-ops
+            models.UniqueConstraint(fields=['bus', 'recorded_at'], name='unique_bus_fix_time'),
+        ]
+
+
+class BusLocationBlock(models.Model):
+    """ One bus-day of downsampled history, delta-encoded and compressed. """
+    bus = models.ForeignKey(BusDetails, on_delete=models.CASCADE, related_name="location_blocks")
+    day = models.DateField()
+    fix_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bus', 'day'], name='unique_bus_block_day'),
+        ]
+
+
+class SegmentTravelTime(models.Model):
+    """ Learned travel time between two consecutive stops, per weekday/hour (see routes/segment_times.py). """
+    from_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    to_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    weekday = models.PositiveSmallIntegerField()   # Monday = 0
+    hour = models.PositiveSmallIntegerField()
+    samples = models.PositiveIntegerField(default=0)
+    mean_seconds = models.FloatField(default=0)
+    m2 = models.FloatField(default=0)               # sum of squared deviations (Welford), for the spread
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['from_location', 'to_location', 'weekday', 'hour'], name='unique_segment_bucket'),
+        ]
+
+
+class SegmentTrainingRun(models.Model):
+    """ One incremental training pass; the latest `trained_through` is where the next one starts. """
+    trained_through = models.DateTimeField(db_index=True)
+    samples = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
     
 # =================================
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+Global "network version" counter.
+
+Bumped by the signals in routes/signals.py whenever anything that shows up in
+search results changes (Route, RouteStop, Trip, Location, bus status). It lives
+in Django's cache so every gunicorn worker sees the same value; anything
+derived from the network (result cache keys, per-worker indexes) is stamped
+with it and becomes stale the moment it moves.
+
+RouteTemplates get their own counter (TEMPLATE_VERSION_KEY): they never show
+up in search results, so admin edits to them shouldn't flush the search cache.
+"""
+import time
+
+from django.core.cache import cache
+
+VERSION_KEY = 'routes:network_version'
+TEMPLATE_VERSION_KEY = 'routes:template_version'
+
+
+def _seed():
+    # Start from the clock so a flushed/evicted counter never reuses an old version
+    return int(time.time() * 1000)
+
+
+def get_version(key=VERSION_KEY):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _seed(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(*args, key=VERSION_KEY, **kwargs):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key missing: seed it (add is a no-op if another worker just did)
+        cache.add(key, _seed(), timeout=None)
+        return cache.incr(key)
+
+
+def get_template_version():
+    return get_version(TEMPLATE_VERSION_KEY)
+
+
+def bump_template_version(*args, **kwargs):
+    return bump_version(key=TEMPLATE_VERSION_KEY)
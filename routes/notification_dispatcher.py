@@ -0,0 +1,327 @@
+"""
+RouteNotification dispatcher: "tell me when the bus is N minutes from my stop".
+
+Runs as a single service (manage.py run_notification_dispatcher), not inside
+the web workers, so each alert is sent once. All of its state is in memory:
+
+  entries   notification id -> Entry (route, normalized stop, notify_minutes, armed)
+  by_stop   (route_id, stop) -> {notification ids}
+  heap      (trigger time, seq, notification id, version): when each armed entry
+            is due, predicted from its route's latest ETAs
+
+Every tick (NOTIFY_TICK_SECONDS):
+  1. RouteNotification rows changed since the last tick are pulled by
+     updated_at (a full reload every NOTIFY_RELOAD_SECONDS drops deleted ones).
+  2. The buses that reported since the last tick come from a FleetIndex
+     (routes/fleet_index.py) refreshed incrementally from BusLiveLocation. Only
+     their routes that have subscriptions get their ETAs computed, once per
+     route, and only those routes' entries are re-scored: each gets a new heap
+     item and older ones go stale (lazy deletion, compacted when they pile up).
+  3. Everything due is popped and sent through the transport
+     (NOTIFY_TRANSPORT) in batches of NOTIFY_BATCH_SIZE.
+
+The table is never scanned per GPS ping, and between pings the heap keeps
+firing on the predicted times. An entry fires once per approach of the bus:
+it re-arms when the bus has passed the stop, or when the ETA is again more
+than NOTIFY_REARM_MINUTES beyond notify_minutes (the next trip). last_sent_at
+and NOTIFY_COOLDOWN_MINUTES keep a restart from repeating alerts.
+"""
+import heapq
+import itertools
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.utils.module_loading import import_string
+
+from . import eta, live_state
+from .fleet_index import FleetIndex
+from .text import normalize
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT = getattr(settings, 'NOTIFY_TRANSPORT', 'routes.notification_dispatcher.EmailTransport')
+TICK_SECONDS = getattr(settings, 'NOTIFY_TICK_SECONDS', 5)
+BATCH_SIZE = getattr(settings, 'NOTIFY_BATCH_SIZE', 500)
+RELOAD_SECONDS = getattr(settings, 'NOTIFY_RELOAD_SECONDS', 600)
+OVERLAP_SECONDS = getattr(settings, 'NOTIFY_OVERLAP_SECONDS', 5)
+COOLDOWN_MINUTES = getattr(settings, 'NOTIFY_COOLDOWN_MINUTES', 60)
+REARM_MINUTES = getattr(settings, 'NOTIFY_REARM_MINUTES', 10)
+RETRY_SECONDS = getattr(settings, 'NOTIFY_RETRY_SECONDS', 60)
+MAX_POSITION_AGE = getattr(settings, 'NOTIFY_MAX_POSITION_AGE', 300)
+
+
+class Alert(NamedTuple):
+    notification_id: int
+    user_id: int
+    route_id: int
+    stop_name: str
+    eta_minutes: int
+
+
+class Entry:
+    __slots__ = ('user_id', 'route_id', 'stop_name', 'stop', 'notify_minutes', 'armed', 'version', 'eta', 'scored_at')
+
+    def __init__(self, user_id, route_id, stop_name, notify_minutes, armed):
+        self.user_id = user_id
+        self.route_id = route_id
+        self.stop_name = stop_name
+        self.stop = normalize(stop_name)
+        self.notify_minutes = notify_minutes
+        self.armed = armed
+        self.version = 0            # bumped on every re-score: older heap items are stale
+        self.eta = None             # minutes, as of scored_at
+        self.scored_at = None
+
+
+# ----------------------------------------------------------------------
+# Transports: send(alerts) delivers one batch, raising if it couldn't
+
+class InMemoryTransport:
+    """ Keeps the batches; for tests. """
+
+    def __init__(self):
+        self.batches = []
+
+    def send(self, alerts):
+        self.batches.append(list(alerts))
+
+    @property
+    def sent(self):
+        return [alert for batch in self.batches for alert in batch]
+
+
+class EmailTransport:
+    """ One email per alert, all of a batch over one SMTP connection. """
+
+    def send(self, alerts):
+        from django.contrib.auth.models import User
+
+        emails = dict(User.objects.filter(id__in={a.user_id for a in alerts}).exclude(email='').values_list('id', 'email'))
+        messages = [
+            (
+                f"Your bus is {alert.eta_minutes} min from {alert.stop_name}",
+                f"The bus on your TravelSync route will reach {alert.stop_name} in about {alert.eta_minutes} minutes.",
+                settings.EMAIL_HOST_USER,
+                [emails[alert.user_id]],
+            )
+            for alert in alerts if alert.user_id in emails
+        ]
+        send_mass_mail(messages, fail_silently=False)
+
+
+# ----------------------------------------------------------------------
+
+def _epoch(value):
+    return value.timestamp() if value is not None else None
+
+
+class Dispatcher:
+    def __init__(self, transport=None, batch_size=BATCH_SIZE, fleet=None):
+        self.transport = transport if transport is not None else import_string(TRANSPORT)()
+        self.batch_size = batch_size
+        self.fleet = fleet if fleet is not None else FleetIndex()
+        self.entries = {}                   # notification id -> Entry
+        self.by_stop = defaultdict(set)     # (route_id, stop) -> {notification id}
+        self.stops_of = defaultdict(set)    # route_id -> {stop} with subscriptions
+        self.route_etas = {}                # route_id -> ({stop: minutes or None}, scored_at)
+        self.heap = []
+        self.watermark = None               # newest RouteNotification.updated_at seen
+        self._reloaded_at = 0.0
+        self._seq = itertools.count()
+        self.stats = {"rescored": 0, "sent": 0, "failed": 0}
+
+    # -- subscriptions -------------------------------------------------
+
+    def upsert(self, notification_id, user_id, route_id, stop_name, notify_minutes, last_sent_at=None, now=None):
+        """ Add or update one subscription; last_sent_at in epoch seconds. """
+        now = time.time() if now is None else now
+        current = self.entries.get(notification_id)
+        if current is not None:
+            if (current.route_id, current.stop_name, current.notify_minutes) == (route_id, stop_name, notify_minutes):
+                return
+            self.remove(notification_id)
+        armed = last_sent_at is None or now - last_sent_at > COOLDOWN_MINUTES * 60
+        entry = Entry(user_id, route_id, stop_name, notify_minutes, armed)
+        self.entries[notification_id] = entry
+        self.by_stop[(route_id, entry.stop)].add(notification_id)
+        self.stops_of[route_id].add(entry.stop)
+        # Scheduled at once if the route's ETAs are known already
+        known = self.route_etas.get(route_id)
+        if known is not None:
+            self._score(notification_id, entry, known[0].get(entry.stop, ()), known[1])
+
+    def remove(self, notification_id):
+        entry = self.entries.pop(notification_id, None)
+        if entry is None:
+            return
+        key = (entry.route_id, entry.stop)
+        self.by_stop[key].discard(notification_id)
+        if not self.by_stop[key]:
+            del self.by_stop[key]
+            self.stops_of[entry.route_id].discard(entry.stop)
+            if not self.stops_of[entry.route_id]:
+                del self.stops_of[entry.route_id]
+                self.route_etas.pop(entry.route_id, None)
+
+    def sync(self, now=None):
+        """ Catch up with RouteNotification: changed rows only, or everything every NOTIFY_RELOAD_SECONDS. """
+        from .models import RouteNotification
+
+        now = time.time() if now is None else now
+        rows = RouteNotification.objects.values_list(
+            'id', 'user_id', 'route_id', 'stop_name', 'notify_minutes', 'last_sent_at', 'updated_at'
+        )
+        full = self.watermark is None or now - self._reloaded_at > RELOAD_SECONDS
+        if full:
+            self._reloaded_at = now
+            rows = rows.iterator(chunk_size=10000)
+        else:
+            rows = rows.filter(updated_at__gte=self.watermark - timedelta(seconds=OVERLAP_SECONDS))
+
+        seen = set()
+        for notification_id, user_id, route_id, stop_name, notify_minutes, last_sent_at, updated_at in rows:
+            seen.add(notification_id)
+            self.upsert(notification_id, user_id, route_id, stop_name, notify_minutes, _epoch(last_sent_at), now)
+            if self.watermark is None or updated_at > self.watermark:
+                self.watermark = updated_at
+        if full:
+            for notification_id in self.entries.keys() - seen:
+                self.remove(notification_id)
+        return len(seen)
+
+    # -- scoring -------------------------------------------------------
+
+    def _score(self, notification_id, entry, minutes, now):
+        """ minutes: the stop's ETA, None once the bus has passed it, () if the route doesn't have it. """
+        entry.version += 1
+        if minutes == ():
+            return
+        if minutes is None:
+            # This approach is over: ready for the next one
+            entry.armed = True
+            entry.eta = None
+            return
+        if not entry.armed:
+            if minutes <= entry.notify_minutes + REARM_MINUTES:
+                return
+            entry.armed = True
+        entry.eta, entry.scored_at = minutes, now
+        trigger = now + max(minutes - entry.notify_minutes, 0) * 60
+        heapq.heappush(self.heap, (trigger, next(self._seq), notification_id, entry.version))
+
+    def rescore(self, route_id, payload, now=None):
+        """ New ETAs of a route (eta.route_etas): re-schedule the entries of its stops only. Returns how many. """
+        stops = self.stops_of.get(route_id)
+        if not stops:
+            return 0
+        now = time.time() if now is None else now
+        etas = {}
+        for stop in payload["stops"]:
+            key = normalize(stop["stop_name"])
+            # A name served twice (a loop): the next visit counts
+            if etas.get(key) is None:
+                etas[key] = stop["eta_minutes"]
+        self.route_etas[route_id] = (etas, now)
+
+        count = 0
+        for stop in stops:
+            minutes = etas.get(stop, ())
+            for notification_id in self.by_stop[(route_id, stop)]:
+                self._score(notification_id, self.entries[notification_id], minutes, now)
+                count += 1
+        self.stats["rescored"] += count
+        self._compact()
+        return count
+
+    def _compact(self):
+        # Every re-score leaves a stale item behind; rebuild once they dominate
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.heap = [item for item in self.heap
+                         if item[2] in self.entries and self.entries[item[2]].version == item[3]]
+            heapq.heapify(self.heap)
+
+    def update_positions(self, now=None):
+        """ Re-score the subscribed routes of every bus that reported since the last call. Returns routes re-scored. """
+        now = time.time() if now is None else now
+        updated = self.fleet.refresh(force=True) or ()
+        routes_of = live_state.get_route_buses().routes_of
+        done = set()
+        for bus_id in updated:
+            position = self.fleet.buses.get(bus_id)
+            # The first load brings every bus; a position from hours ago predicts nothing
+            if position is None or now - position.updated_at > MAX_POSITION_AGE:
+                continue
+            for route_id in routes_of.get(bus_id, ()):
+                if route_id in self.stops_of and route_id not in done:
+                    done.add(route_id)
+                    self.rescore(route_id, eta.route_etas(route_id, position.latitude, position.longitude, position.speed), now)
+        return len(done)
+
+    # -- sending -------------------------------------------------------
+
+    def due(self, now=None):
+        """ Pop every armed entry whose trigger time has come, as Alerts. """
+        now = time.time() if now is None else now
+        alerts = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, notification_id, version = heapq.heappop(self.heap)
+            entry = self.entries.get(notification_id)
+            if entry is None or entry.version != version or not entry.armed:
+                continue
+            entry.armed = False
+            minutes = max(round(entry.eta - (now - entry.scored_at) / 60), 0)
+            alerts.append(Alert(notification_id, entry.user_id, entry.route_id, entry.stop_name, minutes))
+        return alerts
+
+    def dispatch(self, now=None):
+        """ Send everything due, in batches. Returns the number of alerts sent. """
+        from .models import RouteNotification
+
+        now = time.time() if now is None else now
+        alerts = self.due(now)
+        sent = 0
+        for start in range(0, len(alerts), self.batch_size):
+            batch = alerts[start:start + self.batch_size]
+            # Unsubscribed since the last sync: don't send
+            alive = set(RouteNotification.objects.filter(id__in=[a.notification_id for a in batch]).values_list('id', flat=True))
+            for alert in batch:
+                if alert.notification_id not in alive:
+                    self.remove(alert.notification_id)
+            batch = [alert for alert in batch if alert.notification_id in alive]
+            if not batch:
+                continue
+            try:
+                self.transport.send(batch)
+            except Exception:
+                logger.exception(f"Sending {len(batch)} route notifications failed; retrying in {RETRY_SECONDS} s")
+                self.stats["failed"] += len(batch)
+                for alert in batch:
+                    self._retry(alert, now)
+                continue
+            # .update() leaves updated_at alone, so this isn't read back as a change
+            RouteNotification.objects.filter(id__in=[a.notification_id for a in batch]).update(
+                last_sent_at=datetime.fromtimestamp(now, dt_timezone.utc)
+            )
+            sent += len(batch)
+        self.stats["sent"] += sent
+        return sent
+
+    def _retry(self, alert, now):
+        entry = self.entries.get(alert.notification_id)
+        if entry is None:
+            return
+        entry.armed = True
+        entry.version += 1
+        heapq.heappush(self.heap, (now + RETRY_SECONDS, next(self._seq), alert.notification_id, entry.version))
+
+    def tick(self, now=None):
+        """ One round: sync subscriptions, re-score moved buses' routes, send what is due. Returns alerts sent. """
+        now = time.time() if now is None else now
+        self.sync(now)
+        self.update_positions(now)
+        return self.dispatch(now)
@@ -0,0 +1,59 @@
+"""
+search_routes result cache.
+
+Entries are keyed by the normalized query plus the current network version,
+so a bump (see routes/network_version.py) invalidates every entry at once
+without having to find and delete them; old entries simply age out.
+Hit/miss counters are kept in the cache too, so they add up across workers.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .network_version import get_version
+from .text import normalize
+
+CACHE_TIMEOUT = getattr(settings, 'ROUTE_SEARCH_CACHE_TIMEOUT', 300)
+HITS_KEY = 'routes:search_cache:hits'
+MISSES_KEY = 'routes:search_cache:misses'
+
+
+def make_key(*parts):
+    raw = '|'.join(normalize(str(p)) for p in parts)
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return f"routes:search:v{get_version()}:{digest}"
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def get(key):
+    data = cache.get(key)
+    _count(MISSES_KEY if data is None else HITS_KEY)
+    return data
+
+
+def set(key, data):
+    cache.set(key, data, CACHE_TIMEOUT)
+
+
+def stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+        "network_version": get_version(),
+    }
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
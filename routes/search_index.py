@@ -0,0 +1,130 @@
+"""
+In-process stop-sequence index for search_routes.
+
+Maps every normalized location name to a postings list of
+(route_id, position) pairs sorted by route_id. The route's start location
+is position 0, its stops keep their stop_number and the end location is
+position N (one past the last stop). A from/to search is then a merge of
+two postings lists with a position check, no SQL LIKE scans.
+
+Like the icontains lookup it replaces, a query matches every name that
+contains it ("Kozhikode" finds "Kozhikode Beach" too). Candidate names come
+from an index of every 1- to 3-character substring of the vocabulary, so
+matching never scans all names.
+
+The index is built lazily on first use and marked stale by the signals in
+routes/signals.py whenever a Route, RouteStop or Location changes.
+"""
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+
+from .lazy_index import LazyIndex
+from .network_version import get_version
+from .text import normalize
+
+logger = logging.getLogger(__name__)
+
+# Fallback upper bound (seconds) on index age, for when the shared network
+# version can't see writes made by other workers (per-process cache backend).
+INDEX_MAX_AGE = getattr(settings, 'ROUTE_SEARCH_INDEX_MAX_AGE', 60)
+
+
+def grams(key, n=3):
+    """ Substrings of `key` of length n, or of its whole length if shorter. """
+    n = min(n, len(key))
+    return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+
+class StopSequenceIndex:
+    def __init__(self, postings):
+        # { normalized_name: [(route_id, position), ...] sorted by route_id }
+        self.postings = postings
+        self.keys = list(postings.keys())
+        # gram -> indexes into self.keys, ascending; grams of 1-3 characters so short queries are covered too
+        self.grams = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            for gram in grams(key, 1) | grams(key, 2) | grams(key, 3):
+                self.grams[gram].append(i)
+
+    @classmethod
+    def build(cls):
+        from .models import Route, RouteStop
+
+        raw = defaultdict(list)
+        last_stop = defaultdict(int)
+
+        for route_id, loc_name, stop_number in RouteStop.objects.values_list('route_id', 'location__name', 'stop_number'):
+            raw[normalize(loc_name)].append((route_id, stop_number))
+            if stop_number > last_stop[route_id]:
+                last_stop[route_id] = stop_number
+
+        for route_id, start, end in Route.objects.values_list('id', 'start_location', 'end_location'):
+            raw[normalize(start)].append((route_id, 0))
+            raw[normalize(end)].append((route_id, last_stop[route_id] + 1))
+
+        postings = {key: sorted(entries) for key, entries in raw.items()}
+        logger.info(f"Built stop-sequence index: {len(postings)} locations")
+        return cls(postings)
+
+    def _postings_for(self, query):
+        """ Postings of every key containing the query (an exact hit included). """
+        key = normalize(query)
+        if not key:
+            return []
+        lists = [self.grams.get(gram) for gram in grams(key)]
+        if any(candidates is None for candidates in lists):
+            return []
+        # Walk the rarest gram's keys and verify the substring directly
+        return [self.postings[self.keys[i]] for i in min(lists, key=len) if key in self.keys[i]]
+
+    @staticmethod
+    def _collapse(lists, pick):
+        """ Merge postings lists into one (route_id, position) entry per route, sorted by route_id. """
+        if len(lists) == 1:
+            merged = lists[0]
+        else:
+            merged = sorted(entry for plist in lists for entry in plist)
+
+        collapsed = []
+        for route_id, position in merged:
+            if collapsed and collapsed[-1][0] == route_id:
+                collapsed[-1] = (route_id, pick(collapsed[-1][1], position))
+            else:
+                collapsed.append((route_id, position))
+        return collapsed
+
+    def search(self, from_query, to_query):
+        """ Return route ids (ascending) where `from` is served strictly before `to`. """
+        from_list = self._collapse(self._postings_for(from_query), min)
+        if not from_list:
+            return []
+        to_list = self._collapse(self._postings_for(to_query), max)
+
+        # Sorted-postings merge
+        result = []
+        i = j = 0
+        while i < len(from_list) and j < len(to_list):
+            from_route, from_pos = from_list[i]
+            to_route, to_pos = to_list[j]
+            if from_route < to_route:
+                i += 1
+            elif from_route > to_route:
+                j += 1
+            else:
+                if from_pos < to_pos:
+                    result.append(from_route)
+                i += 1
+                j += 1
+        return result
+
+
+_index = LazyIndex(StopSequenceIndex.build, max_age=INDEX_MAX_AGE, version=get_version)
+
+get_index = _index.get
+invalidate = _index.invalidate
+
+
+def search_route_ids(from_query, to_query):
+    return get_index().search(from_query, to_query)
@@ -0,0 +1,251 @@
+"""
+Learned stop-to-stop travel times for ETAs.
+
+Training (manage.py train_segment_times, nightly):
+  1. Read the raw location history since the last run (plus a short
+     lookback, so a trip that straddles the watermark is still paired up).
+  2. Per bus, label every fix with the stop of the bus's routes it is within
+     SEGMENT_ARRIVAL_RADIUS_M of (vectorized, chunk by chunk) and collapse
+     runs into arrivals: (location, first time seen).
+  3. Consecutive arrivals A -> B where B directly follows A on one of the
+     bus's routes give one sample, bucketed by A's local weekday and hour.
+  4. Samples are merged into SegmentTravelTime with Welford's parallel
+     update (count, mean, M2), so nothing already trained is re-read; the
+     weight of old data is capped at SEGMENT_MAX_WEIGHT so the mean follows
+     changing traffic.
+
+Serving: the whole table is loaded into one float32 array of shape
+(segments, 7 * 24) plus a {(from_id, to_id): row} dict. Buckets with fewer
+than SEGMENT_MIN_SAMPLES samples fall back to the segment's all-hours mean,
+and to NaN (= use distance / speed) when that is thin too, so a lookup is a
+dict probe and an array read per segment.
+"""
+import itertools
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .geo_index import haversine_km
+from .lazy_index import LazyIndex
+from .network_version import get_version, bump_version
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'routes:segment_times_version'
+BUCKETS = 7 * 24
+ARRIVAL_RADIUS_KM = getattr(settings, 'SEGMENT_ARRIVAL_RADIUS_M', 75) / 1000
+MIN_SAMPLES = getattr(settings, 'SEGMENT_MIN_SAMPLES', 3)
+MAX_WEIGHT = getattr(settings, 'SEGMENT_MAX_WEIGHT', 500)
+MAX_SEGMENT_SECONDS = getattr(settings, 'SEGMENT_MAX_SECONDS', 3 * 60 * 60)
+LOOKBACK = timedelta(seconds=MAX_SEGMENT_SECONDS)
+SETTLE = timedelta(minutes=10)     # leave the newest fixes for the next run; they may still be in a buffer
+DISTANCE_CHUNK = 2000
+
+
+def bucket_of(when):
+    local = timezone.localtime(when)
+    return local.weekday() * 24 + local.hour
+
+
+# ----------------------------------------------------------------------
+# Serving
+
+class SegmentTimeTable:
+    def __init__(self, rows):
+        """ rows: iterable of (from_id, to_id, weekday, hour, samples, mean_seconds). """
+        per_segment = defaultdict(list)
+        for from_id, to_id, weekday, hour, samples, mean in rows:
+            per_segment[(from_id, to_id)].append((weekday * 24 + hour, samples, mean))
+
+        self.index = {}
+        self.seconds = np.full((len(per_segment), BUCKETS), np.nan, dtype=np.float32)
+        for row, (segment, buckets) in enumerate(per_segment.items()):
+            self.index[segment] = row
+            total = sum(n for _, n, _ in buckets)
+            if total >= MIN_SAMPLES:
+                self.seconds[row, :] = sum(n * mean for _, n, mean in buckets) / total
+            for bucket, samples, mean in buckets:
+                if samples >= MIN_SAMPLES:
+                    self.seconds[row, bucket] = mean
+
+    @classmethod
+    def build(cls):
+        from .models import SegmentTravelTime
+
+        table = cls(SegmentTravelTime.objects.values_list(
+            'from_location_id', 'to_location_id', 'weekday', 'hour', 'samples', 'mean_seconds'
+        ).iterator(chunk_size=10000))
+        logger.info(f"Loaded learned travel times for {len(table.index)} segments")
+        return table
+
+    def lookup(self, segments, when):
+        """ Seconds for each (from_id, to_id) at `when`; NaN where nothing was learned. """
+        rows = np.fromiter((self.index.get(s, -1) for s in segments), dtype=np.int64, count=len(segments))
+        out = np.full(len(segments), np.nan)
+        known = rows >= 0
+        out[known] = self.seconds[rows[known], bucket_of(when)]
+        return out
+
+
+_table = LazyIndex(
+    SegmentTimeTable.build,
+    max_age=getattr(settings, 'SEGMENT_TIMES_MAX_AGE', 3600),
+    version=lambda: get_version(VERSION_KEY),
+)
+
+get_table = _table.get
+
+
+def segment_seconds(segments, when=None):
+    return get_table().lookup(segments, when or timezone.now())
+
+
+# ----------------------------------------------------------------------
+# Training
+
+def detect_arrivals(stamps, lats, lngs, stop_ids, stop_lats, stop_lngs, radius_km=ARRIVAL_RADIUS_KM):
+    """
+    Fixes of one bus (epoch seconds, sorted) -> [(location_id, epoch seconds)]:
+    the first fix of every run of fixes near the same stop.
+    """
+    if not len(stamps) or not len(stop_ids):
+        return []
+    labels = np.full(len(stamps), -1, dtype=np.int64)
+    for lo in range(0, len(stamps), DISTANCE_CHUNK):
+        hi = lo + DISTANCE_CHUNK
+        # (fixes x stops) distance matrix for this chunk
+        distances = haversine_km(lats[lo:hi, None], lngs[lo:hi, None], stop_lats[None, :], stop_lngs[None, :])
+        nearest = np.argmin(distances, axis=1)
+        close = distances[np.arange(len(nearest)), nearest] <= radius_km
+        labels[lo:hi][close] = nearest[close]
+
+    near = np.flatnonzero(labels >= 0)
+    if not len(near):
+        return []
+    runs = near[np.diff(labels[near], prepend=-2) != 0]
+    return list(zip(stop_ids[labels[runs]].tolist(), stamps[runs].tolist()))
+
+
+def _bus_segments(bus_ids):
+    """ {bus_id: ({(from_id, to_id)}, stop ids, lats, lngs)} from the buses' current routes. """
+    from .models import Location, Route, RouteStop
+
+    routes = list(Route.objects.filter(bus_id__in=bus_ids).values_list('id', 'bus_id', 'start_location', 'end_location'))
+    names = {name for _, _, start, end in routes for name in (start, end)}
+    by_name = {name: (loc_id, lat, lng) for loc_id, name, lat, lng in Location.objects.filter(name__in=names).values_list('id', 'name', 'latitude', 'longitude')}
+    stops = defaultdict(list)
+    for route_id, loc_id, lat, lng in RouteStop.objects.filter(route_id__in=[r[0] for r in routes]).order_by('route_id', 'stop_number').values_list(
+        'route_id', 'location_id', 'location__latitude', 'location__longitude'
+    ):
+        stops[route_id].append((loc_id, lat, lng))
+
+    per_bus = defaultdict(lambda: (set(), {}))
+    for route_id, bus_id, start, end in routes:
+        vertices = [by_name.get(start), *stops[route_id], by_name.get(end)]
+        vertices = [v for v in vertices if v and v[1] is not None and v[2] is not None]
+        segments, coords = per_bus[bus_id]
+        for (a, *_), (b, *_) in zip(vertices, vertices[1:]):
+            segments.add((a, b))
+        coords.update({v[0]: (float(v[1]), float(v[2])) for v in vertices})
+
+    result = {}
+    for bus_id, (segments, coords) in per_bus.items():
+        ids = np.array(list(coords), dtype=np.int64)
+        result[bus_id] = (segments, ids, np.array([coords[i][0] for i in ids]), np.array([coords[i][1] for i in ids]))
+    return result
+
+
+def collect_samples(since, until):
+    """ {(from_id, to_id, weekday, hour): [seconds]} for arrivals at B in (since, until]. """
+    from .models import BusLocationFix
+
+    fixes = BusLocationFix.objects.filter(recorded_at__lt=until)
+    if since is not None:
+        fixes = fixes.filter(recorded_at__gte=since - LOOKBACK)
+    bus_ids = list(fixes.values_list('bus_id', flat=True).distinct())
+    geometry = _bus_segments(bus_ids)
+    since_ts = since.timestamp() if since is not None else float('-inf')
+
+    samples = defaultdict(list)
+    rows = fixes.order_by('bus_id', 'recorded_at').values_list('bus_id', 'recorded_at', 'latitude', 'longitude').iterator(chunk_size=10000)
+    for bus_id, bus_rows in itertools.groupby(rows, key=lambda r: r[0]):
+        if bus_id not in geometry:
+            continue
+        segments, stop_ids, stop_lats, stop_lngs = geometry[bus_id]
+        bus_rows = list(bus_rows)
+        stamps = np.array([r[1].timestamp() for r in bus_rows])
+        lats = np.array([r[2] for r in bus_rows])
+        lngs = np.array([r[3] for r in bus_rows])
+
+        arrivals = detect_arrivals(stamps, lats, lngs, stop_ids, stop_lats, stop_lngs)
+        for (a, ta), (b, tb) in zip(arrivals, arrivals[1:]):
+            elapsed = tb - ta
+            if (a, b) in segments and tb > since_ts and 0 < elapsed <= MAX_SEGMENT_SECONDS:
+                local = timezone.localtime(datetime.fromtimestamp(ta, tz=dt_timezone.utc))
+                samples[(a, b, local.weekday(), local.hour)].append(elapsed)
+    return samples
+
+
+def merge(existing, new_values):
+    """ Welford/Chan merge of (samples, mean, m2) with a batch of values; old weight capped at MAX_WEIGHT. """
+    n_a, mean_a, m2_a = existing
+    values = np.asarray(new_values, dtype=np.float64)
+    n_b = len(values)
+    mean_b = float(values.mean())
+    m2_b = float(((values - mean_b) ** 2).sum())
+
+    capped = min(n_a, max(MAX_WEIGHT - n_b, 0))
+    if capped < n_a:
+        m2_a = m2_a * capped / n_a if n_a else 0.0
+        n_a = capped
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta * delta * n_a * n_b / n
+
+
+def train(until=None, full=False):
+    """ Learn from history recorded since the last run (all raw history if `full`). Returns the sample count. """
+    from .models import SegmentTravelTime, SegmentTrainingRun
+
+    until = until or timezone.now() - SETTLE
+    last = None if full else SegmentTrainingRun.objects.order_by('-trained_through').first()
+    since = last.trained_through if last else None
+
+    samples = collect_samples(since, until)
+    count = sum(len(v) for v in samples.values())
+
+    with transaction.atomic():
+        if full:
+            SegmentTravelTime.objects.all().delete()
+        existing = {}
+        keys = list(samples)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            pairs = {(a, b) for a, b, _, _ in chunk}
+            for row in SegmentTravelTime.objects.select_for_update().filter(
+                from_location_id__in={a for a, _ in pairs}, to_location_id__in={b for _, b in pairs}
+            ):
+                existing[(row.from_location_id, row.to_location_id, row.weekday, row.hour)] = row
+
+        to_update, to_create = [], []
+        for key, values in samples.items():
+            row = existing.get(key)
+            if row is None:
+                row = SegmentTravelTime(from_location_id=key[0], to_location_id=key[1], weekday=key[2], hour=key[3])
+                to_create.append(row)
+            else:
+                to_update.append(row)
+            row.samples, row.mean_seconds, row.m2 = merge((row.samples, row.mean_seconds, row.m2), values)
+        SegmentTravelTime.objects.bulk_create(to_create, batch_size=1000)
+        SegmentTravelTime.objects.bulk_update(to_update, ['samples', 'mean_seconds', 'm2'], batch_size=1000)
+        SegmentTrainingRun.objects.create(trained_through=until, samples=count)
+
+    bump_version(key=VERSION_KEY)
+    _table.invalidate()
+    logger.info(f"Segment travel times: {count} samples over {len(samples)} buckets ({len(to_create)} new)")
+    return count
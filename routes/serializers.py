@@ -1,4 +1,6 @@
 from rest_framework import serializers
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from .models import Route, Trip, RouteStop, RouteTemplate,BusLiveLocation
 import logging
 
@@ -18,6 +20,23 @@ class TripSerializer(serializers.ModelSerializer):
         model = Trip
         fields = ['start_time', 'end_time']
 
+class RouteListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Resolve coordinates for every start/end name in the batch with ONE query
+        from .models import Location
+        routes = data.all() if hasattr(data, 'all') else data
+        names = {name for r in routes for name in (r.start_location, r.end_location)}
+
+        coords = self.context.setdefault('location_coords', {})
+        missing = names - coords.keys()
+        if missing:
+            coords.update({name: (None, None) for name in missing})
+            for name, lat, lng in Location.objects.filter(name__in=missing).values_list('name', 'latitude', 'longitude'):
+                coords[name] = (lat, lng)
+
+        return super().to_representation(routes)
+
+
 class RouteSerializer(serializers.ModelSerializer):
     trips = TripSerializer(many=True)
     stops = serializers.ListField(child=serializers.DictField(), write_only=True, required=False)
@@ -39,27 +58,33 @@ class RouteSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Route
+        list_serializer_class = RouteListSerializer
         fields = ['id', 'bus_name', 'bus_reg_number', 'start_location', 'end_location', 'via', 'trips', 'stops', 'stop_list', 'is_booking_open', 'effective_status', 'crowd_status', 'start_location_data', 'end_location_data', 'start_lat', 'start_lng', 'end_lat', 'end_lng']
 
+    def _coords(self, name):
+        """
+        (lat, lng) for a start/end location name. RouteListSerializer preloads
+        every name in the batch with one query; a single route falls back to
+        one lookup per name.
+        """
+        coords = self.context.setdefault('location_coords', {})
+        if name not in coords:
+            from .models import Location
+            loc = Location.objects.filter(name=name).only('latitude', 'longitude').first()
+            coords[name] = (loc.latitude, loc.longitude) if loc else (None, None)
+        return coords[name]
+
     def get_start_lat(self, obj):
-        from .models import Location
-        loc = Location.objects.filter(name=obj.start_location).first()
-        return loc.latitude if loc else None
+        return self._coords(obj.start_location)[0]
 
     def get_start_lng(self, obj):
-        from .models import Location
-        loc = Location.objects.filter(name=obj.start_location).first()
-        return loc.longitude if loc else None
+        return self._coords(obj.start_location)[1]
 
     def get_end_lat(self, obj):
-        from .models import Location
-        loc = Location.objects.filter(name=obj.end_location).first()
-        return loc.latitude if loc else None
+        return self._coords(obj.end_location)[0]
 
     def get_end_lng(self, obj):
-        from .models import Location
-        loc = Location.objects.filter(name=obj.end_location).first()
-        return loc.longitude if loc else None
+        return self._coords(obj.end_location)[1]
 
     def create(self, validated_data):
         trips_data = validated_data.pop('trips')
@@ -70,105 +95,121 @@ class RouteSerializer(serializers.ModelSerializer):
         start_name = validated_data.get('start_location')
         end_name = validated_data.get('end_location')
         via_name = validated_data.get('via')
-        
-        # 1. Ensure Start/End Locations exist in DB (for search ability)
-        from .models import Location, RouteTemplate, TemplateStop 
-        start_loc_obj, _ = Location.objects.get_or_create(name=start_name)
-        if start_loc_data:
-            start_loc_obj.latitude = start_loc_data.get('lat', start_loc_obj.latitude)
-            start_loc_obj.longitude = start_loc_data.get('lon', start_loc_obj.longitude)
-            start_loc_obj.district = start_loc_data.get('district', start_loc_obj.district)
-            start_loc_obj.state = start_loc_data.get('state', start_loc_obj.state)
-            start_loc_obj.save()
-
-        end_loc_obj, _ = Location.objects.get_or_create(name=end_name)
-        if end_loc_data:
-            end_loc_obj.latitude = end_loc_data.get('lat', end_loc_obj.latitude)
-            end_loc_obj.longitude = end_loc_data.get('lon', end_loc_obj.longitude)
-            end_loc_obj.district = end_loc_data.get('district', end_loc_obj.district)
-            end_loc_obj.state = end_loc_data.get('state', end_loc_obj.state)
-            end_loc_obj.save()
+
+        from .models import RouteTemplate, TemplateStop
+        from .signals import route_network_changed
+        from . import template_cache
 
         # Log the action (Info Level)
         logger.info(f"Creating Route: {start_name} -> {end_name} (Via: {via_name})")
 
-        # 2. Create Route
-        route = Route.objects.create(**validated_data)
-
-        # 3. Create Trips
-        for trip in trips_data:
-            Trip.objects.create(route=route, **trip)
-
-        # 4. AUTO-ASSIGN STOPS (Business Logic)
-        try:
-            # A. Check Direct Match
-            template = RouteTemplate.objects.get(
-                start_location__name__iexact=start_name,
-                end_location__name__iexact=end_name,
-                via__iexact=via_name 
-            )
-            logger.info(f"Found Template ID {template.id}. Copying stops...")
-            
-            stops = template.stops.all()
-            for t_stop in stops:
-                RouteStop.objects.create(route=route, location=t_stop.location, stop_number=t_stop.stop_number)
-
-        except RouteTemplate.DoesNotExist:
-            logger.info("Direct Template NOT found. Checking Reverse...")
-            try:
-                # B. Check Reverse Match
-                reverse_template = RouteTemplate.objects.get(
-                    start_location__name__iexact=end_name,
-                    end_location__name__iexact=start_name,
-                    via__iexact=via_name 
-                )
-                logger.info(f"Found Reverse Template ID {reverse_template.id}. Reversing stops...")
-                
-                original_stops = list(reverse_template.stops.all())
+        # Everything below is one transaction: an error leaves no half-built route behind
+        with transaction.atomic():
+            # 1. Find a template (direct or reverse): one indexed probe, or a cache hit
+            template, is_reverse = template_cache.find_template(start_name, end_name, via_name)
+
+            # 2. Upsert Start/End Locations (and the new stops when learning) in one batch
+            location_data = {start_name: start_loc_data, end_name: end_loc_data}
+            if template is None:
+                for stop_info in stops_data:
+                    if stop_info.get('name'):
+                        location_data.setdefault(stop_info['name'], {}).update(stop_info)
+            locations = upsert_locations(location_data)
+
+            # 3. Create Route + Trips
+            route = Route.objects.create(**validated_data)
+            Trip.objects.bulk_create([Trip(route=route, **trip) for trip in trips_data])
+
+            # 4. AUTO-ASSIGN STOPS (Business Logic)
+            if template and not is_reverse:
+                # A. Direct Match
+                logger.info(f"Found Template ID {template.id}. Copying stops...")
+                RouteStop.objects.bulk_create([
+                    RouteStop(route=route, location_id=location_id, stop_number=number)
+                    for number, location_id, _ in template.stops
+                ])
+
+            elif template:
+                # B. Reverse Match
+                logger.info(f"Found Reverse Template ID {template.id}. Reversing stops...")
                 # Assign stops in reverse order
-                for index, t_stop in enumerate(reversed(original_stops)):
-                    RouteStop.objects.create(route=route, location=t_stop.location, stop_number=index + 1)
+                RouteStop.objects.bulk_create([
+                    RouteStop(route=route, location_id=location_id, stop_number=index + 1)
+                    for index, (_, location_id, _) in enumerate(reversed(template.stops))
+                ])
 
-            except RouteTemplate.DoesNotExist:
+            else:
                 # C. NO TEMPLATE FOUND -> CREATE NEW ONE (LEARNING)
                 logger.info(f"No template found. Learning new route: {start_name} -> {end_name}")
-                
+
                 # Determine the user creating the template
                 bus_details = validated_data.get('bus')
-                creator_user = bus_details.user if bus_details else None
+                creator_user_id = bus_details.user_id if bus_details else None
 
                 # Always create a new template for this path
                 new_template = RouteTemplate.objects.create(
-                    start_location=start_loc_obj,
-                    end_location=end_loc_obj,
+                    start_location=locations[start_name],
+                    end_location=locations[end_name],
                     via=via_name,
-                    created_by=creator_user
+                    created_by_id=creator_user_id
                 )
-                
-                if stops_data:
-                    for index, stop_info in enumerate(stops_data):
-                        # Get/Create Location for Stop
-                        stop_name = stop_info.get('name')
-                        if not stop_name: continue
-                        loc_obj, _ = Location.objects.get_or_create(name=stop_name)
-                        
-                        loc_obj.latitude = stop_info.get('lat', loc_obj.latitude)
-                        loc_obj.longitude = stop_info.get('lon', loc_obj.longitude)
-                        loc_obj.district = stop_info.get('district', loc_obj.district)
-                        loc_obj.state = stop_info.get('state', loc_obj.state)
-                        loc_obj.save()
-                        
-                        # Create RouteStop (For this specific bus route)
-                        RouteStop.objects.create(route=route, location=loc_obj, stop_number=index + 1)
-                        
-                        # Create TemplateStop (For future re-use)
-                        TemplateStop.objects.create(template=new_template, location=loc_obj, stop_number=index + 1)
-                        
+
+                route_stops = []
+                template_stops = []
+                for index, stop_info in enumerate(stops_data):
+                    stop_name = stop_info.get('name')
+                    if not stop_name: continue
+                    loc_obj = locations[stop_name]
+                    # RouteStop (For this specific bus route) + TemplateStop (For future re-use)
+                    route_stops.append(RouteStop(route=route, location=loc_obj, stop_number=index + 1))
+                    template_stops.append(TemplateStop(template=new_template, location=loc_obj, stop_number=index + 1))
+                RouteStop.objects.bulk_create(route_stops)
+                TemplateStop.objects.bulk_create(template_stops)
+
                 logger.info(f"Created new RouteTemplate ID {new_template.id} with {len(stops_data)} stops.")
 
+            # bulk_create sends no signals
+            route_network_changed(locations=True)
+
+        # Serve the response from memory instead of one query per stop
+        prefetch_related_objects([route], 'stops__location', 'trips')
         return route
 
 
+LOCATION_FIELDS = {'lat': 'latitude', 'lon': 'longitude', 'district': 'district', 'state': 'state'}
+
+
+def upsert_locations(location_data):
+    """
+    Batched get_or_create + update for Locations.
+    location_data: { name: {'lat', 'lon', 'district', 'state'} (any subset) }.
+    Keys present in the dict overwrite the stored value, like the old per-row save().
+    Returns { name: Location }.
+    """
+    from .models import Location
+
+    names = [name for name in location_data if name]
+    existing = {loc.name: loc for loc in Location.objects.filter(name__in=names)}
+
+    missing = [name for name in names if name not in existing]
+    if missing:
+        Location.objects.bulk_create([Location(name=name) for name in missing], ignore_conflicts=True)
+        # Re-read: not every backend returns primary keys from bulk_create
+        existing.update({loc.name: loc for loc in Location.objects.filter(name__in=missing)})
+
+    changed = set()
+    for name in names:
+        loc = existing[name]
+        for key, field in LOCATION_FIELDS.items():
+            if key in location_data[name] and getattr(loc, field) != location_data[name][key]:
+                setattr(loc, field, location_data[name][key])
+                changed.add(loc)
+    if changed:
+        Location.objects.bulk_update(changed, list(LOCATION_FIELDS.values()))
+
+    return existing
+
+
 # =================eta=============
 class BusLiveLocationSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,102 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from accounts.models import BusDetails
+from .models import Route, RouteStop, Trip, Location, RouteTemplate, TemplateStop, BusLiveLocation
+from . import search_index, suggestions, journey_planner, departures, geo_index, template_cache, eta, live_push, live_state, fleet_index, stop_events
+from .network_version import bump_version, bump_template_version
+
+# BusDetails fields that appear in search results
+BUS_SEARCH_FIELDS = ('bus_name', 'reg_number', 'crowd_status', 'is_booking_open')
+
+
+def bump_network_version():
+    bump_version()
+    # And again once committed, so nothing another worker rebuilt from
+    # pre-commit data survives under the new version
+    transaction.on_commit(bump_version)
+
+
+def route_network_changed(locations=False):
+    """
+    Drop this worker's route-network indexes and move the shared network
+    version. Called by the receivers below, and directly by bulk writes
+    (bulk_create / update()) that don't send model signals.
+    """
+    search_index.invalidate()
+    journey_planner.invalidate()
+    departures.invalidate()
+    eta.invalidate()
+    stop_events.invalidate()
+    live_state.invalidate()
+    live_push.invalidate()
+    if locations:
+        # Autocomplete and the nearby-stops grid only index Location rows
+        suggestions.invalidate()
+        geo_index.invalidate()
+    bump_network_version()
+
+
+def route_templates_changed():
+    """ Same as route_network_changed, for the template cache (bulk writers call it directly). """
+    template_cache.invalidate()
+    bump_template_version()
+    transaction.on_commit(bump_template_version)
+
+
+@receiver([post_save, post_delete], sender=Route)
+@receiver([post_save, post_delete], sender=RouteStop)
+@receiver([post_save, post_delete], sender=Trip)
+def on_route_network_change(sender, **kwargs):
+    route_network_changed()
+
+
+@receiver([post_save, post_delete], sender=Location)
+def on_location_change(sender, **kwargs):
+    route_network_changed(locations=True)
+
+
+@receiver([post_save, post_delete], sender=RouteTemplate)
+@receiver([post_save, post_delete], sender=TemplateStop)
+def on_template_change(sender, **kwargs):
+    route_templates_changed()
+
+
+@receiver([post_save, post_delete], sender=BusLiveLocation)
+def on_live_location_change(sender, instance, **kwargs):
+    # The ingest path upserts without signals; this is for direct writes (admin, shell)
+    live_state.forget(instance.bus_id)
+    if kwargs.get('signal') is post_delete:
+        fleet_index.invalidate()
+
+
+@receiver(post_init, sender=Location)
+def remember_location_name(sender, instance, **kwargs):
+    instance._saved_name = instance.__dict__.get('name')
+
+
+@receiver(post_save, sender=Location)
+def rekey_templates_on_rename(sender, instance, created, **kwargs):
+    # Template lookup keys embed the location names, and cached via lists the names of every stop
+    if not created and instance.name != instance._saved_name:
+        for template in RouteTemplate.objects.filter(Q(start_location=instance) | Q(end_location=instance)).select_related('start_location', 'end_location'):
+            template.save(update_fields=['lookup_key', 'pair_key'])
+        route_templates_changed()
+    instance._saved_name = instance.name
+
+
+# Read from __dict__ so deferred fields never trigger a query
+@receiver(post_init, sender=BusDetails)
+def remember_bus_search_fields(sender, instance, **kwargs):
+    instance._search_fields = tuple(instance.__dict__.get(f) for f in BUS_SEARCH_FIELDS)
+
+
+@receiver(post_save, sender=BusDetails)
+def bump_on_bus_change(sender, instance, created, **kwargs):
+    # Earnings updates on every ticket scan must not flush the search cache
+    current = tuple(instance.__dict__.get(f) for f in BUS_SEARCH_FIELDS)
+    if not created and current != getattr(instance, '_search_fields', None):
+        bump_network_version()
+    instance._search_fields = current
@@ -0,0 +1,185 @@
+"""
+Stop arrivals and departures, detected from the live GPS stream.
+
+Every fix that reaches routes/live_ingest.ingest (update_bus_location and
+the batched upload) is run through a small tracker per (bus, route): the
+stop the bus is inside, if any, and the next stop it is expected at. Only
+that stop and the next STOP_EVENTS_LOOKAHEAD stops are tested, against
+fences precomputed per route from its geometry (routes/eta.py), so a fix
+costs the same on a 5-stop route as on a 200-stop one. The route polyline is
+searched only on a cold start, to place a bus seen for the first time.
+
+  arrival    the bus came within STOP_EVENTS_ENTER_M of the stop
+  departure  it then left STOP_EVENTS_EXIT_M (wider, so GPS jitter at a stop
+             doesn't read as leaving and coming back); carries the dwell time
+
+A stop with no fix inside its fence (a fast pass, a gap in reporting) is
+skipped once the bus is nearer the following stop than that stop itself
+is. After leaving the last stop the tracker starts over at the first one;
+so it does too when the bus came within STOP_EVENTS_TERMINUS_M of the last
+stop without entering its fence (it turned or parked short of it) and is
+now heading away from it.
+
+Tracker state lives in Django's cache next to the live state
+(routes/live_state.py), so every worker sees the same trackers. Events are
+sent as one batch per ingest through the `stop_arrivals` signal, for ETA
+correction, notifications and analytics to connect to.
+"""
+import logging
+import math
+from collections import defaultdict
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
+
+from . import eta, live_state
+from .geo_index import KM_PER_DEGREE
+from .lazy_index import VersionedCache
+from .network_version import get_version
+
+logger = logging.getLogger(__name__)
+
+ENTER_KM = getattr(settings, 'STOP_EVENTS_ENTER_M', 50) / 1000
+EXIT_KM = getattr(settings, 'STOP_EVENTS_EXIT_M', 100) / 1000
+LOOKAHEAD = getattr(settings, 'STOP_EVENTS_LOOKAHEAD', 3)
+TERMINUS_KM = getattr(settings, 'STOP_EVENTS_TERMINUS_M', 500) / 1000
+
+# sender=StopArrival, events=[StopArrival, ...] in the order they happened per bus
+stop_arrivals = Signal()
+
+stats = {"fixes": 0, "stale": 0, "cold_starts": 0, "arrivals": 0, "departures": 0, "skipped": 0}
+
+
+class StopArrival(NamedTuple):
+    bus_id: int
+    route_id: int
+    stop_number: int
+    stop_name: str
+    event: str                  # 'arrival' or 'departure'
+    at: float                   # epoch seconds of the fix
+    dwell_seconds: float        # departures only, else None
+
+
+class Tracker(NamedTuple):
+    next: int                   # index of the next fenced stop expected
+    at: int                     # index of the stop the bus is inside, or None
+    arrived_at: float           # when it entered `at`
+    seen_at: float              # newest fix applied
+    closest: float = None       # closest approach (km) to the last stop while expecting it
+
+
+class StopFences:
+    """ A route's stops with coordinates, in travel order, as plain floats in the route's local plane (km). """
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        located = geometry.located.tolist()
+        self.stops = [(geometry.stop_numbers[i], geometry.names[i]) for i in located]
+        self.kx = getattr(geometry, '_kx', 0.0)
+        self.xs = geometry.xs.tolist() if located else []
+        self.ys = geometry.ys.tolist() if located else []
+        self.gaps = [math.hypot(self.xs[k + 1] - self.xs[k], self.ys[k + 1] - self.ys[k]) for k in range(len(located) - 1)]
+
+    def __len__(self):
+        return len(self.stops)
+
+    def _distance(self, k, x, y):
+        return math.hypot(self.xs[k] - x, self.ys[k] - y)
+
+    def locate(self, lat, lng, stamp):
+        """ Cold start: a tracker for a bus first seen at (lat, lng), expecting the nearest stop not yet behind it. """
+        stats["cold_starts"] += 1
+        projection = self.geometry.project(lat, lng)
+        progress = projection.progress_km if projection else 0.0
+        k = int(np.searchsorted(self.geometry.cumulative, progress - ENTER_KM))
+        return Tracker(min(k, len(self) - 1), None, None, stamp - 1)
+
+    def step(self, tracker, lat, lng, stamp):
+        """ Apply one fix. Returns (tracker, [(event, stop index, dwell seconds)]). """
+        x, y = lng * self.kx, lat * KM_PER_DEGREE
+        nxt, at, arrived_at = tracker.next, tracker.at, tracker.arrived_at
+        found = []
+        if at is not None:
+            if self._distance(at, x, y) <= EXIT_KM:
+                return tracker._replace(seen_at=stamp), found
+            found.append(('departure', at, stamp - arrived_at))
+            at = arrived_at = None
+            if nxt >= len(self):
+                nxt = 0
+
+        for k in range(nxt, min(nxt + LOOKAHEAD, len(self))):
+            distance = self._distance(k, x, y)
+            if distance <= ENTER_KM:
+                found.append(('arrival', k, None))
+                nxt, at, arrived_at = k + 1, k, stamp
+                break
+            if k + 1 < len(self) and distance > EXIT_KM and self._distance(k + 1, x, y) < self.gaps[k]:
+                # Past stop k without a fix inside its fence
+                stats["skipped"] += 1
+                nxt = k + 1
+                continue
+            break
+
+        closest = None
+        if at is None and nxt == len(self) - 1:
+            distance = self._distance(nxt, x, y)
+            closest = distance if tracker.closest is None or tracker.next != nxt else min(tracker.closest, distance)
+            if closest <= TERMINUS_KM and distance - closest > EXIT_KM:
+                # Turned back short of the terminus fence: the trip is over all the same
+                stats["skipped"] += 1
+                nxt, closest = 0, None
+        return Tracker(nxt, at, arrived_at, stamp, closest), found
+
+
+_fences = VersionedCache(eta.CACHE_SIZE, version=get_version)
+invalidate = _fences.invalidate
+
+
+def get_fences(route_id):
+    return _fences.get(route_id, lambda: StopFences(eta.get_geometry(route_id)))
+
+
+def _key(bus_id, route_id):
+    return f"routes:stops:{bus_id}:{route_id}"
+
+
+def observe(fixes):
+    """ Run fixes (any buses, any order) through the trackers of their buses' routes. Returns the StopArrivals sent. """
+    routes_of = live_state.get_route_buses().routes_of
+    by_bus = defaultdict(list)
+    for fix in fixes:
+        if fix.bus_id in routes_of:
+            by_bus[fix.bus_id].append(fix)
+    if not by_bus:
+        return []
+
+    keys = {(bus_id, route_id): _key(bus_id, route_id) for bus_id in by_bus for route_id in routes_of[bus_id]}
+    stored = cache.get_many(list(keys.values()))
+    updates, events = {}, []
+    for (bus_id, route_id), key in keys.items():
+        fences = get_fences(route_id)
+        if len(fences) < 2:
+            continue
+        tracker = stored.get(key)
+        for fix in sorted(by_bus[bus_id], key=lambda f: f.recorded_at):
+            stamp = fix.recorded_at.timestamp()
+            stats["fixes"] += 1
+            if tracker is None:
+                tracker = fences.locate(fix.latitude, fix.longitude, stamp)
+            elif stamp <= tracker.seen_at:
+                stats["stale"] += 1
+                continue
+            tracker, found = fences.step(tracker, fix.latitude, fix.longitude, stamp)
+            for event, k, dwell in found:
+                stats[event + "s"] += 1
+                events.append(StopArrival(bus_id, route_id, *fences.stops[k], event, stamp, dwell))
+        if tracker is not None:
+            updates[key] = tracker
+    cache.set_many(updates, live_state.TIMEOUT)
+
+    if events:
+        stop_arrivals.send(sender=StopArrival, events=events)
+    return events
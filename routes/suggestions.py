@@ -0,0 +1,153 @@
+"""
+Autocomplete engine for get_location_suggestions.
+
+Built once per worker from Location (name + district) and kept fresh by the
+signals in routes/signals.py. Every location gets an integer rank (0 = most
+popular, popularity = number of routes serving it), so all posting lists
+below are naturally in rank order and "top N" is just "first N".
+
+Match tiers, in order:
+  1. the name starts with the query
+  2. a word in the name, or the district, starts with the query
+  3. the name contains the query (trigram candidates, verified)
+
+Tier 3 only runs for queries of three characters or more: one or two
+letters occur inside nearly every name, so short queries match prefixes
+only (the icontains lookup this replaced also matched them mid-name).
+"""
+import heapq
+import logging
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.models import Count
+
+from .lazy_index import LazyIndex
+from .text import normalize
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_LIMIT = 10
+# Prefixes up to this length get their top-N precomputed, longer ones are
+# resolved by a bisect range over the sorted key array.
+PRECOMPUTED_PREFIX_LEN = 3
+
+
+def trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+class _PrefixIndex:
+    """ Compact trie: sorted key array + precomputed top-N for short prefixes. """
+
+    def __init__(self, pairs, limit):
+        pairs.sort()
+        self.keys = [k for k, _ in pairs]
+        self.ids = [i for _, i in pairs]
+        self.limit = limit
+
+        top = defaultdict(list)
+        for key, rank in pairs:
+            for n in range(1, min(len(key), PRECOMPUTED_PREFIX_LEN) + 1):
+                top[key[:n]].append(rank)
+        self.top = {p: heapq.nsmallest(limit, set(ranks)) for p, ranks in top.items()}
+
+    def lookup(self, prefix):
+        if len(prefix) <= PRECOMPUTED_PREFIX_LEN:
+            return self.top.get(prefix, [])
+        lo = bisect_left(self.keys, prefix)
+        # Every key starting with `prefix` sorts before prefix + U+10FFFF
+        hi = bisect_left(self.keys, prefix + '\U0010ffff', lo)
+        return heapq.nsmallest(self.limit, set(self.ids[lo:hi]))
+
+
+class SuggestionEngine:
+    def __init__(self, rows, limit=SUGGESTION_LIMIT):
+        """ rows: iterable of (name, district, popularity). """
+        rows = sorted(rows, key=lambda r: (-r[2], r[0]))
+        self.names = [name for name, _, _ in rows]
+        self.limit = limit
+
+        name_pairs = []
+        word_pairs = []
+        grams = defaultdict(list)
+        for rank, (name, district, _) in enumerate(rows):
+            key = normalize(name)
+            name_pairs.append((key, rank))
+
+            words = key.split(' ')
+            for n in range(1, len(words)):
+                word_pairs.append((' '.join(words[n:]), rank))
+            if district:
+                word_pairs.append((normalize(district), rank))
+
+            for gram in trigrams(key):
+                grams[gram].append(rank)
+
+        self.keys = [key for key, _ in name_pairs]
+        self.name_prefix = _PrefixIndex(name_pairs, limit)
+        self.word_prefix = _PrefixIndex(word_pairs, limit)
+        # Appended in rank order, so already sorted
+        self.grams = dict(grams)
+
+    @classmethod
+    def build(cls):
+        from .models import Location, Route
+
+        served = Counter()
+        for start, end in Route.objects.values_list('start_location', 'end_location'):
+            served[normalize(start)] += 1
+            served[normalize(end)] += 1
+
+        rows = [
+            (name, district, stops + served[normalize(name)])
+            for name, district, stops in Location.objects.annotate(stops=Count('routestop')).values_list('name', 'district', 'stops')
+        ]
+        logger.info(f"Built suggestion engine: {len(rows)} locations")
+        return cls(rows)
+
+    def _contains(self, key, seen):
+        """ Yield ranks whose name contains `key`, in rank order. """
+        lists = [self.grams.get(g) for g in trigrams(key)]
+        if not lists or any(plist is None for plist in lists):
+            return
+        # Walk the rarest trigram's postings and verify the substring directly
+        for rank in min(lists, key=len):
+            if rank not in seen and key in self.keys[rank]:
+                yield rank
+
+    def suggest(self, query, limit=None):
+        limit = limit or self.limit
+        key = normalize(query)
+        if not key:
+            return []
+
+        picked = []
+        seen = set()
+
+        def take(ranks):
+            for rank in ranks:
+                if len(picked) >= limit:
+                    return
+                if rank not in seen:
+                    seen.add(rank)
+                    picked.append(rank)
+
+        take(self.name_prefix.lookup(key))
+        if len(picked) < limit:
+            take(self.word_prefix.lookup(key))
+        if len(picked) < limit and len(key) >= 3:
+            take(self._contains(key, seen))
+
+        return [self.names[rank] for rank in picked]
+
+
+_engine = LazyIndex(SuggestionEngine.build, max_age=getattr(settings, 'LOCATION_SUGGESTIONS_MAX_AGE', 300))
+
+get_engine = _engine.get
+invalidate = _engine.invalidate
+
+
+def suggest(query, limit=SUGGESTION_LIMIT):
+    return get_engine().suggest(query, limit)
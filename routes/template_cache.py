@@ -0,0 +1,134 @@
+"""
+In-process RouteTemplate cache for route creation and the via picker.
+
+Templates are looked up by their normalized keys (RouteTemplate.lookup_key /
+pair_key), so a miss costs one indexed probe (plus one query for the
+template stops) and a hit is a dict lookup. Entries are plain tuples rather
+than model instances, so they are safe to share between threads.
+
+The cache is bounded (LRU, TEMPLATE_CACHE_SIZE entries) and dropped whenever
+the shared template version moves; routes/signals.py bumps it on every
+RouteTemplate / TemplateStop change.
+
+The via picker's finished answers (deduplicated, stops in travel order) are
+additionally kept in Django's cache per unordered location pair, so every
+worker shares them. They are stored oriented from the pair's first name to
+its second and flipped on the way out for the other direction. The keys
+carry the template version, so a bump retires all of them at once;
+warm_vias() fills them for every known pair (manage.py warm_template_vias).
+"""
+import hashlib
+import itertools
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .lazy_index import VersionedCache
+from .network_version import get_template_version
+from .text import normalize
+
+MAX_ENTRIES = getattr(settings, 'TEMPLATE_CACHE_SIZE', 2048)
+VIAS_TIMEOUT = getattr(settings, 'TEMPLATE_VIAS_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+class CachedTemplate(NamedTuple):
+    id: int
+    lookup_key: str
+    pair_key: str
+    ascending: bool # the start's name sorts first, so stored order is the pair's order
+    via: str
+    stops: tuple    # ((stop_number, location_id, location name), ...) in stored order
+
+
+_cache = VersionedCache(MAX_ENTRIES, version=get_template_version)
+invalidate = _cache.invalidate
+
+
+def _load(**filters):
+    from .models import RouteTemplate, TemplateStop
+
+    rows = list(RouteTemplate.objects.filter(**filters).order_by('id').values_list(
+        'id', 'lookup_key', 'pair_key', 'start_location__name', 'end_location__name', 'via'
+    ))
+    stops = defaultdict(list)
+    if rows:
+        for template_id, number, location_id, name in TemplateStop.objects.filter(
+            template_id__in=[row[0] for row in rows]
+        ).order_by('stop_number').values_list('template_id', 'stop_number', 'location_id', 'location__name'):
+            stops[template_id].append((number, location_id, name))
+    return tuple(
+        CachedTemplate(t_id, key, pair, normalize(start) <= normalize(end), via, tuple(stops[t_id]))
+        for t_id, key, pair, start, end, via in rows
+    )
+
+
+def find_template(start_name, end_name, via):
+    """
+    The template for this exact path, or for the same path driven the other way.
+    Returns (CachedTemplate or None, is_reverse); a direct match wins.
+    """
+    from .models import RouteTemplate
+
+    forward = RouteTemplate.make_lookup_key(start_name, end_name, via)
+    backward = RouteTemplate.make_lookup_key(end_name, start_name, via)
+    templates = _cache.get(('path', forward), lambda: _load(lookup_key__in={forward, backward}))
+
+    for template in templates:
+        if template.lookup_key == forward:
+            return template, False
+    return (templates[0], True) if templates else (None, False)
+
+
+def _vias_key(pair, version):
+    digest = hashlib.sha1(pair.encode('utf-8')).hexdigest()
+    return f"routes:template_vias:v{version}:{digest}"
+
+
+def _build_vias(templates):
+    """ Via options for one pair, oriented from the pair's first name to its second. """
+    vias, seen = [], set()
+    for template in templates:
+        if not template.via or template.via in seen:
+            continue
+        seen.add(template.via)
+        stops = [name for _, _, name in template.stops]
+        if not template.ascending:
+            stops.reverse()
+        vias.append({"via": template.via, "stops": stops})
+    return vias
+
+
+def template_vias(start_name, end_name):
+    """ [{"via", "stops"}] for every template between the two locations, stops in start -> end order. """
+    from .models import RouteTemplate
+
+    pair = RouteTemplate.make_pair_key(start_name, end_name)
+    key = _vias_key(pair, get_template_version())
+    vias = cache.get(key)
+    if vias is None:
+        vias = _build_vias(_cache.get(('pair', pair), lambda: _load(pair_key=pair)))
+        cache.set(key, vias, VIAS_TIMEOUT)
+
+    if normalize(start_name) <= normalize(end_name):
+        return vias
+    return [{"via": v["via"], "stops": v["stops"][::-1]} for v in vias]
+
+
+def warm_vias(batch_size=500):
+    """ Precompute the via lists of every location pair that has templates. Returns the number of pairs. """
+    from .models import RouteTemplate
+
+    version = get_template_version()
+    pairs = RouteTemplate.objects.order_by('pair_key').values_list('pair_key', flat=True).distinct().iterator(chunk_size=batch_size)
+    count = 0
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            return count
+        templates = defaultdict(list)
+        for template in _load(pair_key__in=batch):
+            templates[template.pair_key].append(template)
+        cache.set_many({_vias_key(pair, version): _build_vias(templates[pair]) for pair in batch}, VIAS_TIMEOUT)
+        count += len(batch)
@@ -1,3 +1,1212 @@
+import asyncio
+import io
+import time
+from unittest import mock
+
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import BusDetails
+from .models import Route, Location, RouteStop, Trip, FavoriteRoute
+from . import geo_index, search_cache, template_cache
+
+
+def make_operator(username="operator"):
+    user = User.objects.create_user(username=username, password="pass")
+    bus = BusDetails.objects.create(user=user, bus_name=f"{username} bus", reg_number=f"KL-{username}")
+    return user, bus
+
+
+def make_route(bus, start, end, stops=(), trips=(("08:00", "10:00"),)):
+    route = Route.objects.create(bus=bus, start_location=start, end_location=end)
+    for name in (start, end):
+        Location.objects.get_or_create(name=name, defaults={'latitude': 11.25, 'longitude': 75.78})
+    for number, name in enumerate(stops, start=1):
+        loc, _ = Location.objects.get_or_create(name=name)
+        RouteStop.objects.create(route=route, location=loc, stop_number=number)
+    for start_time, end_time in trips:
+        Trip.objects.create(route=route, start_time=start_time, end_time=end_time)
+    return route
+
+
+class RouteQueryCountTests(TestCase):
+    """ Serializing N routes must cost the same number of queries as serializing 1. """
+
+    def setUp(self):
+        self.user, self.bus = make_operator()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.counter = 0
+
+    def add_routes(self, n):
+        for _ in range(n):
+            self.counter += 1
+            route = make_route(
+                self.bus, f"Kozhikode {self.counter}", "Nilambur",
+                stops=["Feroke", f"Areekode {self.counter}"],
+            )
+            FavoriteRoute.objects.create(user=self.user, route=route)
+
+    def count_queries(self, url, params=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.json()
+
+    def assertConstantQueries(self, url, params=None):
+        self.add_routes(2)
+        self.count_queries(url, params)  # warm per-process indexes
+        few, data_few = self.count_queries(url, params)
+        self.add_routes(8)
+        self.count_queries(url, params)
+        many, data_many = self.count_queries(url, params)
+        self.assertGreater(len(data_many), len(data_few))
+        self.assertEqual(few, many)
+        return data_many
+
+    def test_get_routes(self):
+        data = self.assertConstantQueries('/api/routes/get/')
+        self.assertEqual(float(data[0]['start_lat']), 11.25)
+
+    @mock.patch.object(search_cache, 'get', return_value=None)
+    def test_search_routes(self, _):
+        data = self.assertConstantQueries('/api/routes/search/', {'from': 'Feroke', 'to': 'Nilambur'})
+        self.assertEqual(float(data[0]['end_lng']), 75.78)
+
+    def test_my_favorites(self):
+        self.assertConstantQueries('/api/routes/my-favorites/')
+
+
+class SearchRoutesTests(TestCase):
+    def setUp(self):
+        _, bus = make_operator()
+        self.coastal = make_route(bus, "Kozhikode Beach", "Nilambur", stops=["Feroke", "Areekode"])
+        self.inland = make_route(bus, "Nilambur", "Kozhikode", stops=["Areekode"])
+
+    def search(self, origin, destination):
+        response = self.client.get('/api/routes/search/', {'from': origin, 'to': destination})
+        self.assertEqual(response.status_code, 200)
+        return [route['id'] for route in response.json()]
+
+    def test_from_must_come_before_to(self):
+        self.assertEqual(self.search("Feroke", "Areekode"), [self.coastal.id])
+        self.assertEqual(self.search("Areekode", "Feroke"), [])
+        self.assertEqual(self.search("Nilambur", "Areekode"), [self.inland.id])
+
+    def test_names_containing_the_query_match(self):
+        # An exact stop name still matches the longer names that contain it
+        self.assertEqual(self.search("kozhikode", "nilambur"), [self.coastal.id])
+        self.assertEqual(self.search("Beach", "Areekode"), [self.coastal.id])
+        self.assertEqual(self.search("nilambur", "  KOZHIKODE "), [self.inland.id])
+        self.assertEqual(self.search("Kozhikode Beach Road", "Nilambur"), [])
+
+    def test_index_follows_route_stop_changes(self):
+        self.assertEqual(self.search("Wandoor", "Kozhikode"), [])
+        location = Location.objects.create(name="Wandoor")
+        stop = RouteStop.objects.create(route=self.inland, location=location, stop_number=2)
+        self.assertEqual(self.search("Wandoor", "Kozhikode"), [self.inland.id])
+        stop.delete()
+        self.assertEqual(self.search("Wandoor", "Kozhikode"), [])
+
+
+class StopSequenceIndexTests(TestCase):
+    def test_exact_hit_also_matches_longer_names(self):
+        from .search_index import StopSequenceIndex
+
+        index = StopSequenceIndex({
+            "kozhikode": [(1, 0)],
+            "kozhikode beach": [(2, 0)],
+            "feroke": [(1, 1), (2, 1), (3, 0)],
+            "nilambur": [(1, 2), (2, 2), (3, 1)],
+        })
+        self.assertEqual(index.search("Kozhikode", "Nilambur"), [1, 2])
+        self.assertEqual(index.search("beach", "nilambur"), [2])
+        self.assertEqual(index.search("k", "nil"), [1, 2, 3])
+        self.assertEqual(index.search("Kozhikode", "Feroke Town"), [])
+
+
+class SuggestionTests(TestCase):
+    def setUp(self):
+        _, bus = make_operator()
+        # Served by a route, so it ranks first among equal matches
+        make_route(bus, "Koyilandy", "Chevayur")
+        Location.objects.create(name="Kozhikode", district="Kozhikode")
+        Location.objects.create(name="Feroke", district="Kozhikode")
+        Location.objects.create(name="Medical College Kozhikode")
+        Location.objects.create(name="Pookode")
+
+    def suggest(self, query):
+        return self.client.get('/api/routes/suggestions/', {'q': query}).json()
+
+    def test_name_prefix_then_word_or_district_then_infix(self):
+        self.assertEqual(self.suggest("koz"), ["Kozhikode", "Feroke", "Medical College Kozhikode"])
+        self.assertEqual(self.suggest("KO"), ["Koyilandy", "Kozhikode", "Feroke", "Medical College Kozhikode"])
+        self.assertEqual(self.suggest("ode"), ["Kozhikode", "Medical College Kozhikode", "Pookode"])
+
+    def test_short_queries_match_prefixes_only(self):
+        # "ko" is inside Pookode, but under three characters only prefixes count
+        self.assertNotIn("Pookode", self.suggest("ko"))
+        self.assertEqual(self.suggest("oo"), [])
+        self.assertEqual(self.suggest("ook"), ["Pookode"])
+
+    def test_saved_locations_invalidate_the_engine(self):
+        from . import suggestions
+
+        self.suggest("koz")
+        with mock.patch.object(suggestions, 'invalidate', wraps=suggestions.invalidate) as invalidate:
+            Location.objects.create(name="Kozhikode Beach")
+        # Wired through route_network_changed(locations=True)
+        invalidate.assert_called()
+        self.assertEqual(self.suggest("koz")[:2], ["Kozhikode", "Kozhikode Beach"])
+        location = Location.objects.get(name="Pookode")
+        location.name = "Puthiyara"
+        location.save()
+        self.assertEqual(self.suggest("ook"), [])
+
+
+class JourneyPlannerTests(TestCase):
+    def setUp(self):
+        _, bus_a = make_operator("a")
+        _, bus_b = make_operator("b")
+        _, bus_c = make_operator("c")
+        make_route(bus_a, "Kozhikode", "Malappuram", stops=["Feroke"], trips=[("08:00", "10:00")])
+        make_route(bus_b, "Malappuram", "Nilambur", stops=["Manjeri"], trips=[("10:30", "12:00"), ("06:00", "07:30")])
+        make_route(bus_c, "Kozhikode", "Nilambur", stops=["Areekode"], trips=[("09:00", "13:00")])
+
+    def test_pareto_itineraries(self):
+        response = self.client.get('/api/routes/journey/', {'from': 'kozhikode', 'to': 'Nilambur', 'depart': '07:00'})
+        itineraries = response.json()['itineraries']
+
+        self.assertEqual([i['transfers'] for i in itineraries], [0, 1])
+        self.assertEqual(itineraries[0]['arrival'], "13:00")
+        self.assertEqual(itineraries[1]['arrival'], "12:00")
+        self.assertEqual([leg['to'] for leg in itineraries[1]['legs']], ["Malappuram", "Nilambur"])
+        self.assertEqual(itineraries[1]['legs'][1]['departure'], "10:30")
+
+    def test_transfer_from_intermediate_stop(self):
+        response = self.client.get('/api/routes/journey/', {'from': 'Feroke', 'to': 'Manjeri', 'depart': '07:00'})
+        itineraries = response.json()['itineraries']
+
+        self.assertEqual(len(itineraries), 1)
+        self.assertEqual(itineraries[0]['departure'], "09:00")
+        self.assertEqual(itineraries[0]['arrival'], "11:15")
+
+    def test_no_service_after_departure(self):
+        response = self.client.get('/api/routes/journey/', {'from': 'Kozhikode', 'to': 'Nilambur', 'depart': '14:00'})
+        self.assertEqual(response.json()['itineraries'], [])
+
+
+class DepartureSearchTests(TestCase):
+    def setUp(self):
+        _, bus_a = make_operator("a")
+        _, bus_b = make_operator("b")
+        self.early = make_route(bus_a, "Kozhikode", "Nilambur", trips=[("06:00", "08:00"), ("09:00", "11:00"), ("15:00", "17:00")])
+        self.late = make_route(bus_b, "Kozhikode", "Nilambur", trips=[("08:30", "10:30"), ("20:00", "22:00")])
+
+    def search(self, **params):
+        response = self.client.get('/api/routes/search/', {'from': 'Kozhikode', 'to': 'Nilambur', **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_without_time_filter_returns_all_trips(self):
+        data = self.search()
+        self.assertEqual(sum(len(r['trips']) for r in data), 5)
+
+    def test_next_departures(self):
+        data = self.search(depart_after="08:00", limit=2)
+        self.assertEqual([r['id'] for r in data], [self.late.id, self.early.id])
+        self.assertEqual(data[0]['trips'], [{'start_time': '08:30:00', 'end_time': '10:30:00'}])
+        self.assertEqual(data[1]['trips'], [{'start_time': '09:00:00', 'end_time': '11:00:00'}])
+
+    def test_routes_without_upcoming_trips_are_dropped(self):
+        data = self.search(depart_after="16:00", limit=5)
+        self.assertEqual([r['id'] for r in data], [self.late.id])
+
+    def test_invalid_depart_after(self):
+        response = self.client.get('/api/routes/search/', {'from': 'Kozhikode', 'to': 'Nilambur', 'depart_after': '25:99'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user, self.bus = make_operator()
+        self.route = make_route(self.bus, "Kozhikode", "Nilambur", trips=[("08:00", "10:00")])
+
+    def search(self):
+        return self.client.get('/api/routes/search/', {'from': 'Kozhikode', 'to': 'Nilambur'})
+
+    def test_second_search_is_a_hit(self):
+        self.assertEqual(self.search()['X-Cache'], "MISS")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.search()
+        self.assertEqual(response['X-Cache'], "HIT")
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(search_cache.stats()['hits'], 1)
+        self.assertEqual(search_cache.stats()['misses'], 1)
+
+    def test_trip_change_invalidates(self):
+        self.search()
+        Trip.objects.create(route=self.route, start_time="12:00", end_time="14:00")
+        response = self.search()
+        self.assertEqual(response['X-Cache'], "MISS")
+        self.assertEqual(len(response.json()[0]['trips']), 2)
+
+    def test_crowd_status_change_invalidates(self):
+        self.search()
+        self.bus.crowd_status = 'red'
+        self.bus.save()
+        response = self.search()
+        self.assertEqual(response['X-Cache'], "MISS")
+        self.assertEqual(response.json()[0]['crowd_status'], 'red')
+
+    def test_earnings_change_keeps_cache(self):
+        self.search()
+        bus = BusDetails.objects.get(pk=self.bus.pk)
+        bus.total_earnings = 100
+        bus.save()
+        self.assertEqual(self.search()['X-Cache'], "HIT")
+
+
+class EffectiveStatusTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _, bus = make_operator()
+        self.route = make_route(bus, "Kozhikode", "Nilambur")
+        # Closed "today"... two days ago
+        Route.objects.filter(pk=self.route.pk).update(
+            status='closed_today', status_updated_at=timezone.now() - timedelta(days=2)
+        )
+
+    def test_search_issues_no_writes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/routes/search/', {'from': 'Kozhikode', 'to': 'Nilambur'})
+
+        self.assertEqual(response.json()[0]['effective_status'], 'active')
+        writes = [q['sql'] for q in ctx.captured_queries if not q['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.assertEqual(Route.objects.get(pk=self.route.pk).status, 'closed_today')
+
+    def test_rollover_command(self):
+        _, other_bus = make_operator("other")
+        closed_now = make_route(other_bus, "Manjeri", "Nilambur")
+        Route.objects.filter(pk=closed_now.pk).update(status='closed_today')
+
+        call_command('rollover_route_status', stdout=mock.MagicMock())
+
+        self.assertEqual(Route.objects.get(pk=self.route.pk).status, 'active')
+        self.assertEqual(Route.objects.get(pk=closed_now.pk).status, 'closed_today')
+
+
+class NearbyStopsTests(TestCase):
+    def setUp(self):
+        Location.objects.create(name="Kozhikode", latitude=11.2588, longitude=75.7804)
+        Location.objects.create(name="Feroke", latitude=11.1770, longitude=75.8406)
+        Location.objects.create(name="Nilambur", latitude=11.2769, longitude=76.2254)
+        Location.objects.create(name="No Coordinates")
+
+    def test_k_nearest(self):
+        response = self.client.get('/api/routes/stops/nearby/', {'lat': 11.25, 'lng': 75.78, 'k': 2})
+        self.assertEqual([s['name'] for s in response.json()], ["Kozhikode", "Feroke"])
+
+    def test_radius(self):
+        response = self.client.get('/api/routes/stops/nearby/', {'lat': 11.25, 'lng': 75.78, 'radius_km': 15})
+        data = response.json()
+        self.assertEqual([s['name'] for s in data], ["Kozhikode", "Feroke"])
+        self.assertLess(data[0]['distance_km'], 1.5)
+
+    def test_requires_coordinates(self):
+        response = self.client.get('/api/routes/stops/nearby/', {'lat': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_polar_queries_stay_bounded(self):
+        for params in ({'lat': 89.99, 'lng': 0}, {'lat': -90, 'lng': 0, 'radius_km': 50}):
+            self.assertEqual(self.client.get('/api/routes/stops/nearby/', params).status_code, 400)
+        # Called directly the grid still answers, from a bounded number of cells
+        index = geo_index.get_index()
+        gather, visited = index._gather, []
+
+        def counting(keys):
+            keys = list(keys)
+            visited.append(len(keys))
+            return gather(keys)
+
+        with mock.patch.object(index, '_gather', counting):
+            self.assertEqual(index.nearest(89.99, 0), [])
+            self.assertEqual(index.within(90, 0, 50), [])
+        self.assertLess(sum(visited), 100000)
+
+
+class AddRouteTests(TestCase):
+    def setUp(self):
+        # Test transactions roll back without bumping the template version
+        template_cache.invalidate()
+        self.user, self.bus = make_operator()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def payload(self, n_stops, start="Kozhikode", end="Nilambur", via="Areekode"):
+        return {
+            "start_location": start,
+            "end_location": end,
+            "via": via,
+            "trips": [{"start_time": "08:00", "end_time": "10:00"}, {"start_time": "14:00", "end_time": "16:00"}],
+            "stops": [{"name": f"Stop {i}", "lat": 11.0 + i / 100, "lon": 75.9} for i in range(n_stops)],
+            "start_location_data": {"lat": 11.25, "lon": 75.78, "district": "Kozhikode"},
+        }
+
+    def add(self, payload):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/routes/add/', payload, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return len(ctx.captured_queries), response.json()
+
+    def test_learning_path_query_count_is_constant(self):
+        few, _ = self.add(self.payload(5, via="Short"))
+        many, data = self.add(self.payload(40, via="Long"))
+        self.assertEqual(few, many)
+        self.assertLess(many, 25)
+        self.assertEqual(len(data['stop_list']), 40)
+        self.assertEqual(len(data['trips']), 2)
+
+    def test_template_paths_query_count_is_constant(self):
+        self.add(self.payload(40))
+        direct, data = self.add(self.payload(40))
+        reverse, reverse_data = self.add(self.payload(40, start="Nilambur", end="Kozhikode"))
+        self.assertEqual(direct, reverse)
+        self.assertLess(direct, 25)
+        self.assertEqual(
+            [s['location_name'] for s in reverse_data['stop_list']],
+            [s['location_name'] for s in reversed(data['stop_list'])],
+        )
+
+    def test_template_match_ignores_case_and_spacing(self):
+        self.add(self.payload(3))
+        _, data = self.add(self.payload(0, start="  kozhikode", end="NILAMBUR ", via="areekode"))
+        self.assertEqual([s['location_name'] for s in data['stop_list']], ["Stop 0", "Stop 1", "Stop 2"])
+
+    def test_template_vias(self):
+        self.add(self.payload(2, via="Areekode"))
+        self.add(self.payload(1, start="Nilambur", end="Kozhikode", via="Wandoor"))
+
+        self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur'})
+        with self.assertNumQueries(0):
+            vias = self.client.get('/api/routes/template-vias/', {'start': 'kozhikode', 'end': 'nilambur'}).json()
+        self.assertEqual(vias, [
+            {"via": "Areekode", "stops": ["Stop 0", "Stop 1"]},
+            {"via": "Wandoor", "stops": ["Stop 0"]},
+        ])
+
+        # Renaming a location re-keys its templates and drops the cached entries
+        location = Location.objects.get(name="Nilambur")
+        location.name = "Nilambur Town"
+        location.save()
+        self.assertEqual(len(self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur'}).json()), 0)
+        self.assertEqual(len(self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur Town'}).json()), 2)
+
+    def test_renaming_an_intermediate_stop_refreshes_via_lists(self):
+        self.add(self.payload(2, via="Areekode"))
+        call_command('warm_template_vias', stdout=io.StringIO())
+
+        location = Location.objects.get(name="Stop 1")
+        location.name = "Stop 1 (Market)"
+        location.save()
+        vias = self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur'}).json()
+        self.assertEqual(vias, [{"via": "Areekode", "stops": ["Stop 0", "Stop 1 (Market)"]}])
+
+    def test_template_vias_warmup(self):
+        self.add(self.payload(2, via="Areekode"))
+        call_command('warm_template_vias', stdout=io.StringIO())
+
+        with self.assertNumQueries(0):
+            forward = self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur'}).json()
+            backward = self.client.get('/api/routes/template-vias/', {'start': 'Nilambur', 'end': 'Kozhikode'}).json()
+        self.assertEqual(forward, [{"via": "Areekode", "stops": ["Stop 0", "Stop 1"]}])
+        self.assertEqual(backward, [{"via": "Areekode", "stops": ["Stop 1", "Stop 0"]}])
+
+        # A new template retires the cached lists
+        self.add(self.payload(1, via="Wandoor"))
+        vias = self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode', 'end': 'Nilambur'}).json()
+        self.assertEqual([v['via'] for v in vias], ["Areekode", "Wandoor"])
+
+    def test_template_vias_with_a_pipe_in_a_name(self):
+        self.add(self.payload(2, start="Kozhikode | KSRTC", via="Areekode"))
+        self.add(self.payload(1, start="Nilambur", end="Kozhikode | KSRTC", via="Wandoor"))
+        call_command('warm_template_vias', stdout=io.StringIO())
+
+        with self.assertNumQueries(0):
+            vias = self.client.get('/api/routes/template-vias/', {'start': 'Kozhikode | KSRTC', 'end': 'Nilambur'}).json()
+        self.assertEqual(vias, [
+            {"via": "Areekode", "stops": ["Stop 0", "Stop 1"]},
+            {"via": "Wandoor", "stops": ["Stop 0"]},
+        ])
+
+    def test_locations_are_upserted(self):
+        Location.objects.create(name="Stop 1", district="Malappuram")
+        self.add(self.payload(3))
+        stop = Location.objects.get(name="Stop 1")
+        self.assertEqual(float(stop.latitude), 11.01)
+        self.assertEqual(stop.district, "Malappuram")
+        self.assertEqual(Location.objects.get(name="Kozhikode").district, "Kozhikode")
+
+    def test_failure_leaves_nothing_behind(self):
+        from .models import TemplateStop
+        with mock.patch.object(TemplateStop.objects, 'bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/api/routes/add/', self.payload(5), format='json')
+        self.assertFalse(Route.objects.exists())
+        self.assertFalse(Location.objects.exists())
+
+
+class TimetableImportTests(TestCase):
+    CSV = (
+        "route_id,via,trip_id,stop_sequence,stop_name,stop_lat,stop_lon,arrival_time,departure_time\n"
+        "R1,Areekode,T1,1,Kozhikode,11.25,75.78,,08:00:00\n"
+        "R1,Areekode,T1,2,Areekode,11.23,76.05,08:50:00,08:52:00\n"
+        "R1,Areekode,T1,3,Nilambur,11.27,76.22,09:40:00,\n"
+        "R1,Areekode,T2,1,Kozhikode,11.25,75.78,,25:00:00\n"
+        "R1,Areekode,T2,2,Areekode,11.23,76.05,25:50:00,25:52:00\n"
+        "R1,Areekode,T2,3,Nilambur,11.27,76.22,26:40:00,\n"
+        "R1,Areekode,T3,1,Kozhikode,,,,not-a-time\n"
+        "R1,Areekode,T3,2,Nilambur,,,10:00:00,\n"
+    )
+
+    def setUp(self):
+        self.user, self.bus = make_operator()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_csv_import(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import RouteTemplate
+
+        upload = SimpleUploadedFile("timetable.csv", self.CSV.encode(), content_type="text/csv")
+        report = self.client.post('/api/routes/import/', {'file': upload}).json()
+
+        self.assertEqual((report['routes'], report['trips'], report['error_count']), (1, 2, 1))
+        self.assertEqual(report['errors'][0]['line'], 8)
+
+        route = Route.objects.get(bus=self.bus)
+        self.assertEqual((route.start_location, route.end_location, route.via), ("Kozhikode", "Nilambur", "Areekode"))
+        self.assertEqual([s.location.name for s in route.stops.all()], ["Areekode"])
+        self.assertEqual(sorted(str(t.start_time) for t in route.trips.all()), ["01:00:00", "08:00:00"])
+        self.assertEqual(float(Location.objects.get(name="Areekode").latitude), 11.23)
+        self.assertTrue(RouteTemplate.objects.filter(start_location__name="Kozhikode", via="Areekode").exists())
+
+        # Imported routes are searchable straight away
+        results = self.client.get('/api/routes/search/', {'from': 'Areekode', 'to': 'Nilambur'}).json()
+        self.assertEqual([r['id'] for r in results], [route.id])
+
+    def test_truncated_and_undecodable_files_are_reported(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        header = "route_id,trip_id,stop_sequence,stop_name,arrival_time,departure_time\n"
+        for content, line in [
+            (header + "R1,T1\n", 2),
+            ("trip_id,stop_sequence\nT1\n", 2),
+            (header + "R1,T1,1,Kozhikode,,08:00:00\n" + "R1,T1,2,Kozh\xe9,09:00:00,\n", 2),
+        ]:
+            raw = content.encode('latin-1')
+            upload = SimpleUploadedFile("timetable.csv", raw, content_type="text/csv")
+            response = self.client.post('/api/routes/import/', {'file': upload})
+            self.assertEqual(response.status_code, 200, response.content)
+            report = response.json()
+            self.assertEqual((report['trips'], report['error_count']), (0, 1))
+            self.assertEqual(report['errors'][0]['line'], line)
+        self.assertIn("UTF-8", report['errors'][0]['error'])
+
+    def test_bad_coordinates_and_long_names_are_row_errors(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        header = "route_id,trip_id,stop_sequence,stop_name,stop_lat,stop_lon,arrival_time,departure_time\n"
+        good = "R1,T9,1,Kozhikode,11.25,75.78,,08:00:00\nR1,T9,2,Nilambur,11.27,76.22,09:40:00,\n"
+        for bad, message in [
+            ("R1,T1,2,Feroke,abc,75.84,09:00:00,\n", "Invalid stop_lat 'abc' on line 3"),
+            ("R1,T1,2,Feroke,11.17,181,09:00:00,\n", "Invalid stop_lon '181' on line 3"),
+            ("R1,T1,2,Feroke,nan,75.84,09:00:00,\n", "Invalid stop_lat 'nan' on line 3"),
+            (f"R1,T1,2,{'F' * 101},,,09:00:00,\n", "stop_name is longer than 100 characters on line 3"),
+        ]:
+            content = header + "R1,T1,1,Kozhikode,11.25,75.78,,08:00:00\n" + bad + good
+            upload = SimpleUploadedFile("timetable.csv", content.encode(), content_type="text/csv")
+            response = self.client.post('/api/routes/import/', {'file': upload})
+            self.assertEqual(response.status_code, 200, response.content)
+            report = response.json()
+            # Only the trip with the bad cell is dropped
+            self.assertEqual((report['trips'], report['error_count']), (1, 1))
+            self.assertEqual(report['errors'][0]['error'], f"Trip 'T1': {message}")
+        self.assertEqual(float(Location.objects.get(name="Nilambur").latitude), 11.27)
+
+
+class GtfsExportTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from pathlib import Path
+        from . import gtfs_export
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(gtfs_export, 'FEED_PATH', Path(tmp.name) / 'feed.zip')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        _, bus = make_operator()
+        for name in ("Kozhikode", "Areekode", "Nilambur"):
+            Location.objects.create(name=name)
+        self.route = make_route(bus, "Kozhikode", "Nilambur", stops=["Areekode"], trips=[("23:00", "01:00")])
+
+    def read_feed(self, response):
+        import csv
+        import io
+        import zipfile
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        return {name: list(csv.DictReader(io.TextIOWrapper(archive.open(name), encoding='utf-8'))) for name in archive.namelist()}
+
+    def test_feed(self):
+        from . import gtfs_export
+
+        url = '/api/routes/gtfs/feed.zip'
+        # Nothing built yet: the request asks for a background build instead of running one
+        with mock.patch.object(gtfs_export, 'refresh_in_background') as refresh:
+            self.assertEqual(APIClient().get(url).status_code, 503)
+        refresh.assert_called_once()
+
+        call_command('export_gtfs', stdout=io.StringIO())
+        feed = self.read_feed(APIClient().get(url))
+        self.assertEqual(set(feed), {'agency.txt', 'calendar.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt'})
+        self.assertEqual([r['route_id'] for r in feed['routes.txt']], [str(self.route.id)])
+        stop_names = {r['stop_id']: r['stop_name'] for r in feed['stops.txt']}
+        self.assertEqual(
+            [(stop_names[r['stop_id']], r['arrival_time']) for r in feed['stop_times.txt']],
+            [("Kozhikode", "23:00:00"), ("Areekode", "24:00:00"), ("Nilambur", "25:00:00")],
+        )
+
+        # Unchanged network: served as is; changed network: the old feed is served while one rebuild runs off the request
+        self.assertIsNone(gtfs_export.ensure_fresh())
+        Trip.objects.create(route=self.route, start_time="06:00", end_time="08:00")
+        with mock.patch.object(gtfs_export, 'MIN_REBUILD_SECONDS', 0):
+            with mock.patch.object(gtfs_export.threading, 'Thread') as thread:
+                self.assertEqual(len(self.read_feed(APIClient().get(url))['trips.txt']), 1)
+            thread.assert_called_once()
+
+            cache.add(gtfs_export.BUILD_LOCK_KEY, True)
+            self.assertIsNone(gtfs_export.ensure_fresh())
+            cache.delete(gtfs_export.BUILD_LOCK_KEY)
+            self.assertEqual(gtfs_export.ensure_fresh()['trips'], 2)
+
+
+class LiveIngestTests(TestCase):
+    def setUp(self):
+        self.user, self.bus = make_operator()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch_keeps_newest_fix_per_bus(self):
+        from .models import BusLiveLocation
+        from . import live_ingest
+
+        fixes = [
+            {"latitude": 11.1, "longitude": 75.1, "timestamp": 1_700_000_600},
+            {"latitude": 11.3, "longitude": 75.3, "timestamp": 1_700_001_800},
+            {"latitude": 11.2, "longitude": 75.2, "timestamp": 1_700_001_200},
+            {"latitude": "north", "longitude": 75.2},
+        ]
+        with mock.patch.object(live_ingest.buffer, 'durability', 'sync'):
+            response = self.client.post('/api/routes/bus/locations/', {"fixes": fixes}, format='json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json()['accepted'], 3)
+            self.assertEqual(response.json()['errors'][0]['index'], 3)
+            self.assertEqual(BusLiveLocation.objects.get(bus=self.bus).latitude, 11.3)
+
+            # A late upload of an older fix doesn't move the bus backwards
+            self.client.post('/api/routes/bus/locations/', {"fixes": fixes[:1]}, format='json')
+            self.assertEqual(BusLiveLocation.objects.get(bus=self.bus).latitude, 11.3)
+
+            # The single-fix endpoint goes through the same buffer
+            self.client.post('/api/routes/bus/update-location/', {"latitude": 11.4, "longitude": 75.4}, format='json')
+            self.assertEqual(BusLiveLocation.objects.get(bus=self.bus).latitude, 11.4)
+
+    def test_out_of_range_timestamps_are_rejected_per_fix(self):
+        from . import live_ingest
+
+        huge = "100000000000000000000"
+        with self.assertRaisesMessage(ValueError, "Invalid timestamp"):
+            live_ingest.make_fix(self.bus.id, {"latitude": 11.1, "longitude": 75.1, "timestamp": huge})
+
+        buffer = live_ingest.WriteBehindBuffer(writer=len, history_writer=len, background=False)
+        with mock.patch.object(live_ingest, 'buffer', buffer):
+            response = self.client.post('/api/routes/bus/update-location/', {"latitude": 11.1, "longitude": 75.1, "timestamp": huge}, format='json')
+            self.assertEqual(response.status_code, 400)
+            fixes = [{"latitude": 11.1, "longitude": 75.1, "timestamp": 1e300}, {"latitude": 11.2, "longitude": 75.2}]
+            response = self.client.post('/api/routes/bus/locations/', {"fixes": fixes}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json()['accepted'], response.json()['errors']), (1, [{"index": 0, "error": "Invalid timestamp"}]))
+
+    def test_buffer_flushes_in_batches_and_applies_backpressure(self):
+        from . import live_ingest
+
+        written = []
+        history = []
+        buffer = live_ingest.WriteBehindBuffer(writer=written.append, history_writer=history.extend, max_pending=3, background=False)
+        now = timezone.now()
+        buffer.offer([live_ingest.Fix(bus_id, 11.0, 75.0, None, None, now) for bus_id in (1, 2)])
+        buffer.offer([live_ingest.Fix(1, 11.5, 75.0, None, None, now + timedelta(seconds=5))])
+        self.assertEqual(written, [])
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(sorted((f.bus_id, f.latitude) for f in written[0]), [(1, 11.5), (2, 11.0)])
+        self.assertEqual(len(history), 3)
+
+        # Hitting max_pending flushes inline ('flush') or refuses the batch ('reject')
+        buffer.offer([live_ingest.Fix(bus_id, 11.0, 75.0, None, None, now + timedelta(seconds=10)) for bus_id in (1, 2, 3)])
+        self.assertEqual((len(written), buffer.pending()), (2, 0))
+        buffer.backpressure = 'reject'
+        buffer.offer([live_ingest.Fix(bus_id, 11.0, 75.0, None, None, now + timedelta(seconds=20)) for bus_id in (4, 5)])
+        buffer.max_pending = 2
+        with self.assertRaises(live_ingest.BufferFull):
+            buffer.offer([live_ingest.Fix(6, 11.0, 75.0, None, None, now)])
+
+
+class LocationHistoryTests(TestCase):
+    def setUp(self):
+        self.user, self.bus = make_operator()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_block_round_trip(self):
+        from . import location_history
+
+        seconds = [0, 31, 45, 200]
+        data = location_history.encode_block(seconds, [11.123456, 11.2, 11.3, 11.4], [75.5, 75.6, 75.7, 75.8], [30.0, float('nan'), 12.5, 0.0])
+        decoded = location_history.decode_block(data)
+        self.assertEqual(decoded[0].tolist(), seconds)
+        self.assertAlmostEqual(decoded[1][0], 11.123456)
+        self.assertTrue(decoded[3][1] != decoded[3][1])     # NaN survives
+        self.assertEqual(location_history.downsample(seconds, 30).tolist(), [0, 1, 3])
+
+    def test_history_is_kept_compacted_and_read_back(self):
+        from . import live_ingest, location_history
+
+        day_start = (timezone.now() - timedelta(days=10)).replace(hour=6, minute=0, second=0, microsecond=0)
+        old = [live_ingest.Fix(self.bus.id, 11.0 + i / 1000, 75.0, 30.0, None, day_start + timedelta(seconds=5 * i)) for i in range(24)]
+        recent = [live_ingest.Fix(self.bus.id, 12.0, 76.0, None, None, timezone.now() - timedelta(minutes=m)) for m in (30, 20, 10)]
+        buffer = live_ingest.WriteBehindBuffer(writer=lambda fixes: None, background=False)
+        buffer.offer(old + recent + old[:2])    # retried uploads are ignored
+        buffer.flush()
+
+        days, fixes = location_history.compact()
+        self.assertEqual((days, fixes), (1, 24))
+        points = location_history.read(self.bus.id, day_start, day_start + timedelta(hours=1))
+        self.assertEqual([p["recorded_at"] for p in points], [day_start + timedelta(seconds=s) for s in (0, 30, 60, 90)])
+        self.assertAlmostEqual(points[1]["lat"], 11.006)
+
+        response = self.client.get(f'/api/routes/bus/{self.bus.id}/history/')
+        self.assertEqual(len(response.json()['fixes']), 3)
+        other, _ = make_operator("other")
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(f'/api/routes/bus/{self.bus.id}/history/').status_code, 404)
+
+        self.assertEqual(location_history.purge(before=timezone.now().date()), 1)
+
+
+class LiveEtaTests(TestCase):
+    def setUp(self):
+        _, self.bus = make_operator()
+        # Due north, ~11.1 km between consecutive points
+        for i, name in enumerate(["Depot", "Stop A", "Stop B", "Stop C", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A", "Stop B", "Stop C"])
+
+    def test_etas_follow_the_route(self):
+        from .models import BusLiveLocation
+
+        # Just past Stop A, slightly off the road, at 33.4 km/h (~20 min per leg)
+        BusLiveLocation.objects.create(bus=self.bus, latitude=11.105, longitude=76.001, speed=33.36)
+        data = APIClient().get(f'/api/routes/bus/live/{self.route.id}/').json()
+
+        self.assertEqual([s['stop_name'] for s in data['stops']], ["Depot", "Stop A", "Stop B", "Stop C", "Terminus"])
+        self.assertEqual([s['eta_minutes'] for s in data['stops']], [None, None, 19, 39, 59])
+        self.assertAlmostEqual(data['progress_km'], 11.675, places=1)
+        self.assertLess(data['off_route_km'], 0.2)
+
+        # Geometry and live state are cached
+        with self.assertNumQueries(0):
+            APIClient().get(f'/api/routes/bus/live/{self.route.id}/')
+
+    def test_stop_list_contract(self):
+        from .models import BusLiveLocation
+
+        # Start and end are listed around the RouteStops; stops behind the bus have no ETA
+        BusLiveLocation.objects.create(bus=self.bus, latitude=11.105, longitude=76.0, speed=30)
+        stops = APIClient().get(f'/api/routes/bus/live/{self.route.id}/').json()['stops']
+        self.assertEqual([set(s) for s in stops], [{"stop_name", "stop_number", "eta_minutes"}] * 5)
+        self.assertEqual([s['stop_number'] for s in stops], [0, 1, 2, 3, 4])
+        self.assertEqual([(s['stop_name'], s['eta_minutes']) for s in stops[:2]], [("Depot", None), ("Stop A", None)])
+        self.assertTrue(all(isinstance(s['eta_minutes'], int) for s in stops[2:]))
+
+    def test_standing_bus_uses_default_speed(self):
+        from . import eta
+
+        geometry = eta.get_geometry(self.route.id)
+        _, minutes = geometry.etas(11.0, 76.0, speed_kmh=0)
+        self.assertEqual(minutes[-1], round(geometry.length_km / eta.DEFAULT_SPEED_KMH * 60))
+
+
+class LivePushTests(TestCase):
+    def setUp(self):
+        from .models import BusLiveLocation
+
+        _, self.bus = make_operator()
+        for i, name in enumerate(["Depot", "Stop A", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A"])
+        BusLiveLocation.objects.create(bus=self.bus, latitude=11.05, longitude=76.0, speed=30)
+
+    def open_stream(self, path, chunks):
+        """ A fake SSE client on core.asgi: body chunks land in `chunks`. Returns (task, start message, disconnect event). """
+        from core.asgi import application
+
+        start, disconnect = {}, asyncio.Event()
+        requested = []
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {'type': 'http.request', 'body': b''}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+            elif message.get('body'):
+                chunks.put_nowait(message['body'])
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [(b'origin', b'http://localhost:5173')]}
+        return asyncio.ensure_future(application(scope, receive, send)), start, disconnect
+
+    async def test_update_is_computed_once_and_fanned_out(self):
+        from asgiref.sync import sync_to_async
+        from . import eta, live_ingest, live_push
+
+        with mock.patch.object(live_push, 'layer', live_push.InMemoryChannelLayer()):
+            clients = [asyncio.Queue() for _ in range(3)]
+            streams = [self.open_stream(f'/api/routes/bus/live/{self.route.id}/stream/', chunks) for chunks in clients]
+
+            # Every subscriber starts from the current position
+            for chunks in clients:
+                self.assertIn(b'"lat":11.05', await chunks.get())
+            self.assertEqual(streams[0][1]['status'], 200)
+            self.assertIn((b'content-type', b'text/event-stream'), streams[0][1]['headers'])
+            self.assertIn((b'access-control-allow-origin', b'http://localhost:5173'), streams[0][1]['headers'])
+            self.assertEqual(live_push.layer.subscribers(live_push.group_name(self.route.id)), 3)
+
+            buffer = live_ingest.WriteBehindBuffer(history_writer=len, publisher=live_ingest.publish, background=False)
+            buffer.offer([live_ingest.Fix(self.bus.id, 11.15, 76.0, 30.0, None, timezone.now())])
+            with mock.patch.object(eta, 'route_etas', wraps=eta.route_etas) as computed:
+                await sync_to_async(buffer.flush)()
+            self.assertEqual(computed.call_count, 1)
+
+            frames = {await chunks.get() for chunks in clients}
+            self.assertEqual(len(frames), 1)
+            self.assertIn(b'"lat":11.15', frames.pop())
+
+            # Disconnecting leaves the group
+            for task, _, disconnect in streams:
+                disconnect.set()
+                await task
+            self.assertEqual(live_push.layer.subscribers(live_push.group_name(self.route.id)), 0)
+
+            # Unknown route
+            task, start, _ = self.open_stream('/api/routes/bus/live/999999/stream/', asyncio.Queue())
+            await task
+            self.assertEqual(start['status'], 404)
+
+    def test_wsgi_points_streams_at_polling(self):
+        from django.test import override_settings
+        from .checks import check_push_layer
+
+        response = self.client.get(f'/api/routes/bus/live/{self.route.id}/stream/')
+        self.assertEqual(response.status_code, 501)
+        self.assertIn(f'/api/routes/bus/live/{self.route.id}/', response.json()['error'])
+
+        # An in-process layer can't reach the other workers' subscribers
+        self.assertEqual(check_push_layer(None), [])
+        with override_settings(WEB_CONCURRENCY=2):
+            self.assertEqual([e.id for e in check_push_layer(None)], ['routes.E002'])
+        with override_settings(WEB_CONCURRENCY=2, LIVE_PUSH_LAYER='routes.live_push.CacheChannelLayer'):
+            self.assertEqual(check_push_layer(None), [])
+
+    async def test_slow_subscriber_keeps_newest_frames(self):
+        from . import live_push
+
+        layer = live_push.InMemoryChannelLayer()
+        subscription = layer.subscribe('route.1')
+        for i in range(live_push.QUEUE_SIZE + 3):
+            layer.group_send('route.1', str(i).encode())
+        await asyncio.sleep(0)
+        self.assertEqual(subscription.dropped, 3)
+        self.assertEqual(await subscription.receive(), b'3')
+
+        layer.unsubscribe(subscription)
+        self.assertEqual(layer.active({'route.1'}), set())
+
+    def test_routes_nobody_watches_are_not_pushed(self):
+        from . import live_push
+
+        with mock.patch.object(live_push.layer, 'group_send') as sent:
+            self.assertEqual(live_push.publish({self.route.id: {"stops": []}}), 0)
+        sent.assert_not_called()
+
+
+class LiveStateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user, self.bus = make_operator()
+        for i, name in enumerate(["Depot", "Stop A", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A"])
+        self.url = f'/api/routes/bus/live/{self.route.id}/'
+
+    def test_pings_are_read_from_memory_before_the_flush(self):
+        from . import eta, live_ingest
+
+        operator = APIClient()
+        operator.force_authenticate(self.user)
+        # Ten minutes apart, a plausible drive for the ingest filter
+        start = timezone.now().timestamp() - 20 * 60
+        written = []
+        buffer = live_ingest.WriteBehindBuffer(writer=written.append, history_writer=len, publisher=live_ingest.publish, background=False)
+        with mock.patch.object(live_ingest, 'buffer', buffer):
+            self.assertEqual(APIClient().get(self.url).status_code, 404)
+            operator.post('/api/routes/bus/update-location/', {"latitude": 11.05, "longitude": 76.0, "timestamp": start}, format='json')
+            self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.05)
+
+            # Not flushed yet, and no query: the position was written through to the store
+            operator.post('/api/routes/bus/update-location/', {"latitude": 11.15, "longitude": 76.0, "timestamp": start + 600}, format='json')
+            with self.assertNumQueries(0):
+                data = APIClient().get(self.url).json()
+            self.assertEqual(written, [])
+            self.assertEqual(data['bus_location']['lat'], 11.15)
+            self.assertEqual([s['eta_minutes'] is None for s in data['stops']], [True, True, False])
+
+            # The flush precomputes the route's ETAs for the next reader
+            operator.post('/api/routes/bus/update-location/', {"latitude": 11.16, "longitude": 76.0, "timestamp": start + 1200}, format='json')
+            buffer.flush()
+            with mock.patch.object(eta, 'route_etas') as computed:
+                self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.16)
+            computed.assert_not_called()
+
+    def test_cold_start_loads_from_the_database(self):
+        from .models import BusLiveLocation
+
+        live = BusLiveLocation.objects.create(bus=self.bus, latitude=11.05, longitude=76.0, speed=30)
+        self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.05)
+        with self.assertNumQueries(0):
+            APIClient().get(self.url)
+
+        # A direct write drops the cached state
+        live.latitude = 11.15
+        live.save()
+        self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.15)
+
+    def test_cold_loads_and_unknown_buses_are_cached_briefly(self):
+        from . import live_state
+        from .models import BusLiveLocation
+
+        self.assertEqual(APIClient().get(self.url).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(APIClient().get(self.url).status_code, 404)
+
+        # Written where this worker's cache doesn't see it (no signals): picked up after the short timeout
+        BusLiveLocation.objects.bulk_create([BusLiveLocation(bus=self.bus, latitude=11.05, longitude=76.0, speed=30)])
+        later = time.time() + live_state.COLD_TIMEOUT + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.05)
+        BusLiveLocation.objects.filter(bus=self.bus).update(latitude=11.15, updated_at=timezone.now() + timedelta(seconds=1))
+        with mock.patch('time.time', return_value=later + live_state.COLD_TIMEOUT + 1):
+            self.assertEqual(APIClient().get(self.url).json()['bus_location']['lat'], 11.15)
+
+    def test_per_process_cache_needs_a_single_worker(self):
+        from django.test import override_settings
+        from .checks import check_shared_cache
+
+        self.assertEqual(check_shared_cache(None), [])
+        with override_settings(WEB_CONCURRENCY=4):
+            self.assertEqual([e.id for e in check_shared_cache(None)], ['routes.E001'])
+
+
+class FleetTests(TestCase):
+    def setUp(self):
+        from .models import BusLiveLocation
+        from . import fleet_index
+
+        fleet_index.invalidate()
+        self.buses, self.routes, self.live = [], [], []
+        for i, (lat, lng) in enumerate([(11.25, 75.78), (11.26, 75.80), (10.00, 76.30)]):
+            _, bus = make_operator(f"fleet{i}")
+            self.buses.append(bus)
+            self.routes.append(make_route(bus, f"From {i}", f"To {i}"))
+            self.live.append(BusLiveLocation.objects.create(bus=bus, latitude=lat, longitude=lng, speed=20))
+
+    def get(self, **params):
+        from . import fleet_index
+
+        with mock.patch.object(fleet_index, 'REFRESH_SECONDS', 0), mock.patch.object(fleet_index, 'OVERLAP_SECONDS', 0):
+            return APIClient().get('/api/routes/bus/fleet/', params)
+
+    def test_bbox_and_routes(self):
+        data = self.get(bbox="11.0,75.5,11.5,76.0").json()
+        self.assertEqual(data['fields'][:3], ["bus_id", "lat", "lng"])
+        self.assertEqual(sorted(row[0] for row in data['buses']), [self.buses[0].id, self.buses[1].id])
+        routes_of = {bus.id: [route.id] for bus, route in zip(self.buses, self.routes)}
+        self.assertTrue(all(row[-1] == routes_of[row[0]] for row in data['buses']))
+
+        data = self.get(routes=f"{self.routes[2].id},999999").json()
+        self.assertEqual([row[0] for row in data['buses']], [self.buses[2].id])
+
+        self.assertEqual(self.get(bbox="11.5,75.5,11.0,76.0").status_code, 400)
+        self.assertEqual(self.get().status_code, 400)
+
+    def test_since_returns_only_buses_that_moved(self):
+        cursor = self.get(bbox="-90,-180,90,180").json()['cursor']
+
+        # Bus 0 moves (to another cell), bus 1 pings without moving
+        self.live[0].latitude = 11.40
+        self.live[0].save()
+        self.live[1].speed = 0
+        self.live[1].save()
+
+        data = self.get(bbox="-90,-180,90,180", since=cursor).json()
+        self.assertEqual([(row[0], row[1]) for row in data['buses']], [(self.buses[0].id, 11.40)])
+        self.assertGreater(data['cursor'], cursor)
+        self.assertEqual(self.get(bbox="11.35,75.5,11.5,76.0").json()['buses'][0][0], self.buses[0].id)
+
+
+class SegmentTimesTests(TestCase):
+    def setUp(self):
+        _, self.bus = make_operator()
+        for i, name in enumerate(["Depot", "Stop A", "Stop B", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A", "Stop B"])
+
+    def drive(self, start, leg_minutes):
+        """ Fixes every minute from Depot to Terminus, `leg_minutes[i]` for leg i. """
+        from . import live_ingest, location_history
+
+        fixes, t = [], start
+        for leg, minutes in enumerate(leg_minutes):
+            for m in range(minutes):
+                fixes.append(live_ingest.Fix(self.bus.id, 11.0 + (leg + m / minutes) / 10, 76.0, 30.0, None, t))
+                t += timedelta(minutes=1)
+        fixes.append(live_ingest.Fix(self.bus.id, 11.3, 76.0, 30.0, None, t))
+        location_history.append(fixes)
+
+    def test_incremental_training_feeds_etas(self):
+        from .models import BusLiveLocation, SegmentTravelTime
+        from . import segment_times
+
+        monday_9am = timezone.make_aware(datetime(2026, 3, 2, 9, 0))
+        for week in range(3):
+            self.drive(monday_9am + timedelta(weeks=week), [10, 40, 10])
+        self.assertEqual(segment_times.train(until=monday_9am + timedelta(weeks=3)), 9)
+
+        # The next run only reads what arrived since
+        self.assertEqual(segment_times.train(until=monday_9am + timedelta(weeks=3, hours=1)), 0)
+        middle = SegmentTravelTime.objects.get(from_location__name="Stop A", to_location__name="Stop B", weekday=0, hour=9)
+        self.assertEqual((middle.samples, middle.mean_seconds), (3, 40 * 60))
+
+        # The slow middle leg now shows up in the ETA instead of distance / speed
+        BusLiveLocation.objects.create(bus=self.bus, latitude=11.1, longitude=76.0, speed=60)
+        with mock.patch.object(timezone, 'now', return_value=monday_9am + timedelta(weeks=4)):
+            data = APIClient().get(f'/api/routes/bus/live/{self.route.id}/').json()
+        self.assertEqual([s['eta_minutes'] for s in data['stops']], [None, 0, 40, 50])
+
+    def test_merge_caps_old_weight(self):
+        from . import segment_times
+
+        n, mean, _ = segment_times.merge((segment_times.MAX_WEIGHT, 100.0, 0.0), [200.0] * 100)
+        self.assertEqual(n, segment_times.MAX_WEIGHT)
+        self.assertAlmostEqual(mean, 120.0)
+
+
+class NotificationDispatcherTests(TestCase):
+    def setUp(self):
+        from .models import BusLiveLocation, RouteNotification
+        from . import notification_dispatcher
+
+        _, self.bus = make_operator()
+        for i, name in enumerate(["Depot", "Stop A", "Stop B", "Stop C", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A", "Stop B", "Stop C"])
+        self.rider = User.objects.create_user(username="rider", password="pass", email="rider@example.com")
+        # Stop C is ~39 min away at 33.4 km/h
+        self.live = BusLiveLocation.objects.create(bus=self.bus, latitude=11.105, longitude=76.001, speed=33.36)
+        self.notification = RouteNotification.objects.create(user=self.rider, route=self.route, stop_name="stop c", notify_minutes=20)
+        self.transport = notification_dispatcher.InMemoryTransport()
+        self.dispatcher = notification_dispatcher.Dispatcher(transport=self.transport)
+
+    def test_fires_on_predicted_time_once(self):
+        now = time.time()
+        self.assertEqual(self.dispatcher.tick(now), 0)
+        self.assertEqual(len(self.dispatcher.heap), 1)
+
+        # No pings meanwhile: the heap still fires ~19 min later
+        self.assertEqual(self.dispatcher.tick(now + 18 * 60), 0)
+        self.assertEqual(self.dispatcher.tick(now + 19 * 60), 1)
+        alert = self.transport.sent[0]
+        self.assertEqual((alert.notification_id, alert.stop_name, alert.eta_minutes), (self.notification.id, "stop c", 20))
+        self.notification.refresh_from_db()
+        self.assertIsNotNone(self.notification.last_sent_at)
+
+        # Once per approach, and a restarted dispatcher respects the cooldown
+        self.assertEqual(self.dispatcher.tick(now + 30 * 60), 0)
+        from . import notification_dispatcher
+        restarted = notification_dispatcher.Dispatcher(transport=self.transport)
+        self.assertEqual(restarted.tick(now + 20 * 60), 0)
+        self.assertEqual(len(self.transport.sent), 1)
+
+    def test_ping_rescores_only_its_route(self):
+        from .models import RouteNotification
+        from . import eta, notification_dispatcher
+
+        _, other_bus = make_operator("other")
+        other = make_route(other_bus, "Depot", "Terminus", stops=["Stop A"])
+        RouteNotification.objects.create(user=self.rider, route=other, stop_name="Stop A", notify_minutes=5)
+        now = time.time()
+        with mock.patch.object(notification_dispatcher, 'OVERLAP_SECONDS', 0):
+            self.dispatcher.tick(now)
+
+            # The bus is now 10 min from Stop C: due right away
+            self.live.latitude = 11.25
+            self.live.save()
+            with mock.patch.object(eta, 'route_etas', wraps=eta.route_etas) as route_etas:
+                self.assertEqual(self.dispatcher.tick(now + 1), 1)
+        self.assertEqual([call.args[0] for call in route_etas.call_args_list], [self.route.id])
+        self.assertEqual(self.dispatcher.stats["rescored"], 2)
+        self.assertEqual(self.transport.sent[0].eta_minutes, 10)
+
+    def test_subscription_changes_are_synced(self):
+        from .models import RouteNotification
+        from . import notification_dispatcher
+
+        now = time.time()
+        self.dispatcher.tick(now)
+        # A new subscription is scheduled from the ETAs already known; a deleted one never fires
+        RouteNotification.objects.create(user=self.rider, route=self.route, stop_name="Terminus", notify_minutes=60)
+        self.notification.delete()
+        with mock.patch.object(notification_dispatcher, 'OVERLAP_SECONDS', 0):
+            self.assertEqual(self.dispatcher.tick(now + 1), 1)
+            self.assertEqual(self.dispatcher.tick(now + 30 * 60), 0)
+        self.assertEqual([a.stop_name for a in self.transport.sent], ["Terminus"])
+        self.assertNotIn(self.notification.id, self.dispatcher.entries)
+
+
+class StopEventsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _, self.bus = make_operator()
+        # Due north, ~11.1 km between consecutive points
+        for i, name in enumerate(["Depot", "Stop A", "Stop B", "Stop C", "Terminus"]):
+            Location.objects.create(name=name, latitude=11.0 + i / 10, longitude=76.0)
+        self.route = make_route(self.bus, "Depot", "Terminus", stops=["Stop A", "Stop B", "Stop C"])
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def drive(self, *lats):
+        """ One fix a minute at each latitude, through the ingest path. Returns the events received. """
+        from . import gps_filter, live_ingest, stop_events
+
+        received = []
+
+        def on_events(sender, events, **kwargs):
+            received.extend(events)
+
+        stop_events.stop_arrivals.connect(on_events)
+        try:
+            # Far faster than any bus: keep the ingest filter out of it. Nothing is written.
+            buffer = live_ingest.WriteBehindBuffer(writer=len, history_writer=len, background=False)
+            with mock.patch.object(gps_filter, 'ENABLED', False), mock.patch.object(live_ingest, 'buffer', buffer):
+                for lat in lats:
+                    live_ingest.ingest([live_ingest.Fix(self.bus.id, lat, 76.0, 30.0, None, self.start)])
+                    self.start += timedelta(minutes=1)
+        finally:
+            stop_events.stop_arrivals.disconnect(on_events)
+        return [(e.stop_name, e.event, e.dwell_seconds) for e in received]
+
+    def test_arrivals_departures_and_skipped_stops(self):
+        from . import stop_events
+
+        cold_starts = stop_events.stats["cold_starts"]
+        events = self.drive(11.05, 11.1002, 11.1003, 11.102, 11.25, 11.3)
+        # Stop B had no fix inside its fence: passed without an event
+        self.assertEqual(events, [("Stop A", "arrival", None), ("Stop A", "departure", 120.0), ("Stop C", "arrival", None)])
+        # The route polyline was searched once, for the first fix
+        self.assertEqual(stop_events.stats["cold_starts"] - cold_starts, 1)
+
+        # Jitter inside the exit radius is not a departure; after the terminus the next trip starts over
+        self.assertEqual(self.drive(11.3007, 11.4), [("Stop C", "departure", 120.0), ("Terminus", "arrival", None)])
+        self.assertEqual(self.drive(11.39, 11.0), [("Terminus", "departure", 60.0), ("Depot", "arrival", None)])
+
+    def test_trip_ending_short_of_the_terminus_fence_starts_over(self):
+        # 220 m short of the terminus (outside its 50 m fence), then back the way it came
+        events = self.drive(11.25, 11.3, 11.35, 11.398, 11.39, 11.0)
+        self.assertEqual(events, [("Stop C", "arrival", None), ("Stop C", "departure", 60.0), ("Depot", "arrival", None)])
+
+    def test_stale_fix_is_ignored(self):
+        from . import live_ingest, stop_events
+
+        self.drive(11.05)
+        late = live_ingest.Fix(self.bus.id, 11.1, 76.0, 30.0, None, self.start - timedelta(minutes=5))
+        self.assertEqual(stop_events.observe([late]), [])
+
+
+class GpsFilterTests(TestCase):
+    def setUp(self):
+        from . import gps_filter
+
+        cache.clear()
+        gps_filter.reset_stats()
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def fix(self, seconds, lat, lng=76.0, bus_id=1):
+        from . import live_ingest
+
+        return live_ingest.Fix(bus_id, lat, lng, 30.0, None, self.start + timedelta(seconds=seconds))
+
+    def test_duplicates_bursts_and_jumps(self):
+        from . import gps_filter
+
+        kept = gps_filter.filter_fixes([
+            self.fix(0, 11.0),
+            self.fix(10, 11.00005),             # ~6 m: the bus is standing
+            self.fix(40, 11.00005),             # keepalive
+            self.fix(100, 11.01),               # ~1.1 km in a minute: driving
+            self.fix(100.5, 11.0101),           # burst: the newest of the two counts
+            self.fix(160, 11.5),                # 55 km in a minute: a GPS jump
+            self.fix(170, 11.0115),
+        ])
+        self.assertEqual([f.latitude for f in kept], [11.0, 11.00005, 11.0101, 11.0115])
+        stats = gps_filter.stats()
+        self.assertEqual([stats[k] for k in ("received", "accepted", "duplicate", "burst", "jump")], [7, 4, 1, 1, 1])
+        self.assertAlmostEqual(stats["saved_rate"], 3 / 7, places=3)
+
+        # A single ping is checked against the last accepted fix of an earlier upload
+        self.assertEqual(gps_filter.filter_fixes([self.fix(175, 11.0116)]), [])
+
+    def test_consistent_jump_reanchors(self):
+        from . import gps_filter
 
-# Create your tests here.
+        gps_filter.filter_fixes([self.fix(0, 11.0)])
+        # The bus turns up far away (say, after a GPS outage) and stays there
+        self.assertEqual(gps_filter.filter_fixes([self.fix(60, 12.0)]), [])
+        self.assertEqual([f.latitude for f in gps_filter.filter_fixes([self.fix(120, 12.001)])], [12.001])
+        self.assertEqual(gps_filter.stats()["reanchored"], 1)
+        # A late upload of older fixes passes for the history
+        self.assertEqual(len(gps_filter.filter_fixes([self.fix(30, 11.5)])), 1)
@@ -0,0 +1,9 @@
+"""
+Text helpers shared by the models and the in-process indexes. No imports
+from the rest of the app, so anything can depend on this module.
+"""
+
+
+def normalize(name):
+    """ Casefold and collapse whitespace so 'Kozhikode  ' == 'kozhikode'. """
+    return ' '.join((name or '').split()).casefold()
@@ -0,0 +1,364 @@
+"""
+Bulk timetable import for operators.
+
+Two input formats, both streamed row by row:
+
+  * GTFS-lite zip: stops.txt, routes.txt, trips.txt, stop_times.txt
+    (standard GTFS column names; optional `via` in routes.txt and
+    `district` / `state` in stops.txt).
+  * Flat CSV: one row per stop of each trip, i.e. a pre-joined stop_times
+    file with the columns
+        route_id, trip_id, stop_sequence, stop_name, arrival_time, departure_time
+    and optionally via, stop_lat, stop_lon, district, state.
+
+stop_times rows must be grouped by trip_id (GTFS exports are). Each trip
+becomes a Trip on a Route whose start/end are the first/last stop and whose
+intermediate stops become RouteStops; trips of the same route_id with the
+same stop pattern share one Route. Missing RouteTemplates are learned the
+same way add_route does it.
+
+Parsed trips are buffered and written every IMPORT_CHUNK_TRIPS trips in one
+transaction with bulk_create, so memory stays flat no matter how many
+stop_times rows there are. Bad rows are reported, never fatal.
+"""
+import csv
+import io
+import logging
+import zipfile
+from datetime import time as dt_time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Location, Route, RouteStop, Trip, RouteTemplate, TemplateStop
+from .serializers import upsert_locations
+from .signals import route_network_changed, route_templates_changed
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TRIPS = getattr(settings, 'IMPORT_CHUNK_TRIPS', 2000)
+MAX_REPORTED_ERRORS = 500
+# Location names, districts and states, route vias: checked here, since SQLite wouldn't enforce it on write
+MAX_NAME_LENGTH = Location._meta.get_field('name').max_length
+COORDINATE_LIMITS = {'stop_lat': 90, 'stop_lon': 180}
+
+
+class RowError(ValueError):
+    pass
+
+
+def parse_time(value):
+    """ GTFS 'H:MM[:SS]' (hours may run past 24) -> datetime.time. """
+    try:
+        parts = [int(p) for p in value.strip().split(':')]
+        hours, minutes = parts[0], parts[1]
+        seconds = parts[2] if len(parts) > 2 else 0
+    except (AttributeError, ValueError, IndexError):
+        raise RowError(f"Invalid time '{value}'")
+    if not (0 <= minutes < 60 and 0 <= seconds < 60 and hours >= 0):
+        raise RowError(f"Invalid time '{value}'")
+    return dt_time(hours % 24, minutes, seconds)
+
+
+def parse_coordinate(value, column):
+    """ A stop_lat / stop_lon cell -> Decimal inside the valid range. """
+    try:
+        number = Decimal(value.strip())
+    except (AttributeError, InvalidOperation):
+        raise RowError(f"Invalid {column} '{value}'")
+    if not (number.is_finite() and abs(number) <= COORDINATE_LIMITS[column]):
+        raise RowError(f"Invalid {column} '{value}'")
+    return number
+
+
+def _check_length(value, what):
+    if len(value) > MAX_NAME_LENGTH:
+        raise RowError(f"{what} is longer than {MAX_NAME_LENGTH} characters")
+
+
+def _stop_data(row):
+    """ The Location fields a stop row sets ({'lat', 'lon', 'district', 'state'}, any subset), checked. """
+    data = {}
+    for key, column in (('lat', 'stop_lat'), ('lon', 'stop_lon'), ('district', 'district'), ('state', 'state')):
+        value = (row.get(column) or '').strip()
+        if not value:
+            continue
+        if column in COORDINATE_LIMITS:
+            value = parse_coordinate(value, column)
+        else:
+            _check_length(value, column)
+        data[key] = value
+    return data
+
+
+def _text(binary):
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+
+class TimetableImporter:
+    def __init__(self, bus):
+        self.bus = bus
+        self.errors = []
+        self.error_count = 0
+        self.stats = {"routes": 0, "trips": 0, "route_stops": 0, "templates": 0, "locations": 0}
+
+        self._pending = []          # parsed trips waiting for the next flush
+        self._routes = {}           # (route_ref, stop pattern) -> Route id
+        self._location_ids = {}     # stop name -> Location id
+        self._templates = set(RouteTemplate.objects.values_list('lookup_key', flat=True))
+
+    # ------------------------------------------------------------------
+    # Entry points
+
+    def import_file(self, fileobj, filename=''):
+        """ Zip -> GTFS-lite, anything else -> flat CSV. """
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            with zipfile.ZipFile(fileobj) as archive:
+                self.import_gtfs(archive)
+        else:
+            fileobj.seek(0)
+            self.import_csv(_text(fileobj), filename or 'timetable.csv')
+        return self.report()
+
+    def import_csv(self, text, filename='timetable.csv'):
+        def rows():
+            for line, row in self._read(filename, text):
+                yield filename, line, row
+
+        self._consume(rows(), lambda row: ((row.get('route_id') or '').strip(), (row.get('via') or '').strip()))
+        self.flush()
+
+    def import_gtfs(self, archive):
+        names = set(archive.namelist())
+        for required in ('stops.txt', 'trips.txt', 'stop_times.txt'):
+            if required not in names:
+                self._error(required, 0, "Missing file in archive")
+                return
+
+        # Small lookup tables (bounded by stops/routes/trips, not stop_times rows)
+        stops = {}
+        with archive.open('stops.txt') as f:
+            for line, row in self._read('stops.txt', _text(f)):
+                stop_id, name = (row.get('stop_id') or '').strip(), (row.get('stop_name') or '').strip()
+                if not stop_id or not name:
+                    self._error('stops.txt', line, "stop_id and stop_name are required")
+                    continue
+                stops[stop_id] = row
+
+        vias = {}
+        if 'routes.txt' in names:
+            with archive.open('routes.txt') as f:
+                for _, row in self._read('routes.txt', _text(f)):
+                    vias[(row.get('route_id') or '').strip()] = (
+                        row.get('via') or row.get('route_long_name') or row.get('route_short_name') or ''
+                    ).strip()
+
+        trip_routes = {}
+        with archive.open('trips.txt') as f:
+            for line, row in self._read('trips.txt', _text(f)):
+                trip_id, route_id = (row.get('trip_id') or '').strip(), (row.get('route_id') or '').strip()
+                if not trip_id or not route_id:
+                    self._error('trips.txt', line, "trip_id and route_id are required")
+                    continue
+                trip_routes[trip_id] = route_id
+
+        def rows():
+            with archive.open('stop_times.txt') as f:
+                for line, row in self._read('stop_times.txt', _text(f)):
+                    stop = stops.get((row.get('stop_id') or '').strip())
+                    if stop is None:
+                        self._error('stop_times.txt', line, f"Unknown stop_id '{row.get('stop_id')}'")
+                        row['_invalid'] = True
+                    else:
+                        row['stop_name'] = stop['stop_name'].strip()
+                        for key in ('stop_lat', 'stop_lon', 'district', 'state'):
+                            row[key] = stop.get(key)
+                    route_id = trip_routes.get((row.get('trip_id') or '').strip())
+                    if route_id is None:
+                        self._error('stop_times.txt', line, f"Unknown trip_id '{row.get('trip_id')}'")
+                        row['_invalid'] = True
+                    row['route_id'] = route_id or ''
+                    yield 'stop_times.txt', line, row
+
+        self._consume(rows(), lambda row: (row['route_id'], vias.get(row['route_id'], '')))
+        self.flush()
+
+    # ------------------------------------------------------------------
+    # Parsing
+
+    def _read(self, filename, text):
+        """ (line, row) of a CSV file. Short rows get '' for missing columns; bytes that aren't UTF-8 end the file with an error. """
+        line = 1
+        try:
+            for line, row in enumerate(csv.DictReader(text, restval=''), start=2):
+                yield line, row
+        except UnicodeDecodeError:
+            self._error(filename, line + 1, "File is not UTF-8 text")
+
+    def _consume(self, rows, route_of):
+        """ Group consecutive rows by trip_id and hand each complete trip to _add_trip. """
+        current_trip, trip_rows, invalid, finished = None, [], False, set()
+
+        for filename, line, row in rows:
+            trip_ref = (row.get('trip_id') or '').strip()
+            if trip_ref != current_trip:
+                if current_trip is not None and not invalid:
+                    self._add_trip(route_of(trip_rows[0][2]), current_trip, trip_rows)
+                finished.add(current_trip)
+                current_trip, trip_rows, invalid = trip_ref, [], False
+                if not trip_ref:
+                    self._error(filename, line, "trip_id is required")
+                    invalid = True
+                elif trip_ref in finished:
+                    self._error(filename, line, f"Rows of trip '{trip_ref}' must be contiguous")
+                    invalid = True
+            if row.get('_invalid'):
+                invalid = True
+            trip_rows.append((filename, line, row))
+
+        if current_trip is not None and not invalid:
+            self._add_trip(route_of(trip_rows[0][2]), current_trip, trip_rows)
+
+    def _add_trip(self, route, trip_ref, trip_rows):
+        route_ref, via = route
+        filename, first_line, _ = trip_rows[0]
+        try:
+            if not route_ref:
+                raise RowError("route_id is required")
+            _check_length(via or '', "via")
+            ordered = []
+            for _, line, row in trip_rows:
+                try:
+                    sequence = int(row.get('stop_sequence') or '')
+                except (TypeError, ValueError):
+                    raise RowError(f"Invalid stop_sequence on line {line}")
+                name = (row.get('stop_name') or '').strip()
+                if not name:
+                    raise RowError(f"stop_name is required on line {line}")
+                try:
+                    _check_length(name, "stop_name")
+                    data = _stop_data(row)
+                except RowError as e:
+                    raise RowError(f"{e} on line {line}")
+                ordered.append((sequence, name, data, row))
+            ordered.sort(key=lambda item: item[0])
+            if len(ordered) < 2:
+                raise RowError("A trip needs at least two stops")
+
+            first, last = ordered[0][3], ordered[-1][3]
+            start_time = parse_time(first.get('departure_time') or first.get('arrival_time'))
+            end_time = parse_time(last.get('arrival_time') or last.get('departure_time'))
+        except RowError as e:
+            self._error(filename, first_line, f"Trip '{trip_ref}': {e}")
+            return
+
+        stops = [(name, data) for _, name, data, _ in ordered]
+
+        self._pending.append((route_ref, via, stops, start_time, end_time))
+        if len(self._pending) >= CHUNK_TRIPS:
+            self.flush()
+
+    # ------------------------------------------------------------------
+    # Writing
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+
+        with transaction.atomic():
+            # 1. Locations not seen in earlier chunks: one batched upsert
+            location_data = {}
+            for _, _, stops, _, _ in pending:
+                for name, data in stops:
+                    if name not in self._location_ids:
+                        location_data.setdefault(name, {}).update(data)
+            if location_data:
+                locations = upsert_locations(location_data)
+                self._location_ids.update({name: loc.id for name, loc in locations.items()})
+                self.stats["locations"] += len(locations)
+
+            # 2. New routes (one per route_id + stop pattern)
+            new_routes = {}
+            for route_ref, via, stops, _, _ in pending:
+                key = (route_ref, tuple(name for name, _ in stops))
+                if key not in self._routes and key not in new_routes:
+                    new_routes[key] = (Route(
+                        bus=self.bus, start_location=stops[0][0], end_location=stops[-1][0], via=via or None
+                    ), via)
+            created = _create_with_pks(Route, [route for route, _ in new_routes.values()])
+            for key, route in zip(new_routes, created):
+                self._routes[key] = route.id
+
+            route_stops = [
+                RouteStop(route_id=self._routes[key], location_id=self._location_ids[name], stop_number=number)
+                for key in new_routes
+                for number, name in enumerate(key[1][1:-1], start=1)
+            ]
+            RouteStop.objects.bulk_create(route_stops, batch_size=1000)
+
+            # 3. Learn templates for paths we haven't seen
+            new_templates = {}
+            for key, (route, via) in new_routes.items():
+                template_key = RouteTemplate.make_lookup_key(route.start_location, route.end_location, via)
+                if template_key not in self._templates and template_key not in new_templates:
+                    template = RouteTemplate(
+                        start_location_id=self._location_ids[route.start_location],
+                        end_location_id=self._location_ids[route.end_location],
+                        via=via or None,
+                        created_by_id=self.bus.user_id,
+                    )
+                    # bulk_create skips save(), which normally fills the keys
+                    template.set_keys(route.start_location, route.end_location)
+                    new_templates[template_key] = (template, key[1][1:-1])
+            created = _create_with_pks(RouteTemplate, [template for template, _ in new_templates.values()])
+            TemplateStop.objects.bulk_create([
+                TemplateStop(template_id=template.id, location_id=self._location_ids[name], stop_number=number)
+                for template, (_, stop_names) in zip(created, new_templates.values())
+                for number, name in enumerate(stop_names, start=1)
+            ], batch_size=1000)
+            self._templates.update(new_templates)
+
+            # 4. Trips
+            Trip.objects.bulk_create([
+                Trip(route_id=self._routes[(route_ref, tuple(name for name, _ in stops))], start_time=start, end_time=end)
+                for route_ref, _, stops, start, end in pending
+            ], batch_size=1000)
+
+            # bulk_create sends no signals
+            route_network_changed(locations=bool(location_data))
+            if new_templates:
+                route_templates_changed()
+
+        self.stats["routes"] += len(new_routes)
+        self.stats["route_stops"] += len(route_stops)
+        self.stats["templates"] += len(new_templates)
+        self.stats["trips"] += len(pending)
+
+    def _error(self, filename, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"file": filename, "line": line, "error": message})
+
+    def report(self):
+        return {**self.stats, "error_count": self.error_count, "errors": self.errors}
+
+
+def _create_with_pks(model, objs):
+    """ bulk_create where the backend hands back primary keys, one save() each otherwise. """
+    if not objs:
+        return []
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=1000)
+    for obj in objs:
+        obj.save()
+    return objs
+
+
+def import_timetable(bus, fileobj, filename=''):
+    importer = TimetableImporter(bus)
+    report = importer.import_file(fileobj, filename)
+    logger.info(f"Timetable import for bus {bus.id}: {report['trips']} trips, {report['routes']} routes, {report['error_count']} errors")
+    return report
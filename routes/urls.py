@@ -3,9 +3,13 @@ from . import views
 
 urlpatterns = [
     path('add/', views.add_route, name='add_route'),
+    path('import/', views.import_timetable, name='import_timetable'),
     path('get/', views.get_routes, name='get_routes'),
     path('search/', views.search_routes, name='search_routes'),
+    path('journey/', views.plan_journey, name='plan_journey'),
     path('suggestions/', views.get_location_suggestions, name='suggestions'),
+    path('stops/nearby/', views.get_nearby_stops, name='get_nearby_stops'),
+    path('gtfs/feed.zip', views.gtfs_feed, name='gtfs_feed'),
     path('template-vias/', views.get_template_vias, name='get_template_vias'),
     path('delete/<int:route_id>/', views.delete_route, name='delete_route'),
     path('toggle-route-status/', views.toggle_route_status, name='toggle_route_status'),
@@ -16,6 +20,10 @@ urlpatterns = [
 
          # 🚍 LIVE BUS SYSTEM
     path('bus/update-location/', views.update_bus_location, name='update_bus_location'),
+    path('bus/locations/', views.ingest_bus_locations, name='ingest_bus_locations'),
+    path('bus/<int:bus_id>/history/', views.get_bus_location_history, name='get_bus_location_history'),
     path('bus/live/<int:route_id>/', views.get_live_bus_data, name='get_live_bus_data'),
+    path('bus/live/<int:route_id>/stream/', views.live_bus_stream, name='live_bus_stream'),
+    path('bus/fleet/', views.get_live_fleet, name='get_live_fleet'),
 
 ]
\ No newline at end of file
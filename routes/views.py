@@ -1,12 +1,25 @@
+from datetime import timedelta
+
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework import status
-from django.db.models import Q
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.static import serve
 
-from .models import Route, Location, RouteTemplate, FavoriteRoute, RouteNotification,RouteStop,BusLiveLocation
+from .models import Route, Location, RouteTemplate, FavoriteRoute, RouteNotification,RouteStop,BusLiveLocation, Trip
 from accounts.models import BusDetails
 from .serializers import RouteSerializer,BusLiveLocationSerializer
+from . import search_index, suggestions, journey_planner, departures, search_cache, geo_index, timetable_import, gtfs_export, template_cache, live_ingest, location_history, live_state, fleet_index
+
+DEFAULT_DEPARTURE_LIMIT = 10
+MAX_DEPARTURE_LIMIT = 100
+MAX_NEARBY_STOPS = 100
+MAX_FIXES_PER_BATCH = 500
+MAX_HISTORY_WINDOW = timedelta(hours=24)
+MAX_FLEET_ROUTES = 200
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -25,6 +38,23 @@ def add_route(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def import_timetable(request):
+    """ Bulk import routes/trips from an uploaded CSV or GTFS-lite zip (multipart field `file`). """
+    try:
+        bus_details = BusDetails.objects.get(user=request.user)
+    except BusDetails.DoesNotExist:
+        return Response({"error": "You are not registered as a bus operator."}, status=status.HTTP_403_FORBIDDEN)
+
+    upload = request.FILES.get('file')
+    if not upload:
+        return Response({"error": "Upload a CSV or GTFS zip in the 'file' field"}, status=status.HTTP_400_BAD_REQUEST)
+
+    report = timetable_import.import_timetable(bus_details, upload, upload.name)
+    return Response(report, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_routes(request):
@@ -33,7 +63,7 @@ def get_routes(request):
     except BusDetails.DoesNotExist:
         return Response({"error": "Not a bus operator"}, status=status.HTTP_403_FORBIDDEN)
 
-    routes = Route.objects.filter(bus=bus_details)
+    routes = Route.objects.filter(bus=bus_details).select_related('bus').prefetch_related('stops__location', 'trips')
     serializer = RouteSerializer(routes, many=True)
     return Response(serializer.data)
 
@@ -47,54 +77,89 @@ def search_routes(request):
     if not from_query or not to_query:
         return Response({"error": "Please provide start and end locations"}, status=status.HTTP_400_BAD_REQUEST)
 
-    # 1. Filter candidates from DB (Efficient Filtering)
-    from_matches = Route.objects.filter(
-        Q(start_location__icontains=from_query) |
-        Q(stops__location__name__icontains=from_query) 
-    ).distinct()
-
-    to_matches = Route.objects.filter(
-        Q(end_location__icontains=to_query) |
-        Q(stops__location__name__icontains=to_query)
-    ).distinct()
-
-    # Intersect
-    candidate_routes = from_matches & to_matches
-    # Prefetch related data to avoid N+1 problem during serialization
-    candidate_routes = candidate_routes.distinct().prefetch_related('stops__location', 'bus')
-
-    valid_routes = []
-
-    # 2. Logic Check: Does Start come BEFORE End?
-    for route in candidate_routes:
-        start_index = -1
-        end_index = -1
-
-        # Determine Start Index
-        if from_query.lower() in route.start_location.lower():
-            start_index = 0
-        else:
-            for stop in route.stops.all():
-                if from_query.lower() in stop.location.name.lower():
-                    start_index = stop.stop_number
-                    break 
-        
-        # Determine End Index
-        if to_query.lower() in route.end_location.lower():
-            end_index = 9999
-        else:
-            for stop in route.stops.all():
-                if to_query.lower() in stop.location.name.lower():
-                    end_index = stop.stop_number
-                    break 
-
-        if start_index != -1 and end_index != -1 and start_index < end_index:
-            valid_routes.append(route)
+    # Optional time filter: only the next `limit` departures after `depart_after`
+    time_filtered = 'depart_after' in request.GET or 'limit' in request.GET
+    depart_after = limit = None
+    if time_filtered:
+        try:
+            depart_after = parse_minutes(request.GET.get('depart_after'))
+            limit = max(min(int(request.GET.get('limit', DEFAULT_DEPARTURE_LIMIT)), MAX_DEPARTURE_LIMIT), 0)
+        except ValueError:
+            return Response({"error": "Invalid depart_after or limit value"}, status=status.HTTP_400_BAD_REQUEST)
+
+    # 0. Versioned result cache (any network change moves the version)
+    cache_key = search_cache.make_key(from_query, to_query, depart_after, limit)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached, headers={"X-Cache": "HIT"})
+
+    # 1. Resolve candidates from the in-memory stop-sequence index
+    # (start is position 0, end is position N, so "from before to" is a position check)
+    route_ids = search_index.search_route_ids(from_query, to_query)
+
+    valid_routes = (
+        Route.objects.filter(id__in=route_ids)
+        .order_by('id')
+        .select_related('bus')
+        .prefetch_related('stops__location')
+    )
+
+    # 2. Keep only the trips among the next `limit` departures
+    if time_filtered:
+        upcoming = departures.next_departures(route_ids, depart_after, limit)
+        first_departure = {}
+        for _, route_id, _ in upcoming:
+            first_departure.setdefault(route_id, len(first_departure))
+
+        valid_routes = valid_routes.filter(id__in=first_departure.keys()).prefetch_related(
+            Prefetch('trips', queryset=Trip.objects.filter(id__in=[trip_id for _, _, trip_id in upcoming]).order_by('start_time'))
+        )
+        # Soonest departure first
+        valid_routes = sorted(valid_routes, key=lambda route: first_departure[route.id])
+    else:
+        valid_routes = valid_routes.prefetch_related('trips')
 
     # --- OPTIMIZATION: REMOVED MANUAL LOOP ---
     # The Serializer now automatically handles 'is_booking_open'
-    serializer = RouteSerializer(valid_routes, many=True)
-    return Response(serializer.data)
+    data = RouteSerializer(valid_routes, many=True).data
+    search_cache.set(cache_key, data)
+    return Response(data, headers={"X-Cache": "MISS"})
+
+
+def parse_minutes(value):
+    """ 'HH:MM' -> minutes after midnight; empty means now. Raises ValueError. """
+    if not value:
+        now = timezone.localtime()
+        return now.hour * 60 + now.minute
+    hours, minutes = value.split(':')[:2]
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(value)
+    return hours * 60 + minutes
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def plan_journey(request):
+    """
+    Multi-leg journeys (with transfers) from `from` to `to`, leaving at or after
+    `depart` (HH:MM, defaults to now). Returns the Pareto-optimal itineraries:
+    each one arrives strictly earlier than any with fewer transfers.
+    """
+    from_query = request.GET.get('from', '').strip()
+    to_query = request.GET.get('to', '').strip()
+
+    if not from_query or not to_query:
+        return Response({"error": "Please provide start and end locations"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        depart_at = parse_minutes(request.GET.get('depart'))
+        max_transfers = int(request.GET.get('max_transfers', 2))
+    except ValueError:
+        return Response({"error": "Invalid depart or max_transfers value"}, status=status.HTTP_400_BAD_REQUEST)
+
+    itineraries, truncated = journey_planner.plan_journey(from_query, to_query, depart_at, max_transfers)
+    return Response({"itineraries": itineraries, "truncated": truncated})
 
 
 @api_view(['GET'])
@@ -105,17 +170,61 @@ def get_location_suggestions(request):
     if len(query) < 1:
         return Response([])
 
-    locations = Location.objects.filter(name__icontains=query)[:10]
-    data = [loc.name for loc in locations]
-    
+    # Served from the per-worker prefix/trigram engine, no LIKE '%q%' scan
+    data = suggestions.suggest(query)
+
     return Response(data)
 
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_nearby_stops(request):
+    """
+    Stops near a point, nearest first.
+    ?lat=&lng=&radius_km=  -> every stop within the radius (up to `limit`)
+    ?lat=&lng=&k=          -> the k nearest stops
+    """
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        radius_km = request.GET.get('radius_km')
+        radius_km = float(radius_km) if radius_km else None
+        k = int(request.GET.get('k', request.GET.get('limit', 10)))
+    except (KeyError, ValueError):
+        return Response({"error": "lat and lng are required and must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not (abs(lat) <= geo_index.MAX_LATITUDE and -180 <= lng <= 180) or k < 1 or (radius_km is not None and radius_km <= 0):
+        return Response({"error": "Invalid coordinates, radius_km or k"}, status=status.HTTP_400_BAD_REQUEST)
+
+    k = min(k, MAX_NEARBY_STOPS)
+    index = geo_index.get_index()
+    if radius_km is not None:
+        stops = index.within(lat, lng, radius_km, limit=k)
+    else:
+        stops = index.nearest(lat, lng, k=k)
+
+    return Response(stops)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def gtfs_feed(request):
+    """ The network as a GTFS static zip, rebuilt only after the route network changed. """
+    # Never built here: a stale feed is served while a background build replaces it
+    gtfs_export.refresh_in_background()
+    if not gtfs_export.FEED_PATH.exists():
+        return Response({"error": "The feed is being built, retry shortly"}, status=503, headers={"Retry-After": "30"})
+    # django's static serve handles Last-Modified / If-Modified-Since and streams the file
+    return serve(request._request, gtfs_export.FEED_PATH.name, document_root=gtfs_export.FEED_PATH.parent)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated]) 
 def get_template_vias(request):
     """
-    OPTIMIZED: Fetches both forward and reverse templates in a SINGLE database query.
+    Via options (with their stops, in travel order) for a start/end pair, from
+    templates stored in either direction. Served from the shared cache; see
+    routes/template_cache.py.
     """
     start_name = request.GET.get('start', '')
     end_name = request.GET.get('end', '')
@@ -123,34 +232,7 @@ def get_template_vias(request):
     if not start_name or not end_name:
         return Response([])
 
-    # --- FIXED: Return objects with via and stops ---
-    templates = RouteTemplate.objects.filter(
-        Q(start_location__name__iexact=start_name, end_location__name__iexact=end_name) |
-        Q(start_location__name__iexact=end_name, end_location__name__iexact=start_name)
-    ).prefetch_related('stops__location').distinct()
-
-    valid_vias = []
-    seen_vias = set()
-
-    for t in templates:
-        if not t.via or t.via in seen_vias:
-            continue
-        seen_vias.add(t.via)
-        
-        # Order the stops by stop_number
-        sorted_stops = sorted(t.stops.all(), key=lambda x: x.stop_number)
-        stop_names = [stop.location.name for stop in sorted_stops]
-        
-        # Check if we queried in reverse order of the stored template
-        if t.end_location.name.lower() == start_name.lower() and t.start_location.name.lower() == end_name.lower():
-            stop_names.reverse()
-            
-        valid_vias.append({
-            "via": t.via,
-            "stops": stop_names
-        })
-    
-    return Response(valid_vias)
+    return Response(template_cache.template_vias(start_name, end_name))
 
 
 @api_view(['DELETE'])
@@ -251,17 +333,6 @@ def set_route_notification(request):
 # =================eta=============
 # =================================
 
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371  # Earth radius in km
-
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-
-    return R * c
-
 # ------------
 
 @api_view(['POST'])
@@ -275,66 +346,134 @@ def update_bus_location(request):
 
     latitude = request.data.get("latitude")
     longitude = request.data.get("longitude")
-    speed = request.data.get("speed", 30)
 
     if not latitude or not longitude:
         return Response({"error": "latitude and longitude required"}, status=400)
 
-    obj, created = BusLiveLocation.objects.update_or_create(
-        bus=bus,
-        defaults={
-            "latitude": latitude,
-            "longitude": longitude,
-            "speed": speed
-        }
-    )
+    try:
+        fix = live_ingest.make_fix(bus.id, request.data, default_speed=30)
+        live_ingest.ingest([fix])
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+    except live_ingest.BufferFull:
+        return Response({"error": "Server busy, retry shortly"}, status=503, headers={"Retry-After": "1"})
 
     return Response({"message": "Location updated"})
 
 # -----------
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ingest_bus_locations(request):
+    """
+    Batched GPS upload: {"fixes": [{"latitude", "longitude", "speed", "heading", "timestamp"}, ...]}.
+    Fixes are buffered and only the newest per bus is written (see routes/live_ingest.py).
+    """
+    try:
+        bus = BusDetails.objects.get(user=request.user)
+    except BusDetails.DoesNotExist:
+        return Response({"error": "Bus not found"}, status=404)
+
+    reported = request.data.get("fixes")
+    if not isinstance(reported, list) or not reported:
+        return Response({"error": "fixes must be a non-empty list"}, status=400)
+    if len(reported) > MAX_FIXES_PER_BATCH:
+        return Response({"error": f"At most {MAX_FIXES_PER_BATCH} fixes per request"}, status=400)
+
+    fixes, errors = [], []
+    for index, data in enumerate(reported):
+        try:
+            fixes.append(live_ingest.make_fix(bus.id, data))
+        except (ValueError, AttributeError) as e:
+            errors.append({"index": index, "error": str(e)})
+
+    try:
+        kept = live_ingest.ingest(fixes)
+    except live_ingest.BufferFull:
+        return Response({"error": "Server busy, retry shortly"}, status=503, headers={"Retry-After": "1"})
+
+    return Response({"accepted": len(fixes), "kept": kept, "errors": errors}, status=status.HTTP_202_ACCEPTED)
+
 @api_view(['GET'])
-@permission_classes([AllowAny])
-def get_live_bus_data(request, route_id):
+@permission_classes([IsAuthenticated])
+def get_bus_location_history(request, bus_id):
+    """
+    GPS history of one bus: ?from=&to= (ISO-8601, default the last hour, at most
+    MAX_HISTORY_WINDOW apart). Only the bus's operator and staff can read it.
+    """
+    if not request.user.is_staff and not BusDetails.objects.filter(id=bus_id, user=request.user).exists():
+        return Response({"error": "Bus not found"}, status=status.HTTP_404_NOT_FOUND)
 
     try:
-        route = Route.objects.get(id=route_id)
-        live = BusLiveLocation.objects.get(bus=route.bus)
-    except:
-        return Response({"error": "Live bus not available"}, status=404)
+        end = parse_datetime(request.GET['to']) if request.GET.get('to') else timezone.now()
+        start = parse_datetime(request.GET['from']) if request.GET.get('from') else end - timedelta(hours=1)
+        start, end = (timezone.make_aware(t) if timezone.is_naive(t) else t for t in (start, end))
+    except (TypeError, ValueError, AttributeError):
+        return Response({"error": "from and to must be ISO-8601 datetimes"}, status=status.HTTP_400_BAD_REQUEST)
+    if not start < end <= start + MAX_HISTORY_WINDOW:
+        return Response({"error": f"from must be before to, at most {MAX_HISTORY_WINDOW} apart"}, status=status.HTTP_400_BAD_REQUEST)
 
-    stops = RouteStop.objects.filter(route=route).select_related('location')
+    return Response({"bus": bus_id, "fixes": location_history.read(bus_id, start, end)})
 
-    bus_lat = live.latitude
-    bus_lng = live.longitude
-    speed = live.speed or 30
+# -----------
 
-    stop_data = []
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_live_bus_data(request, route_id):
 
-    for stop in stops:
+    # Served from the live state store; the database is only read on a cold start (see routes/live_state.py)
+    data = live_state.route_live_data(route_id)
+    if data is None:
+        return Response({"error": "Live bus not available"}, status=404)
 
-        # IMPORTANT
-        # For now we simulate stop GPS
-        # later we can store GPS for each stop
-        stop_lat = bus_lat + (stop.stop_number * 0.002)
-        stop_lng = bus_lng + (stop.stop_number * 0.002)
+    return Response(data)
 
-        distance = haversine(bus_lat, bus_lng, stop_lat, stop_lng)
 
-        eta = (distance / speed) * 60  # minutes
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def live_bus_stream(request, route_id):
+    """ Only reached under WSGI: core.asgi answers the stream path itself (see routes/live_push.py). """
+    return Response(
+        {"error": f"Live streams need the ASGI server; poll /api/routes/bus/live/{route_id}/ instead"},
+        status=status.HTTP_501_NOT_IMPLEMENTED,
+    )
 
-        stop_data.append({
-            "stop_name": stop.location.name,
-            "stop_number": stop.stop_number,
-            "eta_minutes": round(eta)
-        })
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_live_fleet(request):
+    """
+    Every live bus on the map in one call (see routes/fleet_index.py).
+    ?bbox=min_lat,min_lng,max_lat,max_lng  or  ?routes=1,2,3
+    &since=<cursor of the previous answer>  -> only the buses that moved since
+    Rows are positional, in the order given by "fields".
+    """
+    try:
+        bbox = [float(v) for v in request.GET['bbox'].split(',')] if request.GET.get('bbox') else None
+        route_ids = [int(v) for v in request.GET['routes'].split(',')] if request.GET.get('routes') else None
+        since = float(request.GET['since']) if request.GET.get('since') else None
+    except ValueError:
+        return Response({"error": "bbox, routes and since must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if (bbox is None) == (route_ids is None):
+        return Response({"error": "Give either bbox or routes"}, status=status.HTTP_400_BAD_REQUEST)
+    if bbox is not None and (len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]):
+        return Response({"error": "bbox must be min_lat,min_lng,max_lat,max_lng"}, status=status.HTTP_400_BAD_REQUEST)
+    if route_ids is not None and len(route_ids) > MAX_FLEET_ROUTES:
+        return Response({"error": f"At most {MAX_FLEET_ROUTES} routes"}, status=status.HTTP_400_BAD_REQUEST)
+
+    fleet = fleet_index.get_fleet()
+    route_buses = live_state.get_route_buses()
+    if bbox is not None:
+        bus_ids = fleet.in_box(*bbox)
+    else:
+        bus_ids = list(dict.fromkeys(route_buses.bus_of[r] for r in route_ids if r in route_buses.bus_of))
+
+    rows = fleet.rows(bus_ids, since=since)
     return Response({
-        "bus_location": {
-            "lat": bus_lat,
-            "lng": bus_lng
-        },
-        "stops": stop_data
+        "cursor": fleet.cursor(),
+        "fields": fleet_index.FIELDS + ["route_ids"],
+        "buses": [row + [route_buses.routes_of.get(row[0], [])] for row in rows],
     })
 
 # =================eta=============